@@ -8,6 +8,7 @@ from torchnlp.samplers import BPTTBatchSampler
 from slp.config.nlp import SPECIAL_TOKENS
 from slp.data import Seq2SeqCollator
 from slp.modules.embed import PositionalEncoding
+from slp.modules.softmax import make_output_layer
 from slp.modules.transformer import Encoder as TransformerEncoder
 from slp.plbind import (
     PLDataModuleFromCorpus,
@@ -28,6 +29,8 @@ class TransformerLM(nn.Module):
         inner_size=256,
         dropout=0.2,
         tie_weights=True,
+        output_layer="softmax",
+        token_counts=None,
     ):
         super(TransformerLM, self).__init__()
         self.pos_encoder = PositionalEncoding(hidden_size, max_len=5000)
@@ -37,15 +40,22 @@ class TransformerLM(nn.Module):
             num_heads=num_heads,
             inner_size=inner_size,
             dropout=dropout,
-            nystrom=False,  # Cannot be used for autoregressive masks right now
-            kernel_size=None,  # Cannot be used for autoregressive tasks right now
+            nystrom=False,  # Set to True for long sequences. Needs causal=True for autoregressive masks
+            num_landmarks=32,
+            causal=True,
+            kernel_size=None,  # Cannot be used for autoregressive tasks
         )
         self.hidden_size = hidden_size
         self.encoder = nn.Embedding(vocab_size, hidden_size)
-        self.decoder = nn.Linear(hidden_size, vocab_size)
-        self.tie_weights = tie_weights
+        # adaptive or sampled softmax avoid the full hidden x vocab_size projection in training
+        self.output_layer = output_layer
+        self.decoder = make_output_layer(
+            output_layer, hidden_size, vocab_size, token_counts=token_counts
+        )
+        # The adaptive softmax clusters have their own projections
+        self.tie_weights = tie_weights and output_layer != "adaptive"
 
-        if tie_weights:
+        if self.tie_weights:
             self.decoder.weight = self.encoder.weight
 
         self.init_weights()
@@ -54,7 +64,7 @@ class TransformerLM(nn.Module):
         initrange = 0.1
         nn.init.uniform_(self.encoder.weight, -initrange, initrange)
 
-        if not self.tie_weights:
+        if not self.tie_weights and self.output_layer != "adaptive":
             nn.init.zeros_(self.decoder.weight)
             nn.init.uniform_(self.decoder.weight, -initrange, initrange)
 
@@ -62,6 +72,10 @@ class TransformerLM(nn.Module):
         src = self.encoder(src) * math.sqrt(self.hidden_size)
         src = self.pos_encoder(src)
         output = self.transformer_encoder(src, attention_mask=target_mask)
+
+        if self.output_layer != "softmax":
+            # The output layer is the criterion
+            return output
         output = self.decoder(output)
 
         return output
@@ -77,6 +91,7 @@ if __name__ == "__main__":
     bptt = 35  # TODO: argparse this
     vocab_size = -1
     lr = 1e-4
+    output_layer = "adaptive"  # softmax, adaptive or sampled
 
     train, dev, test = wikitext_2_dataset(
         directory="data/",
@@ -115,10 +130,14 @@ if __name__ == "__main__":
         inner_size=256,
         dropout=0.2,
         tie_weights=True,
+        output_layer=output_layer,
+        token_counts=ldm.token_counts,
     )
 
     optimizer = optim.Adam([p for p in model.parameters() if p.requires_grad], lr=lr)
-    criterion = nn.CrossEntropyLoss()
+    # Adaptive and sampled softmax compute the loss from the hidden states.
+    # Perplexity is exact on the validation and test sets
+    criterion = nn.CrossEntropyLoss() if output_layer == "softmax" else model.decoder
 
     lm = TransformerPLModule(
         model,
@@ -1,6 +1,12 @@
-from slp.data.collators import Seq2SeqCollator, SequenceClassificationCollator
+from slp.data.collators import (
+    PackedSequenceClassificationCollator,
+    Seq2SeqCollator,
+    SequenceClassificationCollator,
+)
 from slp.data.corpus import HfCorpus, WordCorpus, create_vocab
 from slp.data.datasets import CorpusDataset, CorpusLMDataset
+from slp.data.prefetch import PrefetchDataLoader, move_batch
+from slp.data.snapshot import SnapshotDataset
 from slp.data.transforms import (
     HuggingFaceTokenizer,
     ReplaceUnknownToken,
@@ -192,3 +192,101 @@ class MultimodalSequenceClassificationCollator(object):
         )
 
         return inputs, ttargets.to(self.device), lengths
+
+
+class PackedSequenceClassificationCollator(object):
+    def __init__(self, pad_indx=0, max_length=128, device="cpu"):
+        """Collate function that packs several short sequences in each row, for sequence classification
+
+        * Pack sequences into rows of at most max_length tokens (first fit, longest sequences first)
+        * Emit segment ids, per segment position ids and row lengths
+
+        Segment ids are the 1-based index of each example in the batch, so per segment outputs
+        (slp.util.pytorch.pool_segments) are in the original example order. Use
+        slp.util.pytorch.block_diagonal_mask to keep examples in the same row from attending to each other.
+
+        Args:
+            pad_indx (int): Pad token index. Defaults to 0.
+            max_length (int): Maximum row length. Longer sequences are truncated. Defaults to 128.
+            device (str): device of returned tensors. Leave this as "cpu".
+                The LightningModule will handle the Conversion.
+
+        Examples:
+            >>> dataloader = torch.utils.DataLoader(my_dataset, collate_fn=PackedSequenceClassificationCollator())
+        """
+        self.pad_indx = pad_indx
+        self.device = device
+        self.max_length = max_length
+
+    def pack(self, lengths: List[int]) -> List[List[int]]:
+        """Assign sequences to rows
+
+        Args:
+            lengths (List[int]): Sequence lengths
+
+        Returns:
+            List[List[int]]: Indices of the sequences in each row
+        """
+        rows: List[List[int]] = []
+        free: List[int] = []
+
+        for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            for r, space in enumerate(free):
+                if lengths[idx] <= space:
+                    rows[r].append(idx)
+                    free[r] -= lengths[idx]
+
+                    break
+            else:
+                rows.append([idx])
+                free.append(self.max_length - lengths[idx])
+
+        return rows
+
+    def __call__(
+        self, batch: List[Tuple[torch.Tensor, Label]]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Call collate function
+
+        Args:
+            batch (List[Tuple[torch.Tensor, slp.util.types.Label]]): Batch of samples.
+                It expects a list of tuples (inputs, label).
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]: Returns tuple of batched
+                tensors (inputs [R, L], labels [N], row lengths [R], segment ids [R, L], position ids [R, L])
+        """
+        inputs: List[torch.Tensor] = [b[0][: self.max_length] for b in batch]
+        targets: List[Label] = [b[1] for b in batch]
+        rows = self.pack([s.size(0) for s in inputs])
+
+        packed, segments, positions = [], [], []
+
+        for row in rows:
+            packed.append(torch.cat([inputs[i] for i in row]))
+            segments.append(
+                torch.cat(
+                    [
+                        torch.full((inputs[i].size(0),), i + 1, dtype=torch.long)
+                        for i in row
+                    ]
+                )
+            )
+            positions.append(torch.cat([torch.arange(inputs[i].size(0)) for i in row]))
+
+        lengths = torch.tensor([s.size(0) for s in packed], device=self.device)
+        inputs_packed: torch.Tensor = pad_sequence(
+            packed, batch_first=True, padding_value=self.pad_indx
+        ).to(self.device)
+        segment_ids = pad_sequence(segments, batch_first=True).to(self.device)
+        position_ids = pad_sequence(positions, batch_first=True).to(self.device)
+
+        ttargets: torch.Tensor = mktensor(targets, device=self.device, dtype=torch.long)
+
+        return (
+            inputs_packed,
+            ttargets.to(self.device),
+            lengths,
+            segment_ids,
+            position_ids,
+        )
@@ -0,0 +1,283 @@
+import queue
+import threading
+import time
+import weakref
+from typing import Any, Iterator, Optional
+
+import torch
+from loguru import logger
+from torch.utils.data import DataLoader
+
+from slp.util import types
+
+
+def move_batch(batch: Any, device: types.Device, non_blocking: bool = False) -> Any:
+    """Recursively move all tensors in a batch to a device
+
+    Handles tensors nested in tuples, lists and dicts, which covers the outputs of
+    the collators in slp.data.collators
+
+    Args:
+        batch (Any): Batch, as returned by the collate function
+        device (types.Device): Target device
+        non_blocking (bool): Use non-blocking memory transfers. Defaults to False.
+
+    Returns:
+        Any: The batch, with all tensors in the target device
+    """
+
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+
+    if isinstance(batch, dict):
+        return {k: move_batch(v, device, non_blocking) for k, v in batch.items()}
+
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(move_batch(b, device, non_blocking) for b in batch)
+
+    return batch
+
+
+def _record_stream(batch: Any, stream: "torch.cuda.Stream") -> None:
+    """Mark tensors created in a side stream as used by the consumer stream
+
+    Prevents the caching allocator from reusing their memory too early
+    """
+
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for b in batch:
+            _record_stream(b, stream)
+
+
+class _ExceptionWrapper(object):
+    def __init__(self, exc: BaseException):
+        """Carry an exception raised in the producer thread over to the consumer"""
+        self.exc = exc
+
+
+_END = object()
+
+
+def _put(q: queue.Queue, stop_event: threading.Event, item: Any) -> bool:
+    """Put item in queue. Give up if the consumer has stopped iterating"""
+
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _produce(
+    iterator: Iterator,
+    q: queue.Queue,
+    stop_event: threading.Event,
+    device: Optional[types.Device],
+    stream: Optional["torch.cuda.Stream"],
+) -> None:
+    """Producer loop. Collate (through the underlying iterator) and transfer batches
+
+    It only holds the shared queue and stop event, not the consumer iterator, so that an abandoned
+    consumer is garbage collected and stops the thread
+    """
+    try:
+        for batch in iterator:
+            if stop_event.is_set():
+                return
+            event = None
+
+            if stream is not None:
+                with torch.cuda.stream(stream):
+                    batch = move_batch(batch, device, non_blocking=True)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+            elif device is not None:
+                batch = move_batch(batch, device, non_blocking=True)
+
+            if not _put(q, stop_event, (batch, event)):
+                return
+    except Exception as e:  # noqa: B902
+        _put(q, stop_event, _ExceptionWrapper(e))
+
+        return
+    _put(q, stop_event, _END)
+
+
+class _PrefetchIterator(object):
+    def __init__(self, loader: "PrefetchDataLoader", iterator: Iterator):
+        """Iterator that produces batches in a background thread
+
+        Args:
+            loader (PrefetchDataLoader): Parent loader. Used for configuration and statistics
+            iterator (Iterator): Underlying DataLoader iterator
+        """
+        self.loader = loader
+        self.device = loader.device
+        self.queue: queue.Queue = queue.Queue(maxsize=loader.prefetch_batches)
+        self.stop_event = threading.Event()
+        self.stream = None
+
+        if self.device is not None and torch.device(self.device).type == "cuda":
+            self.stream = torch.cuda.Stream(device=torch.device(self.device))
+
+        self.wait_time = 0.0
+        self.num_batches = 0
+        self.finished = False
+        self.thread = threading.Thread(
+            target=_produce,
+            args=(iterator, self.queue, self.stop_event, self.device, self.stream),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def __iter__(self) -> "_PrefetchIterator":
+        return self
+
+    def __next__(self) -> Any:
+        if self.finished:
+            raise StopIteration
+
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.wait_time += time.perf_counter() - start
+
+        if item is _END:
+            self.close()
+            raise StopIteration
+
+        if isinstance(item, _ExceptionWrapper):
+            self.close()
+            raise item.exc
+
+        batch, event = item
+
+        if event is not None:
+            current = torch.cuda.current_stream(device=torch.device(self.device))
+            current.wait_event(event)
+            _record_stream(batch, current)
+
+        self.num_batches += 1
+
+        return batch
+
+    def close(self) -> None:
+        """Stop the producer thread and report the time spent waiting for data
+
+        Called at the end of the pass, when the loader creates a new iterator and when the
+        iterator is garbage collected, e.g. after a break. Partial passes are reported too
+        """
+
+        if self.finished:
+            return
+        self.finished = True
+        self.stop_event.set()
+
+        if self.thread is not threading.current_thread():
+            # At most one batch is still being prepared
+            self.thread.join()
+        self.loader._update_stats(self.wait_time, self.num_batches)
+
+    def __del__(self):
+        self.close()
+
+
+class PrefetchDataLoader(DataLoader):
+    def __init__(
+        self,
+        *args,
+        prefetch_batches: int = 2,
+        device: Optional[types.Device] = None,
+        **kwargs,
+    ):
+        """DataLoader that prepares the next batches in a background thread
+
+        The underlying DataLoader iteration (sampling, collation, tensor creation and pinning)
+        and the optional transfer to device run in a background thread, which keeps up to
+        prefetch_batches ready batches in a queue. This overlaps data preparation with the
+        current training step. It is most useful when num_workers=0, where all of this work
+        would otherwise run synchronously before each step.
+
+        If device is a CUDA device, transfers are issued with non_blocking=True in a side stream
+        and the consumer stream waits on an event before using the batch.
+
+        The loader records the time the training loop spends waiting for data. After each
+        pass it is logged and accumulated in self.wait_time and self.num_batches.
+
+        Passes that stop early (e.g. the sanity check or limit_train_batches) stop the background
+        thread when the iterator is garbage collected, or when the loader creates its next iterator.
+        Call close() to stop it explicitly.
+
+        Args:
+            *args: Positional arguments for torch.utils.data.DataLoader
+            prefetch_batches (int): Number of batches to prepare ahead. Defaults to 2.
+            device (Optional[types.Device]): Move batches to this device in the background thread.
+                Defaults to None, which leaves device placement to the LightningModule.
+            **kwargs: Keyword arguments for torch.utils.data.DataLoader
+
+        Examples:
+            >>> loader = PrefetchDataLoader(dataset, batch_size=32, collate_fn=collate_fn, prefetch_batches=4)
+            >>> for batch in loader:
+            ...     step(batch)
+            >>> loader.avg_wait_time  # seconds per batch spent waiting for data
+        """
+        super(PrefetchDataLoader, self).__init__(*args, **kwargs)
+
+        if prefetch_batches < 1:
+            raise ValueError("prefetch_batches should be >= 1")
+        self.prefetch_batches = prefetch_batches
+        self.device = device
+        self.wait_time = 0.0
+        self.num_batches = 0
+        self._prefetch_iterator: Optional[weakref.ref] = None
+
+    def __iter__(self) -> Iterator:  # type: ignore
+        # The previous producer must stop before the (possibly persistent) workers are reused
+        self.close()
+        iterator = _PrefetchIterator(self, super(PrefetchDataLoader, self).__iter__())
+        self._prefetch_iterator = weakref.ref(iterator)
+
+        return iterator
+
+    def close(self) -> None:
+        """Stop the background thread of the current pass, if it is still running"""
+        iterator = (
+            self._prefetch_iterator() if self._prefetch_iterator is not None else None
+        )
+
+        if iterator is not None:
+            iterator.close()
+        self._prefetch_iterator = None
+
+    def _update_stats(self, wait_time: float, num_batches: int) -> None:
+        """Accumulate and log data waiting time for a finished pass
+
+        Args:
+            wait_time (float): Seconds spent waiting for data
+            num_batches (int): Number of consumed batches
+        """
+        self.wait_time += wait_time
+        self.num_batches += num_batches
+        per_batch = 1000 * wait_time / max(num_batches, 1)
+        logger.info(
+            f"Waited {wait_time:.3f}s for data over {num_batches} batches ({per_batch:.2f} ms/batch)"
+        )
+
+    @property
+    def avg_wait_time(self) -> float:
+        """Average seconds per batch the consumer waited for data over all passes
+
+        Returns:
+            float: Average waiting time per batch
+        """
+
+        return self.wait_time / max(self.num_batches, 1)
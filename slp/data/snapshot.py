@@ -0,0 +1,368 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from loguru import logger
+from torch.utils.data import Dataset
+
+SNAPSHOT_VERSION = 1
+META_FILE = "meta.json"
+VOCAB_FILE = "word2idx.json"
+FREQUENCIES_FILE = "frequencies.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+
+
+def config_hash(config: Dict[str, Any]) -> str:
+    """Stable hash of a preprocessing configuration
+
+    Args:
+        config (Dict[str, Any]): Configuration. Values that are not json serializable are
+            hashed through their string representation
+
+    Returns:
+        str: sha256 hex digest of the configuration
+    """
+    serialized = json.dumps(config, sort_keys=True, default=str)
+
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def _field_files(path: str, split: str, field: int) -> Tuple[str, str, str]:
+    prefix = os.path.join(path, f"{split}.{field}")
+
+    return f"{prefix}.data.npy", f"{prefix}.offsets.npy", f"{prefix}.shapes.npy"
+
+
+def _as_fields(item: Any) -> Tuple[Any, ...]:
+    if isinstance(item, (tuple, list)):
+        return tuple(item)
+
+    return (item,)
+
+
+def _to_numpy(x: Any) -> np.ndarray:
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+
+    return np.asarray(x)
+
+
+def save_split(dataset: Dataset, path: str, split: str) -> Dict[str, Any]:
+    """Materialize a dataset and write it to disk in a flat, mmap friendly layout
+
+    Each sample is expected to be a tuple of fields (e.g. (input ids, label)).
+    Every field is converted to a numpy array. For every field three files are written:
+
+    * {split}.{field}.data.npy: All samples flattened and concatenated
+    * {split}.{field}.offsets.npy: Start position of each sample in data
+    * {split}.{field}.shapes.npy: Original shape of each sample. For sequences, shapes[:, 0]
+        are the sequence lengths
+
+    Args:
+        dataset (Dataset): Dataset to save. All transforms are applied before saving
+        path (str): Snapshot directory
+        split (str): Split name [train|val|test]
+
+    Raises:
+        ValueError: If samples contain fields that cannot be converted to numeric arrays
+
+    Returns:
+        Dict[str, Any]: Split metadata (number of samples, field dtypes and dimensions)
+    """
+    fields: Optional[List[List[np.ndarray]]] = None
+    is_tensor: List[bool] = []
+
+    for idx in range(len(dataset)):  # type: ignore
+        item = _as_fields(dataset[idx])
+        sample = [_to_numpy(f) for f in item]
+
+        if fields is None:
+            fields = [[] for _ in sample]
+            is_tensor = [isinstance(f, torch.Tensor) for f in item]
+
+        if len(sample) != len(fields):
+            raise ValueError(
+                f"Sample {idx} of {split} set has {len(sample)} fields. Expected {len(fields)}"
+            )
+
+        for f, arr in zip(fields, sample):
+            if arr.dtype == object or arr.dtype.kind in {"U", "S"}:
+                raise ValueError(
+                    f"Cannot snapshot non numeric field of type {arr.dtype} in {split} set"
+                )
+            f.append(arr)
+
+    fields = fields if fields is not None else []
+    meta_fields = []
+
+    for i, samples in enumerate(fields):
+        ndims = {s.ndim for s in samples}
+
+        if len(ndims) > 1:
+            raise ValueError(
+                f"Field {i} of {split} set has inconsistent number of dimensions {ndims}"
+            )
+        ndim = ndims.pop()
+        dtype = np.result_type(*[s.dtype for s in samples])
+        sizes = np.array([s.size for s in samples], dtype=np.int64)
+        offsets = np.zeros(len(samples), dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)[:-1]
+        shapes = np.array([s.shape for s in samples], dtype=np.int64).reshape(
+            len(samples), ndim
+        )
+        data = np.concatenate([s.reshape(-1).astype(dtype) for s in samples])
+
+        data_file, offsets_file, shapes_file = _field_files(path, split, i)
+        np.save(data_file, data)
+        np.save(offsets_file, offsets)
+        np.save(shapes_file, shapes)
+        meta_fields.append({"dtype": dtype.str, "ndim": ndim, "tensor": is_tensor[i]})
+
+    num_samples = len(fields[0]) if fields else 0
+
+    return {"num_samples": num_samples, "fields": meta_fields}
+
+
+class SnapshotDataset(Dataset):
+    def __init__(self, path: str, split: str, mmap: bool = True):
+        """Dataset backed by a split saved with save_split
+
+        Samples are read lazily from memory mapped numpy files, so opening a snapshot
+        is instant and memory is shared between DataLoader workers.
+        Fields that were torch tensors in the original dataset are returned as tensors and the rest
+        as numpy arrays or python numbers, matching the outputs of the original dataset
+
+        Args:
+            path (str): Snapshot directory
+            split (str): Split name [train|val|test]
+            mmap (bool): Memory map the arrays instead of loading them in memory. Defaults to True.
+        """
+        with open(os.path.join(path, META_FILE), "r") as fd:
+            meta = json.load(fd)
+        self.split = split
+        self.num_samples = meta["splits"][split]["num_samples"]
+        self.data, self.offsets, self.shapes = [], [], []
+        self.is_tensor = [f["tensor"] for f in meta["splits"][split]["fields"]]
+        mmap_mode = "r" if mmap else None
+
+        for i, _ in enumerate(meta["splits"][split]["fields"]):
+            data_file, offsets_file, shapes_file = _field_files(path, split, i)
+            self.data.append(np.load(data_file, mmap_mode=mmap_mode))
+            self.offsets.append(np.load(offsets_file))
+            self.shapes.append(np.load(shapes_file))
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Lengths of the first field (inputs) of each sample
+
+        Returns:
+            np.ndarray: Sequence lengths. Useful for length based batch samplers
+        """
+
+        return self.shapes[0][:, 0]
+
+    def __len__(self) -> int:
+        """Number of samples
+
+        Returns:
+            int: Number of samples in split
+        """
+
+        return int(self.num_samples)
+
+    def __getitem__(self, idx: int) -> Tuple[Any, ...]:
+        """Read a sample
+
+        Args:
+            idx (int): Sample index
+
+        Returns:
+            Tuple[Any, ...]: The sample fields
+        """
+        sample = []
+
+        for data, offsets, shapes, is_tensor in zip(
+            self.data, self.offsets, self.shapes, self.is_tensor
+        ):
+            shape = tuple(shapes[idx])
+            start = offsets[idx]
+            arr = np.array(data[start : start + int(np.prod(shape))]).reshape(shape)
+
+            if is_tensor:
+                sample.append(torch.from_numpy(arr))
+            else:
+                sample.append(arr if arr.ndim > 0 else arr.item())
+
+        return tuple(sample)
+
+
+class SnapshotCorpus(object):
+    def __init__(
+        self,
+        vocab_size: int,
+        word2idx: Optional[Dict[str, int]] = None,
+        embeddings: Optional[np.ndarray] = None,
+        frequencies: Optional[Dict[str, int]] = None,
+    ):
+        """Vocabulary information of a corpus restored from a snapshot
+
+        Exposes the same vocabulary properties as WordCorpus, HfCorpus and TokenizedCorpus
+
+        Args:
+            vocab_size (int): Number of tokens in the vocabulary
+            word2idx (Optional[Dict[str, int]]): Word to index mapping. Defaults to None.
+            embeddings (Optional[np.ndarray]): Embeddings matrix. Defaults to None.
+            frequencies (Optional[Dict[str, int]]): Token occurence counts in the training corpus.
+                Defaults to None.
+        """
+        self.vocab_size = vocab_size
+        self.word2idx = word2idx
+        self.idx2word = (
+            {v: k for k, v in word2idx.items()} if word2idx is not None else None
+        )
+        self.embeddings = embeddings
+        self.frequencies = frequencies
+
+
+def write_snapshot(
+    path: str,
+    splits: Dict[str, Dataset],
+    config: Dict[str, Any],
+    corpus: Optional[Any] = None,
+) -> None:
+    """Write a snapshot directory
+
+    The snapshot is written in a temporary directory and moved in place when complete,
+    so an interrupted save never leaves a partial snapshot behind. An existing snapshot at path
+    is replaced
+
+    Args:
+        path (str): Snapshot directory
+        splits (Dict[str, Dataset]): Datasets to save, keyed by split name
+        config (Dict[str, Any]): Preprocessing configuration that produced the datasets
+        corpus (Optional[Any]): Train corpus. If provided, vocabulary and embeddings are saved.
+            Defaults to None.
+
+    Raises:
+        ValueError: If path exists and is neither a snapshot nor an empty directory
+    """
+
+    if os.path.exists(path) and not (
+        os.path.exists(os.path.join(path, META_FILE))
+        or (os.path.isdir(path) and not os.listdir(path))
+    ):
+        raise ValueError(f"{path} exists and is not a snapshot. Refusing to replace it")
+    tmp_path = f"{path}.tmp"
+
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    meta: Dict[str, Any] = {
+        "version": SNAPSHOT_VERSION,
+        "config": json.loads(json.dumps(config, default=str)),
+        "config_hash": config_hash(config),
+        "splits": {},
+        "vocab_size": None,
+    }
+
+    for split, dataset in splits.items():
+        logger.info(f"Saving {split} set to snapshot {path}")
+        meta["splits"][split] = save_split(dataset, tmp_path, split)
+
+    if corpus is not None:
+        meta["vocab_size"] = int(corpus.vocab_size)
+
+        if corpus.word2idx is not None:
+            with open(os.path.join(tmp_path, VOCAB_FILE), "w") as fd:
+                json.dump(corpus.word2idx, fd)
+
+        if corpus.embeddings is not None:
+            np.save(os.path.join(tmp_path, EMBEDDINGS_FILE), corpus.embeddings)
+
+        if getattr(corpus, "frequencies", None) is not None:
+            with open(os.path.join(tmp_path, FREQUENCIES_FILE), "w") as fd:
+                json.dump(dict(corpus.frequencies), fd)
+
+    with open(os.path.join(tmp_path, META_FILE), "w") as fd:
+        json.dump(meta, fd, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    logger.info(f"Saved snapshot version {SNAPSHOT_VERSION} to {path}")
+
+
+def read_snapshot(
+    path: str, config: Dict[str, Any], mmap: bool = True
+) -> Tuple[Dict[str, SnapshotDataset], Optional[SnapshotCorpus]]:
+    """Open a snapshot directory and validate it against the expected configuration
+
+    Args:
+        path (str): Snapshot directory
+        config (Dict[str, Any]): Expected preprocessing configuration
+        mmap (bool): Memory map the arrays. Defaults to True.
+
+    Raises:
+        ValueError: If the snapshot version is not supported
+        ValueError: If the snapshot was created with a different configuration
+
+    Returns:
+        Tuple[Dict[str, SnapshotDataset], Optional[SnapshotCorpus]]: Datasets keyed by split name
+            and vocabulary information, if saved
+    """
+    with open(os.path.join(path, META_FILE), "r") as fd:
+        meta = json.load(fd)
+
+    if meta["version"] != SNAPSHOT_VERSION:
+        raise ValueError(
+            f"Snapshot {path} has version {meta['version']}. Expected {SNAPSHOT_VERSION}"
+        )
+
+    if meta["config_hash"] != config_hash(config):
+        expected = json.loads(json.dumps(config, default=str))
+        diff = sorted(
+            k
+            for k in set(expected) | set(meta["config"])
+            if expected.get(k) != meta["config"].get(k)
+        )
+        raise ValueError(
+            f"Snapshot {path} was created with a different configuration. Mismatched keys: {diff}"
+        )
+
+    splits = {
+        split: SnapshotDataset(path, split, mmap=mmap) for split in meta["splits"]
+    }
+
+    corpus = None
+
+    if meta["vocab_size"] is not None:
+        word2idx, embeddings, frequencies = None, None, None
+        vocab_file = os.path.join(path, VOCAB_FILE)
+        embeddings_file = os.path.join(path, EMBEDDINGS_FILE)
+        frequencies_file = os.path.join(path, FREQUENCIES_FILE)
+
+        if os.path.exists(vocab_file):
+            with open(vocab_file, "r") as fd:
+                word2idx = json.load(fd)
+
+        if os.path.exists(embeddings_file):
+            embeddings = np.load(embeddings_file)
+
+        if os.path.exists(frequencies_file):
+            with open(frequencies_file, "r") as fd:
+                frequencies = json.load(fd)
+        corpus = SnapshotCorpus(
+            meta["vocab_size"],
+            word2idx=word2idx,
+            embeddings=embeddings,
+            frequencies=frequencies,
+        )
+
+    logger.info(f"Loaded snapshot {path} with splits {list(splits.keys())}")
+
+    return splits, corpus
@@ -0,0 +1,11 @@
+from slp.deploy.compile import compile_model
+from slp.deploy.export import OnnxModel, check_onnx_parity, export_onnx
+from slp.deploy.quantization import (
+    check_parity,
+    load_quantized,
+    measure_latency,
+    model_size,
+    quantize_and_report,
+    quantize_dynamic,
+    save_quantized,
+)
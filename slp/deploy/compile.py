@@ -0,0 +1,43 @@
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+
+def compile_model(
+    model: nn.Module,
+    fullgraph: bool = False,
+    backend: str = "inductor",
+    mode: Optional[str] = None,
+    dynamic: Optional[bool] = None,
+) -> nn.Module:
+    """Compile a model with torch.compile
+
+    The transformer encoders, attention layers, fusers and mmdrop compile without graph breaks,
+    e.g. with fullgraph=True. torch.compile does not capture nn.RNN / nn.LSTM / nn.GRU layers,
+    so the RNN based modules run with one graph break per recurrent layer, which runs eagerly.
+    Unpadded execution of the transformer encoders (varlen=True) has data dependent shapes and
+    needs fullgraph=False.
+
+    Args:
+        model (nn.Module): Model to compile
+        fullgraph (bool): Fail on graph breaks. Defaults to False.
+        backend (str): torch.compile backend. Defaults to "inductor".
+        mode (Optional[str]): torch.compile mode, e.g. "reduce-overhead". Defaults to None.
+        dynamic (Optional[bool]): Compile with dynamic shapes. Defaults to None (automatic).
+
+    Returns:
+        nn.Module: The compiled model. The input model if torch.compile is not available (pytorch < 2.0)
+    """
+
+    if not hasattr(torch, "compile"):
+        logger.warning(
+            "torch.compile requires pytorch >= 2.0. Running the model eagerly"
+        )
+
+        return model
+
+    return torch.compile(  # type: ignore
+        model, fullgraph=fullgraph, backend=backend, mode=mode, dynamic=dynamic
+    )
@@ -0,0 +1,301 @@
+import copy
+import inspect
+import json
+import warnings
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+# Positional model inputs: tensors, or dicts of tensors (e.g. modalities for multimodal models)
+ModelInputs = Tuple[Union[torch.Tensor, Dict[str, torch.Tensor]], ...]
+
+# [(argument name, dict keys or None for tensor arguments)]
+InputStructure = List[Tuple[str, Optional[List[str]]]]
+
+_STRUCTURE_KEY = "slp_input_structure"
+
+
+def _input_structure(model: nn.Module, sample_batch: ModelInputs) -> InputStructure:
+    """Names and dict keys of the positional model inputs
+
+    Arguments are named after the parameters of model.forward, e.g. x, lengths or attention_mask
+    """
+    params = [
+        p.name
+        for p in inspect.signature(model.forward).parameters.values()
+        if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)
+    ]
+    params += [f"input_{i}" for i in range(len(params), len(sample_batch))]
+
+    return [
+        (name, list(arg.keys()) if isinstance(arg, dict) else None)
+        for name, arg in zip(params, sample_batch)
+    ]
+
+
+def _input_names(structure: InputStructure) -> List[str]:
+    """Names of the flattened inputs. Dict arguments get one input per key, e.g. mod_dict.text"""
+    names = []
+
+    for name, keys in structure:
+        names += [f"{name}.{key}" for key in keys] if keys is not None else [name]
+
+    return names
+
+
+def _flatten(inputs: ModelInputs, structure: InputStructure) -> List[torch.Tensor]:
+    flat = []
+
+    for arg, (_, keys) in zip(inputs, structure):
+        flat += [arg[key] for key in keys] if keys is not None else [arg]  # type: ignore
+
+    return flat
+
+
+def _dynamic_axes(
+    sample_batch: ModelInputs, structure: InputStructure
+) -> Dict[str, Dict[int, str]]:
+    """Dynamic batch and sequence axes of the flattened inputs
+
+    All inputs share the batch axis. Inputs with the same dict key (e.g. the text features
+    and the text lengths) share the sequence axis, because modalities may have different lengths
+    """
+    axes = {}
+    names = _input_names(structure)
+
+    for name, x in zip(names, _flatten(sample_batch, structure)):
+        axes[name] = {0: "batch"}
+
+        if x.ndim > 1:
+            key = name.split(".", 1)[1] if "." in name else None
+            axes[name][1] = f"{key}_sequence" if key is not None else "sequence"
+
+    return axes
+
+
+def _as_tuple(out: Any) -> Tuple[torch.Tensor, ...]:
+    return tuple(out) if isinstance(out, (tuple, list)) else (out,)
+
+
+class _FlatInputs(nn.Module):
+    def __init__(self, model: nn.Module, structure: InputStructure):
+        """Call a model with flat tensor inputs, as required by torch.onnx.export
+
+        Args:
+            model (nn.Module): Model with tensor or dict positional inputs
+            structure (InputStructure): Input names and dict keys
+        """
+        super(_FlatInputs, self).__init__()
+        self.model = model
+        self.structure = structure
+
+    def forward(self, *flat: torch.Tensor):
+        """Regroup the flat inputs and call the model
+
+        Args:
+            *flat (torch.Tensor): Flattened inputs
+
+        Returns:
+            Model outputs
+        """
+        args: List[Any] = []
+        i = 0
+
+        for _, keys in self.structure:
+            if keys is None:
+                args.append(flat[i])
+                i += 1
+            else:
+                args.append(dict(zip(keys, flat[i : i + len(keys)])))
+                i += len(keys)
+
+        return self.model(*args)
+
+
+class OnnxModel(object):
+    def __init__(self, path: str, num_threads: Optional[int] = None):
+        """Run a model exported with export_onnx with onnxruntime on CPU
+
+        Call it with the same positional inputs as the original model, e.g. onnx_model(x, lengths)
+        or onnx_model(mod_dict, lengths). Can be used with measure_latency.
+
+        Args:
+            path (str): Exported model
+            num_threads (Optional[int]): onnxruntime intra-op threads. Defaults to None (onnxruntime default).
+        """
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                "Running exported models requires onnxruntime: pip install onnxruntime"
+            ) from e
+
+        options = onnxruntime.SessionOptions()
+
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.structure: InputStructure = [
+            (name, keys) for name, keys in json.loads(metadata[_STRUCTURE_KEY])
+        ]
+        # Inputs that do not affect the outputs are removed from the exported graph
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def eval(self) -> "OnnxModel":
+        """No-op, for compatibility with utilities that expect an nn.Module
+
+        Returns:
+            OnnxModel: self
+        """
+
+        return self
+
+    def __call__(self, *inputs: Union[torch.Tensor, Dict[str, torch.Tensor]]):
+        """Run inference
+
+        Args:
+            *inputs: Positional inputs of the original model
+
+        Returns:
+            Union[torch.Tensor, Tuple[torch.Tensor, ...]]: Model outputs, as CPU tensors
+        """
+        names = _input_names(self.structure)
+        flat = _flatten(inputs, self.structure)
+        feed = {
+            name: x.detach().cpu().numpy()
+            for name, x in zip(names, flat)
+            if name in self.input_names
+        }
+        out = tuple(torch.from_numpy(o) for o in self.session.run(None, feed))
+
+        return out[0] if len(out) == 1 else out
+
+
+@torch.no_grad()
+def check_onnx_parity(
+    model: nn.Module, onnx_model: OnnxModel, batches: Iterable[ModelInputs]
+) -> Dict[str, float]:
+    """Compare the outputs of a model and its onnxruntime export
+
+    Args:
+        model (nn.Module): Original model
+        onnx_model (OnnxModel): Exported model
+        batches (Iterable[ModelInputs]): Positional model inputs for each batch. Use batch sizes and
+            sequence lengths different from the export sample to check the dynamic axes
+
+    Returns:
+        Dict[str, float]: max_abs_diff and max_rel_diff over all outputs and batches
+    """
+    model.eval()
+    max_abs_diff, max_rel_diff = 0.0, 0.0
+
+    for inputs in batches:
+        outputs = _as_tuple(model(*inputs))
+        onnx_outputs = _as_tuple(onnx_model(*inputs))
+
+        for out, onnx_out in zip(outputs, onnx_outputs):
+            out = out.detach().cpu().float()
+            diff = (out - onnx_out.float()).abs()
+            max_abs_diff = max(max_abs_diff, diff.max().item())
+            max_rel_diff = max(
+                max_rel_diff, (diff / out.abs().clamp(min=1e-6)).max().item()
+            )
+
+    return {"max_abs_diff": max_abs_diff, "max_rel_diff": max_rel_diff}
+
+
+def export_onnx(
+    model: nn.Module,
+    sample_batch: ModelInputs,
+    path: str,
+    opset_version: int = 17,
+    check_batches: Optional[Iterable[ModelInputs]] = None,
+    atol: float = 1e-4,
+) -> Dict[str, float]:
+    """Export a model to ONNX with dynamic batch and sequence axes
+
+    The positional inputs of the model are flattened to named ONNX inputs:
+        * TokenRNN, RNNSequenceClassifier: x [B, L] token ids or [B, L, D] features, lengths [B].
+          Packed sequences are exported and run in onnxruntime.
+        * Transformer classifiers: x, attention_mask [B, L]
+        * Multimodal models: dict arguments, e.g. mod_dict.text [B, L_text, D_text] and lengths.text [B]
+          for MultimodalBaselineClassifier or inputs.text and attention_mask.text for
+          TransformerLateFusionClassifier.
+    All inputs have a dynamic batch axis and a dynamic sequence axis, which is shared by the inputs
+    of the same modality. After export, the model is run with onnxruntime on CPU and compared to
+    the pytorch model on the sample batch and check_batches, if onnxruntime is installed.
+    Sliding window attention (window_size) and unpadded execution (varlen=True) cannot be exported.
+
+    Args:
+        model (nn.Module): Model to export. It is exported in eval mode on CPU
+        sample_batch (ModelInputs): Example positional inputs, e.g. (x, lengths)
+        path (str): Output .onnx file
+        opset_version (int): ONNX opset. Defaults to 17.
+        check_batches (Optional[Iterable[ModelInputs]]): Extra inputs for the parity check,
+            preferably with other batch sizes and sequence lengths. Defaults to None.
+        atol (float): Warn if outputs differ more than this. Defaults to 1e-4.
+
+    Returns:
+        Dict[str, float]: Parity report (see check_onnx_parity). Empty if onnxruntime is not installed
+    """
+    try:
+        import onnx
+    except ImportError as e:
+        raise ImportError("ONNX export requires onnx: pip install onnx") from e
+
+    model = copy.deepcopy(model).cpu().eval()
+    structure = _input_structure(model, sample_batch)
+    input_names = _input_names(structure)
+
+    with torch.no_grad():
+        outputs = _as_tuple(model(*sample_batch))
+    output_names = (
+        ["output"]
+        if len(outputs) == 1
+        else [f"output_{i}" for i in range(len(outputs))]
+    )
+    dynamic_axes = _dynamic_axes(sample_batch, structure)
+    dynamic_axes.update({name: {0: "batch"} for name in output_names})
+
+    with warnings.catch_warnings():
+        # Python scalars computed from tensor shapes are expected. The parity check covers them
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        torch.onnx.export(
+            _FlatInputs(model, structure),
+            tuple(_flatten(sample_batch, structure)),
+            path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+    exported = onnx.load(path)
+    onnx.checker.check_model(exported)
+    exported.metadata_props.add(key=_STRUCTURE_KEY, value=json.dumps(structure))
+    onnx.save(exported, path)
+    logger.info(f"Exported ONNX model to {path}")
+
+    try:
+        onnx_model = OnnxModel(path)
+    except ImportError:
+        logger.warning("onnxruntime is not installed. Skipping the parity check")
+
+        return {}
+
+    batches = [sample_batch] + list(check_batches or [])
+    report = check_onnx_parity(model, onnx_model, batches)
+
+    for k, v in report.items():
+        logger.info(f"{k}: {v:.2e}")
+
+    if report["max_abs_diff"] > atol:
+        logger.warning(
+            f"ONNX outputs differ from pytorch by {report['max_abs_diff']:.2e} > {atol}"
+        )
+
+    return report
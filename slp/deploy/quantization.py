@@ -0,0 +1,261 @@
+import copy
+import inspect
+import io
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple, Type
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+# torch.quantization moved to torch.ao.quantization (pytorch >= 1.10)
+_quantization = getattr(getattr(torch, "ao", None), "quantization", torch.quantization)
+
+# Pickled modules cannot be loaded with weights_only=True, the default in recent pytorch versions
+_LOAD_KWARGS = (
+    {"weights_only": False}
+    if "weights_only" in inspect.signature(torch.load).parameters
+    else {}
+)
+
+DEFAULT_QUANTIZED_LAYERS: Set[Type[nn.Module]] = {nn.Linear, nn.LSTM, nn.GRU}
+
+ForwardFn = Callable[[nn.Module, Any], Tuple[torch.Tensor, torch.Tensor]]
+
+
+def _default_forward(model: nn.Module, batch: Any) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Forward pass for (inputs, targets, *extra) batches, e.g. from SequenceClassificationCollator
+
+    The model is called as model(inputs, *extra), e.g. model(inputs, lengths) for RNN classifiers
+    """
+    inputs, targets, *extra = batch
+
+    return model(inputs, *extra), targets
+
+
+def quantize_dynamic(
+    model: nn.Module,
+    layers: Optional[Set[Type[nn.Module]]] = None,
+    dtype: torch.dtype = torch.qint8,
+) -> nn.Module:
+    """Apply dynamic quantization to a model for CPU inference
+
+    Weights of the selected layer types are stored in int8. Activations are quantized on the fly,
+    so no calibration data are needed. The input model is not modified.
+
+    Args:
+        model (nn.Module): Model to quantize, e.g. TransformerSequenceClassifier, RNNSequenceClassifier,
+            TokenRNN or MultimodalBaselineClassifier
+        layers (Optional[Set[Type[nn.Module]]]): Layer types to quantize. Defaults to None (nn.Linear, nn.LSTM, nn.GRU).
+        dtype (torch.dtype): Quantized weight dtype. Defaults to torch.qint8.
+
+    Returns:
+        nn.Module: Quantized copy of the model, in eval mode
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    layers = layers if layers is not None else DEFAULT_QUANTIZED_LAYERS
+
+    return _quantization.quantize_dynamic(model, layers, dtype=dtype)
+
+
+def model_size(model: nn.Module) -> int:
+    """Size of the serialized state dict of a model
+
+    Args:
+        model (nn.Module): Model
+
+    Returns:
+        int: Size in bytes
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+
+    return buffer.tell()
+
+
+@torch.no_grad()
+def measure_latency(
+    model: nn.Module,
+    batches: Iterable[Any],
+    forward_fn: ForwardFn = _default_forward,
+    warmup: int = 2,
+) -> float:
+    """Average CPU latency of a model per batch
+
+    Args:
+        model (nn.Module): Model
+        batches (Iterable[Any]): Batches, e.g. a dataloader
+        forward_fn (ForwardFn): forward_fn(model, batch) returns (predictions, targets). Defaults to
+            model(inputs, *extra) for (inputs, targets, *extra) batches.
+        warmup (int): Number of warmup runs on the first batch. Defaults to 2.
+
+    Returns:
+        float: Seconds per batch
+    """
+    model.eval()
+    batches = list(batches)
+
+    for _ in range(warmup):
+        forward_fn(model, batches[0])
+
+    start = time.perf_counter()
+
+    for batch in batches:
+        forward_fn(model, batch)
+
+    return (time.perf_counter() - start) / len(batches)
+
+
+@torch.no_grad()
+def check_parity(
+    model: nn.Module,
+    quantized: nn.Module,
+    dataloader: Iterable[Any],
+    forward_fn: ForwardFn = _default_forward,
+) -> Dict[str, float]:
+    """Compare the predictions of a model and its quantized copy on held-out data
+
+    Args:
+        model (nn.Module): Original model
+        quantized (nn.Module): Quantized model
+        dataloader (Iterable[Any]): Held-out batches
+        forward_fn (ForwardFn): forward_fn(model, batch) returns ([B, C] logits or [B] scores, targets).
+            The get_predictions_and_targets method of the plbind predictors can be used. Defaults to
+            model(inputs, *extra) for (inputs, targets, *extra) batches.
+
+    Returns:
+        Dict[str, float]: accuracy and quantized_accuracy (argmax for logits, sign for scores),
+            agreement between the two models and max_abs_diff of their outputs
+    """
+    model.eval()
+    quantized.eval()
+    correct, quantized_correct, agree, total = 0, 0, 0, 0
+    max_abs_diff = 0.0
+
+    for batch in dataloader:
+        out, targets = forward_fn(model, batch)
+        quantized_out, _ = forward_fn(quantized, batch)
+        out, quantized_out = out.float(), quantized_out.float()
+
+        if out.ndim > 1 and out.size(-1) > 1:
+            pred, quantized_pred = out.argmax(-1), quantized_out.argmax(-1)
+        else:
+            pred = (out.view(-1) > 0).long()
+            quantized_pred = (quantized_out.view(-1) > 0).long()
+            targets = (targets.view(-1) > 0).long()
+
+        targets = targets.view(-1).to(pred.device)
+        correct += (pred == targets).sum().item()
+        quantized_correct += (quantized_pred == targets).sum().item()
+        agree += (pred == quantized_pred).sum().item()
+        total += pred.numel()
+        max_abs_diff = max(max_abs_diff, (out - quantized_out).abs().max().item())
+
+    return {
+        "accuracy": correct / total,
+        "quantized_accuracy": quantized_correct / total,
+        "agreement": agree / total,
+        "max_abs_diff": max_abs_diff,
+    }
+
+
+def save_quantized(
+    model: nn.Module, path: str, example_inputs: Optional[Tuple[Any, ...]] = None
+) -> None:
+    """Save a quantized model as a self-contained artifact
+
+    With example_inputs the model is traced with TorchScript, and the artifact can be loaded without
+    the model code. Otherwise the whole module is pickled, and slp must be importable when loading.
+
+    Args:
+        model (nn.Module): Quantized model
+        path (str): Output file
+        example_inputs (Optional[Tuple[Any, ...]]): Example positional inputs for tracing. Defaults to None.
+    """
+    model.eval()
+
+    if example_inputs is not None:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example_inputs, check_trace=False)
+        torch.jit.save(traced, path)
+    else:
+        torch.save(model, path)
+    logger.info(f"Saved quantized model to {path}")
+
+
+def load_quantized(path: str) -> nn.Module:
+    """Load a model saved with save_quantized
+
+    Args:
+        path (str): Saved artifact
+
+    Returns:
+        nn.Module: The quantized model, in eval mode
+    """
+    try:
+        model = torch.jit.load(path, map_location="cpu")
+    except RuntimeError:
+        # Pickled module, not a TorchScript archive
+        model = torch.load(path, map_location="cpu", **_LOAD_KWARGS)
+
+    return model.eval()
+
+
+def quantize_and_report(
+    model: nn.Module,
+    dataloader: Iterable[Any],
+    forward_fn: ForwardFn = _default_forward,
+    layers: Optional[Set[Type[nn.Module]]] = None,
+    path: Optional[str] = None,
+    example_inputs: Optional[Tuple[Any, ...]] = None,
+    max_accuracy_drop: Optional[float] = None,
+) -> Tuple[nn.Module, Dict[str, float]]:
+    """Quantize a model, check accuracy parity, measure CPU latency and size, and optionally save it
+
+    Args:
+        model (nn.Module): Model to quantize
+        dataloader (Iterable[Any]): Held-out batches, used for the parity check and the latency measurement
+        forward_fn (ForwardFn): forward_fn(model, batch) returns (predictions, targets). Defaults to
+            model(inputs, *extra) for (inputs, targets, *extra) batches.
+        layers (Optional[Set[Type[nn.Module]]]): Layer types to quantize. Defaults to None (nn.Linear, nn.LSTM, nn.GRU).
+        path (Optional[str]): Save the quantized model here. Defaults to None.
+        example_inputs (Optional[Tuple[Any, ...]]): Example inputs to save a traced artifact. Defaults to None.
+        max_accuracy_drop (Optional[float]): Do not save the model if the accuracy drops more than this.
+            Defaults to None.
+
+    Returns:
+        Tuple[nn.Module, Dict[str, float]]: (quantized model, report). The report contains the parity metrics,
+            latency_ms and quantized_latency_ms per batch, speedup, size_mb, quantized_size_mb and size_reduction
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    quantized = quantize_dynamic(model, layers=layers)
+    batches = list(dataloader)
+    report = check_parity(model, quantized, batches, forward_fn=forward_fn)
+
+    latency = measure_latency(model, batches, forward_fn=forward_fn)
+    quantized_latency = measure_latency(quantized, batches, forward_fn=forward_fn)
+    size, quantized_size = model_size(model), model_size(quantized)
+    report.update(
+        {
+            "latency_ms": 1000 * latency,
+            "quantized_latency_ms": 1000 * quantized_latency,
+            "speedup": latency / quantized_latency,
+            "size_mb": size / 2 ** 20,
+            "quantized_size_mb": quantized_size / 2 ** 20,
+            "size_reduction": size / quantized_size,
+        }
+    )
+
+    for k, v in report.items():
+        logger.info(f"{k}: {v:.4f}")
+
+    accuracy_drop = report["accuracy"] - report["quantized_accuracy"]
+
+    if max_accuracy_drop is not None and accuracy_drop > max_accuracy_drop:
+        logger.warning(
+            f"Accuracy dropped by {accuracy_drop:.4f} > {max_accuracy_drop}. Not saving the quantized model"
+        )
+    elif path is not None:
+        save_quantized(quantized, path, example_inputs=example_inputs)
+
+    return quantized, report
@@ -1,6 +1,6 @@
 from slp.modules.attention import Attention, MultiheadAttention, attention_scores
 from slp.modules.classifier import Classifier
-from slp.modules.embed import Embed, PositionalEncoding
+from slp.modules.embed import Embed, PositionalEncoding, RotaryEmbedding
 from slp.modules.feedforward import TwoLayer, PositionwiseFF
 from slp.modules.norm import LayerNorm
 from slp.modules.regularization import GaussianNoise
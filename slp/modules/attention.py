@@ -1,11 +1,28 @@
 import math
-from typing import Optional, Tuple
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from slp.modules.embed import RotaryEmbedding
 from slp.modules.norm import LayerNorm
-from slp.util.pytorch import moore_penrose_pinv
+from slp.util.pytorch import (
+    cached_subsequent_mask,
+    autocast_disabled,
+    checkpoint,
+    is_compiling,
+    is_low_precision,
+    is_recomputing,
+    moore_penrose_pinv,
+    pad_unpadded_sequences,
+    safe_softmax,
+    subsequent_mask,
+    unpad_sequences,
+)
+
+_HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+# torch.qr is deprecated in favor of torch.linalg.qr (pytorch >= 1.8)
+_qr = getattr(getattr(torch, "linalg", None), "qr", torch.qr)
 
 
 def reset_parameters(named_parameters):
@@ -55,11 +72,235 @@ def merge_heads(x: torch.Tensor) -> torch.Tensor:
     return x.view(batch_size, max_length, -1)
 
 
+def _reset_fused_projection(weight: torch.Tensor, num_chunks: int) -> None:
+    """Initialize each chunk of a fused projection weight as a separate linear layer
+
+    xavier_normal_ on the fused [num_chunks * A, D] weight would use a smaller std than
+    the separate [A, D] k, q, v projections
+    """
+
+    with torch.no_grad():
+        for chunk in weight.chunk(num_chunks, dim=0):
+            nn.init.xavier_normal_(chunk)
+
+
+def _linear_weight(layer: nn.Module) -> torch.Tensor:
+    """Weight of a linear layer, for use with F.linear
+
+    Dynamically quantized linear layers (slp.deploy.quantization) keep a packed int8 weight,
+    which is dequantized
+    """
+    weight = layer.weight
+
+    if not isinstance(weight, torch.Tensor):
+        weight = weight().dequantize()
+
+    return weight  # type: ignore
+
+
+def _fuse_projections_hook(names: Tuple[str, ...], fused: str) -> Callable[..., None]:
+    """State dict pre-hook that loads checkpoints with separate projections in a fused layer
+
+    Concatenates prefix.{name}.weight for name in names into prefix.{fused}.weight
+    """
+
+    def hook(state_dict, prefix, *args):
+        keys = [f"{prefix}{name}.weight" for name in names]
+
+        if all(key in state_dict for key in keys):
+            state_dict[f"{prefix}{fused}.weight"] = torch.cat(
+                [state_dict.pop(key) for key in keys], dim=0
+            )
+
+    return hook
+
+
+class AttentionMask(object):
+    def __init__(
+        self,
+        mask: Optional[torch.Tensor] = None,
+        causal: bool = False,
+        seq_length: Optional[int] = None,
+    ):
+        """Boolean attention mask, built once per forward pass and shared by all attention layers
+
+        All attention modules accept an AttentionMask in place of a zero-one mask tensor.
+        The mask shape is normalized once, and the float and additive forms that the attention
+        kernels use are created on first use and cached, instead of once per layer and head.
+        Causal masks reuse a subsequent mask cached by (length, device).
+
+        Args:
+            mask (Optional[torch.Tensor]): Optional [B, L] pad mask or [B, M, L] (or [B, 1, M, L]) mask,
+                zero-one or boolean. Defaults to None.
+            causal (bool): Combine the mask with a subsequent mask. Defaults to False.
+            seq_length (Optional[int]): Sequence length of the subsequent mask, if mask is None. Defaults to None.
+
+        Raises:
+            ValueError: If mask has a head dimension larger than 1
+        """
+
+        if mask is not None:
+            if mask.ndim == 4:
+                if mask.size(1) > 1:
+                    raise ValueError("AttentionMask does not support per head masks")
+                mask = mask.squeeze(1)
+
+            if mask.ndim == 2:
+                mask = mask.unsqueeze(1)
+            mask = mask.bool()
+
+        if causal:
+            seq_length = seq_length if seq_length is not None else mask.size(-1)  # type: ignore
+            future = cached_subsequent_mask(
+                seq_length, mask.device if mask is not None else None
+            )
+            mask = future if mask is None else mask & future
+
+        self.mask = mask  # (B, 1 | M, L)
+        self._cache: Dict[Any, Any] = {}
+
+    def _cached(self, key: Any, fn: Callable[[], Any]) -> Any:
+        if key not in self._cache:
+            self._cache[key] = fn()
+
+        return self._cache[key]
+
+    @staticmethod
+    def _view(mask: Optional[torch.Tensor], num_dims: int) -> Optional[torch.Tensor]:
+        if mask is None or num_dims == 3:
+            return mask
+
+        return mask.unsqueeze(1)
+
+    def as_bool(self, num_dims: int = 3) -> Optional[torch.Tensor]:
+        """Boolean mask
+
+        Args:
+            num_dims (int): 3 for single head [B, 1|M, L] or 4 for multi-head [B, 1, 1|M, L] attention. Defaults to 3.
+
+        Returns:
+            Optional[torch.Tensor]: The mask. True in positions that are preserved
+        """
+
+        return self._view(self.mask, num_dims)
+
+    def as_float(self, dtype: torch.dtype, num_dims: int = 3) -> Optional[torch.Tensor]:
+        """Zero-one mask, as used by the approximate attention kernels
+
+        Args:
+            dtype (torch.dtype): Mask dtype
+            num_dims (int): 3 for single head or 4 for multi-head attention. Defaults to 3.
+
+        Returns:
+            Optional[torch.Tensor]: The mask with ones in positions that are preserved
+        """
+        mask = self._cached(
+            ("float", dtype),
+            lambda: self.mask.to(dtype) if self.mask is not None else None,
+        )
+
+        return self._view(mask, num_dims)
+
+    def as_additive(
+        self, dtype: torch.dtype, num_dims: int = 3
+    ) -> Optional[torch.Tensor]:
+        """Additive mask, as used by attention and F.scaled_dot_product_attention
+
+        Args:
+            dtype (torch.dtype): Mask dtype
+            num_dims (int): 3 for single head or 4 for multi-head attention. Defaults to 3.
+
+        Returns:
+            Optional[torch.Tensor]: The mask with zeros in positions that are preserved
+                and large negative values in masked positions
+        """
+        mask = self._cached(
+            ("additive", dtype),
+            lambda: additive_mask(self.mask, dtype) if self.mask is not None else None,
+        )
+
+        return self._view(mask, num_dims)
+
+    def unpad_indices(self) -> torch.Tensor:
+        """Indices of the valid positions in the flattened [B * L] batch. Cached
+
+        Used for variable length execution, where position-wise layers run on the [T, D] valid
+        tokens of the batch only
+
+        Raises:
+            ValueError: If the mask is not a [B, L] pad mask
+
+        Returns:
+            torch.Tensor: [T] indices, ordered by sequence and position
+        """
+
+        if self.mask is None or self.mask.size(1) != 1:
+            raise ValueError("Unpadded execution requires a [B, L] pad mask")
+
+        return self._cached(
+            "unpad_indices", lambda: self.mask.flatten().nonzero().squeeze(-1)  # type: ignore
+        )
+
+    def select(self, indices: torch.Tensor) -> "AttentionMask":
+        """Mask of a subset of the batch, e.g. the examples that remain after an early exit
+
+        Args:
+            indices (torch.Tensor): Indices of the batch elements to keep
+
+        Returns:
+            AttentionMask: Mask of the selected batch elements
+        """
+
+        if self.mask is None or self.mask.size(0) == 1:
+            return self
+
+        return AttentionMask(self.mask.index_select(0, indices))
+
+    def with_causal(self) -> "AttentionMask":
+        """The mask combined with a subsequent mask. Cached, so it is built once for all causal layers
+
+        Returns:
+            AttentionMask: Causal attention mask
+        """
+
+        return self._cached(
+            "causal",
+            lambda: AttentionMask(self.mask, causal=True)
+            if self.mask is not None
+            else None,
+        )
+
+
+def _mask_tensor(
+    attention_mask: Optional[Union[torch.Tensor, AttentionMask]], dtype: torch.dtype
+) -> Optional[torch.Tensor]:
+    """Zero-one [B, 1, 1|M, L] mask tensor for the multi-head attention kernels"""
+
+    if isinstance(attention_mask, AttentionMask):
+        return attention_mask.as_float(dtype, num_dims=4)
+
+    return attention_mask
+
+
+def _multihead_mask(
+    attention_mask: Optional[Union[torch.Tensor, AttentionMask]]
+) -> Optional[Union[torch.Tensor, AttentionMask]]:
+    """Normalize [B, L] and [B, M, L] mask tensors to [B, 1, 1|M, L]. AttentionMask is already normalized"""
+
+    if attention_mask is None or isinstance(attention_mask, AttentionMask):
+        return attention_mask
+
+    if attention_mask.ndim == 2:
+        attention_mask = attention_mask.unsqueeze(1)
+
+    return attention_mask.unsqueeze(1)
+
+
 def attention_scores(
     k: torch.Tensor,
     q: torch.Tensor,
     dk: int,
-    attention_mask: Optional[torch.Tensor] = None,
+    attention_mask: Optional[Union[torch.Tensor, AttentionMask]] = None,
     dropout: float = 0.2,
     training: bool = True,
 ) -> torch.Tensor:
@@ -77,216 +318,996 @@ def attention_scores(
         k (torch.Tensor): Single head [B, L, A] or multi-head [B, H, L, A/H] Keys tensor
         q (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Keys tensor
         dk (int): Model dimension
-        attention_mask (Optional[torch.Tensor]): Optional [B, [H], 1, L] pad mask or [B, [H], M, L] pad mask + subsequent mask
+        attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, [H], 1, L] pad mask or [B, [H], M, L]
+            pad mask + subsequent mask tensor with zeros in sequence indices that should be masked and ones in sequence
+            indices that should be preserved, or an AttentionMask. Defaults to None.
+        dropout (float): Drop probability. Defaults to 0.2.
+        training (bool): Is module in training phase? Defaults to True.
+
+    Returns:
+        torch.Tensor: [B, M, L] or [B, H, M, L] attention scores
+    """
+    scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(dk)
+
+    if attention_mask is not None:
+        scores = scores + additive_mask(
+            attention_mask, scores.dtype, num_dims=scores.ndim
+        )
+    scores = safe_softmax(scores, dim=-1)
+    scores = F.dropout(scores, p=dropout, training=training)
+
+    return scores
+
+
+def mask_value(dtype: torch.dtype) -> float:
+    """Large negative value used for masked positions in additive masks
+
+    -1e5 overflows to -inf in float16, which turns fully masked rows (e.g. padding queries) into NaN.
+    Low precision dtypes get half of their smallest representable value instead
+
+    Args:
+        dtype (torch.dtype): Mask dtype
+
+    Returns:
+        float: -1e5, or half the smallest value of dtype if it is larger
+    """
+
+    if not is_low_precision(dtype):
+        return -1e5
+
+    return max(-1e5, torch.finfo(dtype).min / 2)
+
+
+def additive_mask(
+    attention_mask: Union[torch.Tensor, AttentionMask],
+    dtype: torch.dtype,
+    num_dims: int = 3,
+) -> torch.Tensor:
+    """Convert a zero-one attention mask to an additive mask
+
+    Masked positions get a large negative value, preserved positions get zero.
+    This is the mask form used by attention_scores and expected by F.scaled_dot_product_attention
+
+    Args:
+        attention_mask (Union[torch.Tensor, AttentionMask]): Mask with zeros in sequence indices that should be masked
+            and ones in sequence indices that should be preserved. For an AttentionMask the cached additive mask is returned
+        dtype (torch.dtype): Output dtype. Should match the dtype of the attention inputs
+        num_dims (int): Number of dimensions of the attention scores. Only used for AttentionMask. Defaults to 3.
+
+    Returns:
+        torch.Tensor: Additive mask with the same shape as attention_mask
+    """
+
+    if isinstance(attention_mask, AttentionMask):
+        return attention_mask.as_additive(dtype, num_dims=num_dims)  # type: ignore
+
+    return (1 - attention_mask.to(dtype)) * mask_value(dtype)
+
+
+def attention(
+    k: torch.Tensor,
+    q: torch.Tensor,
+    v: torch.Tensor,
+    dk: int,
+    attention_mask: Optional[Union[torch.Tensor, AttentionMask]] = None,
+    dropout: float = 0.2,
+    training: bool = True,
+    need_weights: bool = True,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    r"""Reweight values using scaled dot product attention
+
+    $$s = softmax(\frac{Q \cdot K^T}{\sqrt{d}}) V$$
+
+    If need_weights=False and F.scaled_dot_product_attention is available (pytorch >= 2.0), the
+    computation is dispatched to it, which selects fused CPU, flash or memory efficient kernels.
+    Otherwise the scores are computed explicitly.
+
+    * B: Batch size
+    * L: Keys Sequence length
+    * M: Queries Sequence length
+    * H: Number of heads
+    * A: Feature dimension
+
+    Args:
+        k (torch.Tensor): Single head [B, L, A] or multi-head [B, H, L, A/H] Keys tensor
+        q (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Keys tensor
+        v (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Values tensor
+        dk (int): Model dimension
+        attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, [H], 1, L] pad mask or [B, [H], M, L]
+            pad mask + subsequent mask tensor with zeros in sequence indices that should be masked and ones in sequence
+            indices that should be preserved, or an AttentionMask. Defaults to None.
+        dropout (float): Drop probability. Defaults to 0.2.
+        training (bool): Is module in training phase? Defaults to True.
+        need_weights (bool): Return attention scores. Defaults to True.
+
+    Returns:
+        Tuple[torch.Tensor, Optional[torch.Tensor]]: (Reweighted values [B, M, A] or [B, H, M, A/H],
+            attention scores [B, M, L] or [B, H, M, L]). Scores are None if need_weights=False
+    """
+
+    if not need_weights and _HAS_SDPA:
+        # SDPA scales by 1 / sqrt(q.size(-1)). Rescale queries to use 1 / sqrt(dk)
+        q = q * (math.sqrt(q.size(-1)) / math.sqrt(dk))
+        mask = (
+            additive_mask(attention_mask, q.dtype, num_dims=q.ndim)
+            if attention_mask is not None
+            else None
+        )
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=mask, dropout_p=dropout if training else 0.0
+        )
+
+        return out, None
+
+    scores = attention_scores(
+        k, q, dk, attention_mask=attention_mask, dropout=dropout, training=training
+    )
+    out = torch.matmul(scores, v)
+
+    if not need_weights:
+        return out, None
+
+    return out, scores
+
+
+def _online_softmax_attention(
+    k: torch.Tensor,
+    q: torch.Tensor,
+    v: torch.Tensor,
+    q_start: int,
+    attention_mask: Optional[torch.Tensor] = None,
+    chunk_size: int = 128,
+    causal: bool = False,
+    dropout: float = 0.2,
+    training: bool = True,
+) -> torch.Tensor:
+    """Attend a chunk of (already scaled) queries to all keys, one chunk of keys at a time
+
+    Keeps a running maximum and a running softmax denominator for each query, so that at most
+    [B, H, chunk_size, chunk_size] scores exist at any time
+
+    Args:
+        k (torch.Tensor): [B, [H], L, A] Keys
+        q (torch.Tensor): [B, [H], C, A] Chunk of scaled queries
+        v (torch.Tensor): [B, [H], L, A] Values
+        q_start (int): Position of the first query in the chunk
+        attention_mask (Optional[torch.Tensor]): [B, [H], 1, L] or [B, [H], M, L] zero-one mask.
+            Defaults to None.
+        chunk_size (int): Number of keys processed at once. Defaults to 128.
+        causal (bool): Mask keys in future positions. Defaults to False.
+        dropout (float): Drop probability. Defaults to 0.2.
+        training (bool): Is module in training phase? Defaults to True.
+
+    Returns:
+        torch.Tensor: [B, [H], C, A] Attention output for the query chunk
+    """
+    q_end = q_start + q.size(-2)
+    # Accumulate in (at least) float32, so that low precision runs match float32 runs
+    acc_dtype = torch.promote_types(q.dtype, torch.float32)
+    out = q.new_zeros(q.shape[:-1] + (v.size(-1),), dtype=acc_dtype)
+    running_max = q.new_full(q.shape[:-1] + (1,), -float("inf"), dtype=acc_dtype)
+    denominator = q.new_zeros(q.shape[:-1] + (1,), dtype=acc_dtype)
+
+    for k_start in range(0, k.size(-2), chunk_size):
+        if causal and k_start >= q_end:
+            # All remaining keys are in the future
+            break
+        k_end = min(k_start + chunk_size, k.size(-2))
+        scores = torch.matmul(q, k[..., k_start:k_end, :].transpose(-1, -2))
+        scores = scores.to(acc_dtype)
+
+        mask = None
+
+        if attention_mask is not None:
+            mask = attention_mask[..., k_start:k_end]
+
+            if mask.size(-2) > 1:
+                mask = mask[..., q_start:q_end, :]
+
+        if causal:
+            q_idx = torch.arange(q_start, q_end, device=q.device).unsqueeze(-1)
+            k_idx = torch.arange(k_start, k_end, device=q.device).unsqueeze(0)
+            future = (k_idx <= q_idx).to(scores.dtype)
+            mask = future if mask is None else mask * future
+
+        if mask is not None:
+            scores = scores + additive_mask(mask, scores.dtype)
+
+        chunk_max = torch.max(running_max, scores.max(dim=-1, keepdim=True)[0])
+        correction = torch.exp(running_max - chunk_max)
+        probs = torch.exp(scores - chunk_max)
+        denominator = denominator * correction + probs.sum(dim=-1, keepdim=True)
+        # Dropout on unnormalized probabilities is equivalent to dropout after normalization
+        probs = F.dropout(probs, p=dropout, training=training)
+        chunk_out = torch.matmul(probs.to(v.dtype), v[..., k_start:k_end, :])
+        out = out * correction + chunk_out.to(acc_dtype)
+        running_max = chunk_max
+
+    return (out / denominator).to(q.dtype)
+
+
+def chunked_attention(
+    k: torch.Tensor,
+    q: torch.Tensor,
+    v: torch.Tensor,
+    dk: int,
+    attention_mask: Optional[torch.Tensor] = None,
+    chunk_size: int = 128,
+    causal: bool = False,
+    dropout: float = 0.2,
+    training: bool = True,
+) -> Tuple[torch.Tensor, None]:
+    r"""Memory efficient scaled dot product attention
+
+    Computes the same output as attention, without materializing the [B, H, M, L] scores tensor.
+    Queries and keys are processed in chunks of chunk_size and the softmax is computed online
+    (https://arxiv.org/abs/2112.05682, https://arxiv.org/abs/2205.14135).
+    When gradients are needed, each query chunk is checkpointed and recomputed in the backward pass,
+    so peak memory is O(chunk_size^2) per head instead of O(M * L) in training too.
+
+    $$s = softmax(\frac{Q \cdot K^T}{\sqrt{d}}) V$$
+
+    * B: Batch size
+    * L: Keys Sequence length
+    * M: Queries Sequence length
+    * H: Number of heads
+    * A: Feature dimension
+
+    Args:
+        k (torch.Tensor): Single head [B, L, A] or multi-head [B, H, L, A/H] Keys tensor
+        q (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Keys tensor
+        v (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Values tensor
+        dk (int): Model dimension
+        attention_mask (Optional[torch.Tensor]): Optional [B, [H], 1, L] pad mask or [B, [H], M, L] pad mask + subsequent mask
+            tensor with zeros in sequence indices that should be masked and ones in sequence indices that should be
+            preserved. Defaults to None.
+        chunk_size (int): Number of queries and keys processed at once. Defaults to 128.
+        causal (bool): Apply a subsequent mask on the fly, without creating an [M, L] mask tensor.
+            Defaults to False.
+        dropout (float): Drop probability. Defaults to 0.2.
+        training (bool): Is module in training phase? Defaults to True.
+
+    Returns:
+        Tuple[torch.Tensor, None]: [B, M, A] or [B, H, M, A/H] attention output. Attention scores are not
+            computed, so None is returned in their place
+    """
+    q = q / math.sqrt(dk)
+    use_checkpoint = torch.is_grad_enabled() and any(t.requires_grad for t in (k, q, v))
+
+    outputs = []
+
+    for q_start in range(0, q.size(-2), chunk_size):
+        args = (
+            k,
+            q[..., q_start : q_start + chunk_size, :],
+            v,
+            q_start,
+            attention_mask,
+            chunk_size,
+            causal,
+            dropout,
+            training,
+        )
+
+        if use_checkpoint:
+            outputs.append(checkpoint(_online_softmax_attention, *args))
+        else:
+            outputs.append(_online_softmax_attention(*args))
+
+    return torch.cat(outputs, dim=-2), None
+
+
+def _local_windows(x: torch.Tensor, window_size: int) -> torch.Tensor:
+    """Strided [.., L / w, 3w] view over blocks of w positions and their neighbouring blocks
+
+    x is padded with w positions on each side of the sequence dimension (the last one).
+    """
+    x = F.pad(x, (window_size, window_size))
+
+    return x.unfold(-1, 3 * window_size, window_size)
+
+
+def _key_mask(
+    attention_mask: Optional[torch.Tensor], causal: bool, kernel: str
+) -> Optional[torch.Tensor]:
+    """Key pad mask for the kernels that do not support arbitrary [M, L] masks
+
+    [B, L] and [B, [H], 1, L] masks are key pad masks. [B, [H], M, L] masks are only accepted with
+    causal=True, as pad + subsequent masks, whose last row is the key pad mask
+
+    Args:
+        attention_mask (Optional[torch.Tensor]): Zero-one attention mask
+        causal (bool): The kernel applies a subsequent mask itself
+        kernel (str): Kernel name, for error messages
+
+    Raises:
+        ValueError: If a [B, [H], M, L] mask is passed without causal=True
+
+    Returns:
+        Optional[torch.Tensor]: [B, 1, L] or [B, [H], 1, L] key pad mask
+    """
+
+    if attention_mask is None:
+        return None
+
+    if attention_mask.ndim == 2:
+        attention_mask = attention_mask.unsqueeze(1)
+
+    if attention_mask.size(-2) > 1:
+        if not causal:
+            raise ValueError(
+                f"{kernel} only supports [B, L] or [B, [H], 1, L] key pad masks. "
+                f"Got a mask of shape {tuple(attention_mask.shape)}. "
+                "Use causal=True with a key pad mask for autoregressive attention"
+            )
+        attention_mask = attention_mask[..., -1:, :]
+
+    return attention_mask
+
+
+def sliding_window_attention(
+    k: torch.Tensor,
+    q: torch.Tensor,
+    v: torch.Tensor,
+    dk: int,
+    window_size: int,
+    attention_mask: Optional[torch.Tensor] = None,
+    num_global_tokens: int = 0,
+    causal: bool = False,
+    dropout: float = 0.2,
+    training: bool = True,
+) -> Tuple[torch.Tensor, None]:
+    r"""Local attention, where each position attends to the positions at distance at most window_size
+
+    The sequence is split in blocks of window_size positions. Each block of queries is scored against
+    its own and the two neighbouring blocks of keys, which are unfolded as strided views,
+    and out of window scores are masked. Time and memory are $O(L \cdot w)$ instead of $O(L^2)$.
+
+    Optionally the first num_global_tokens positions are global (e.g. a CLS token). They attend to all positions
+    and all positions attend to them.
+
+    The output is equal to attention() with the equivalent banded mask for all non pad positions.
+
+    * B: Batch size
+    * L: Sequence length
+    * H: Number of heads
+    * A: Feature dimension
+    * w: Window size
+
+    Args:
+        k (torch.Tensor): [B, H, L, A/H] Keys tensor
+        q (torch.Tensor): [B, H, L, A/H] Queries tensor
+        v (torch.Tensor): [B, H, L, A/H] Values tensor
+        dk (int): Model dimension
+        window_size (int): Maximum distance between a query and the keys it attends to
+        attention_mask (Optional[torch.Tensor]): Optional zero-one pad mask for the keys, [B, L] or [B, [H], 1, L].
+            [B, [H], L, L] pad + subsequent masks are only accepted with causal=True. Defaults to None.
+        num_global_tokens (int): Number of global tokens at the start of the sequence. Defaults to 0.
+        causal (bool): Attend only to the current and previous positions. Defaults to False.
+        dropout (float): Drop probability. Defaults to 0.2.
+        training (bool): Is module in training phase? Defaults to True.
+
+    Raises:
+        ValueError: If a [B, [H], L, L] mask is passed without causal=True
+
+    Returns:
+        Tuple[torch.Tensor, None]: [B, H, L, A/H] attention output and None, because the scores are not computed
+            as a dense [L, L] matrix
+    """
+    batch_size, _, seq_length, _ = q.size()
+    num_global_tokens = min(num_global_tokens, seq_length)
+
+    key_mask = _key_mask(attention_mask, causal, "sliding_window_attention")
+
+    if key_mask is None:
+        key_mask = q.new_ones(batch_size, 1, seq_length)
+    else:
+        key_mask = key_mask.reshape(key_mask.size(0), -1, seq_length).to(q.dtype)
+
+    # Right pad to a multiple of window_size. Padded keys are masked
+    padding = -seq_length % window_size
+
+    if padding > 0:
+        k, q, v = [F.pad(t, (0, 0, 0, padding)) for t in (k, q, v)]
+        key_mask = F.pad(key_mask, (0, padding))
+    padded_length = seq_length + padding
+    num_blocks = padded_length // window_size
+
+    # (B, H, L / w, w, A/H) x (B, H, L / w, A/H, 3w) => (B, H, L / w, w, 3w)
+    q_blocks = q.reshape(q.shape[:2] + (num_blocks, window_size, q.size(-1)))
+    k_windows = _local_windows(k.transpose(-1, -2), window_size).transpose(-2, -3)
+    scores = torch.matmul(q_blocks, k_windows) / math.sqrt(dk)
+
+    # Keep keys in the band, that are not padding and not global (they are scored separately)
+    positions = torch.arange(padded_length, device=q.device)
+    query_positions = positions.reshape(num_blocks, window_size, 1)
+    key_positions = _local_windows(positions, window_size).unsqueeze(-2)
+    distance = key_positions - query_positions
+    band = (distance >= -window_size) & (distance <= (0 if causal else window_size))
+    band = band & (key_positions >= num_global_tokens)
+    local_mask = _local_windows(key_mask, window_size).unsqueeze(-2) * band.to(q.dtype)
+    scores = scores + additive_mask(local_mask, scores.dtype)
+
+    if num_global_tokens > 0:
+        # All queries attend to the global tokens
+        global_scores = torch.matmul(
+            q_blocks, k[..., :num_global_tokens, :].transpose(-1, -2).unsqueeze(2)
+        ) / math.sqrt(dk)
+        global_mask = key_mask[..., None, None, :num_global_tokens]
+
+        if causal:
+            global_mask = global_mask * (
+                positions[:num_global_tokens] <= query_positions
+            ).to(q.dtype)
+        global_scores = global_scores + additive_mask(global_mask, scores.dtype)
+        scores = torch.cat([global_scores, scores], dim=-1)
+
+    scores = safe_softmax(scores, dim=-1)
+    scores = F.dropout(scores, p=dropout, training=training)
+
+    v_windows = _local_windows(v.transpose(-1, -2), window_size)
+    # (B, H, L / w, w, 3w) x (B, H, L / w, 3w, A/H) => (B, H, L / w, w, A/H)
+    out = torch.matmul(
+        scores[..., num_global_tokens:], v_windows.permute(0, 1, 3, 4, 2)
+    )
+
+    if num_global_tokens > 0:
+        out = out + torch.matmul(
+            scores[..., :num_global_tokens],
+            v[..., :num_global_tokens, :].unsqueeze(2),
+        )
+    out = out.reshape(q.shape)[..., :seq_length, :]
+
+    if num_global_tokens > 0:
+        # Global tokens attend to all positions
+        global_mask = key_mask[..., None, :seq_length]
+
+        if causal:
+            future = subsequent_mask(seq_length)[..., :num_global_tokens, :]
+            global_mask = global_mask * future.to(device=q.device, dtype=q.dtype)
+        global_out, _ = attention(
+            k[..., :seq_length, :],
+            q[..., :num_global_tokens, :],
+            v[..., :seq_length, :],
+            dk,
+            attention_mask=global_mask,
+            dropout=dropout,
+            training=training,
+            need_weights=False,
+        )
+        out = torch.cat([global_out, out[..., num_global_tokens:, :]], dim=-2)
+
+    return out, None
+
+
+def segment_ids(
+    key_mask: torch.Tensor, num_segments: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Assign each valid sequence position to one of num_segments contiguous segments
+
+    Each sequence is split according to its own number of valid positions, so
+    ragged batches get evenly sized segments without padding to a multiple of num_segments.
+    Masked positions are assigned to segment 0 and should be zeroed before the reduction.
+
+    Args:
+        key_mask (torch.Tensor): [B, L] zero-one mask of valid positions
+        num_segments (int): Number of segments
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: ([B, L] segment index of each position,
+            [B, num_segments] number of valid positions in each segment)
+    """
+    position = key_mask.cumsum(-1) - 1  # Position among valid elements
+    lengths = key_mask.sum(-1, keepdim=True).clamp(min=1)
+    ids = (position.clamp(min=0) * num_segments / lengths).floor().long()
+    ids = ids.clamp(max=num_segments - 1) * key_mask.long()
+    counts = key_mask.new_zeros(key_mask.size(0), num_segments)
+    counts.scatter_add_(1, ids, key_mask)
+
+    return ids, counts
+
+
+def segment_mean(
+    x: torch.Tensor, ids: torch.Tensor, counts: torch.Tensor
+) -> torch.Tensor:
+    """Masked mean of x over the segments of the sequence dimension
+
+    Args:
+        x (torch.Tensor): [B, H, L, A] Input tensor. Masked positions should be zero
+        ids (torch.Tensor): [B, L] segment index of each position
+        counts (torch.Tensor): [B, S] number of valid positions in each segment
+
+    Returns:
+        torch.Tensor: [B, H, S, A] mean of each segment
+    """
+    out = x.new_zeros(x.size(0), x.size(1), counts.size(-1), x.size(-1))
+
+    if is_compiling():
+        # The per-sequence loop would be unrolled for the traced batch size
+        out.scatter_add_(2, ids[:, None, :, None].expand_as(x), x)
+
+        return out / counts.clamp(min=1)[:, None, :, None]
+
+    for b in range(x.size(0)):
+        # index_add_ with a per-sequence index is much faster than a batched scatter_add_
+        out[b].index_add_(1, ids[b], x[b])
+
+    return out / counts.clamp(min=1)[:, None, :, None]
+
+
+def nystrom_attention(
+    k: torch.Tensor,
+    q: torch.Tensor,
+    v: torch.Tensor,
+    dk: int,
+    num_landmarks: int,
+    attention_mask: Optional[torch.Tensor] = None,
+    inverse_iterations: int = 6,
+    dropout: float = 0.2,
+    training: bool = True,
+    inverse_tolerance: Optional[float] = None,
+):
+    """Calculate attention using nystrom approximation
+
+    Implementation heavily based on: https://github.com/lucidrains/nystrom-attention
+
+    Reference: https://arxiv.org/abs/2102.03902
+
+    Inputs of any length are supported. Each sequence in the batch is split according to its own length
+    into num_landmarks segments, and landmarks are the masked segment means of the queries and keys.
+    Segment indices and the additive masks are computed once and shared between the three kernels.
+
+    * B: Batch size
+    * L: Keys Sequence length
+    * M: Queries Sequence length
+    * H: Number of heads
+    * A: Feature dimension
+
+    Args:
+        k (torch.Tensor): Single head [B, L, A] or multi-head [B, H, L, A/H] Keys tensor
+        q (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Keys tensor
+        v (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Values tensor
+        dk (int): Model dimension
+        num_landmarks (int): Number of landmark points
+        attention_mask (Optional[torch.Tensor]): Optional [B, L] or [B, [H], 1, L] pad mask
             tensor with zeros in sequence indices that should be masked and ones in sequence indices that should be
             preserved. Defaults to None.
-        dropout (float): Drop probability. Defaults to 0.2.
+        inverse_iterations (int): Number of iterations for Moore Penrose iterative inverse
+            approximation
+        dropout (float): Drop probability. Applied on the query-landmark kernel. Defaults to 0.2.
         training (bool): Is module in training phase? Defaults to True.
+        inverse_tolerance (Optional[float]): Stop the inverse iterations early when the residual of all
+            landmark kernels is below this tolerance. Defaults to None.
+
+    Raises:
+        ValueError: If attention_mask is a [B, [H], M, L] mask. Nystrom landmarks mix all positions,
+            so causal or block diagonal masks cannot be applied. Use causal_nystrom_attention for
+            autoregressive attention
 
     Returns:
-        torch.Tensor: [B, M, L] or [B, H, M, L] attention scores
+        Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]: [B, H, M, A/H] attention output and
+            the three nystrom kernels [B, H, M, num_landmarks], [B, H, num_landmarks, num_landmarks],
+            [B, H, num_landmarks, L]
     """
-    scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(dk)
+    batch_size, _, seq_length, _ = k.size()
 
-    if attention_mask is not None:
-        scores = scores + ((1 - attention_mask) * -1e5)
-    scores = F.softmax(scores, dim=-1)
-    scores = F.dropout(scores, p=dropout, training=training)
+    key_mask = _key_mask(attention_mask, False, "nystrom_attention")
 
-    return scores
+    if key_mask is None:
+        key_mask = k.new_ones(batch_size, seq_length)
+    else:
+        key_mask = (
+            key_mask.reshape(key_mask.size(0), -1, seq_length)[:, -1]
+            .expand(batch_size, seq_length)
+            .to(k.dtype)
+        )
 
+    ids, counts = segment_ids(key_mask, num_landmarks)
+    mask = key_mask[:, None, :, None]
+    q = q * (mask / math.sqrt(dk))
+    k = k * mask
 
-def attention(
+    q_landmarks = segment_mean(q, ids, counts)  # (B, H, Landmarks, A/H)
+    k_landmarks = segment_mean(k, ids, counts)  # (B, H, Landmarks, A/H)
+
+    valid_landmarks = (counts > 0).to(k.dtype)  # (B, Landmarks)
+    landmark_mask = additive_mask(valid_landmarks, k.dtype)[:, None, None, :]
+    key_mask = additive_mask(key_mask, k.dtype)[:, None, None, :]
+
+    logits_1 = torch.matmul(q, k_landmarks.transpose(-1, -2))  # (B, H, L, Landmarks)
+    logits_2 = torch.matmul(q_landmarks, k_landmarks.transpose(-1, -2))
+    logits_3 = torch.matmul(q_landmarks, k.transpose(-1, -2))  # (B, H, Landmarks, L)
+
+    scores_1 = safe_softmax(logits_1 + landmark_mask, dim=-1)
+    scores_2 = safe_softmax(logits_2 + landmark_mask, dim=-1)
+    scores_3 = safe_softmax(logits_3 + key_mask, dim=-1)
+
+    # The iterative pseudo-inverse diverges in float16 / bfloat16. Run it in (at least) float32
+    inverse_dtype = torch.promote_types(k.dtype, torch.float32)
+
+    with autocast_disabled(k.device.type):
+        # Empty landmarks get an identity row, so they are decoupled in the pseudo-inverse
+        valid_rows = valid_landmarks[:, None, :, None].to(inverse_dtype)
+        eye = torch.eye(num_landmarks, device=k.device, dtype=inverse_dtype)
+        scores_2 = scores_2.to(inverse_dtype) * valid_rows + eye * (1 - valid_rows)
+        z_star = moore_penrose_pinv(
+            scores_2, num_iter=inverse_iterations, tol=inverse_tolerance
+        ).to(scores_1.dtype)
+
+    scores_1 = F.dropout(scores_1, p=dropout, training=training)
+
+    out = torch.matmul(torch.matmul(scores_1, z_star), torch.matmul(scores_3, v))
+
+    return out, (scores_1, scores_2, scores_3)
+
+
+def causal_nystrom_attention(
     k: torch.Tensor,
     q: torch.Tensor,
     v: torch.Tensor,
     dk: int,
+    num_landmarks: int,
     attention_mask: Optional[torch.Tensor] = None,
     dropout: float = 0.2,
     training: bool = True,
-):
-    r"""Reweight values using scaled dot product attention
+) -> Tuple[torch.Tensor, None]:
+    """Causal (autoregressive) attention with segment mean landmarks
 
-    $$s = softmax(\frac{Q \cdot K^T}{\sqrt{d}}) V$$
+    The Nystrom approximation mixes all sequence positions into every landmark, which leaks future
+    tokens. This variant keeps the landmark idea but gives it a prefix structure:
+
+    * The sequence is split in num_landmarks segments. Each segment is summarized by a landmark,
+      which is the masked mean of its keys and values.
+    * A query attends exactly (with a causal mask) to the keys of its own segment, and to the landmarks
+      of the already completed segments. Landmark scores are biased by log(segment size), so a landmark
+      is weighted as the number of tokens it summarizes.
+    * Both sets of scores are normalized with a single softmax.
+
+    Cost is O(L * (num_landmarks + L / num_landmarks)) instead of O(L^2).
+    With num_landmarks >= L this is exact causal attention.
 
     * B: Batch size
-    * L: Keys Sequence length
-    * M: Queries Sequence length
+    * L: Sequence length
     * H: Number of heads
     * A: Feature dimension
 
     Args:
-        k (torch.Tensor): Single head [B, L, A] or multi-head [B, H, L, A/H] Keys tensor
-        q (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Keys tensor
-        v (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Values tensor
+        k (torch.Tensor): [B, H, L, A/H] Keys tensor
+        q (torch.Tensor): [B, H, L, A/H] Queries tensor
+        v (torch.Tensor): [B, H, L, A/H] Values tensor
         dk (int): Model dimension
-        attention_mask (Optional[torch.Tensor]): Optional [B, [H], 1, L] pad mask or [B, [H], M, L] pad mask + subsequent mask
-            tensor with zeros in sequence indices that should be masked and ones in sequence indices that should be
-            preserved. Defaults to None.
+        num_landmarks (int): Number of segments / landmarks
+        attention_mask (Optional[torch.Tensor]): Optional [B, L] or [B, [H], 1, L] zero-one pad mask for the keys.
+            A subsequent mask is applied internally. For [B, [H], L, L] pad + subsequent masks the last row is
+            used as the pad mask. Defaults to None.
         dropout (float): Drop probability. Defaults to 0.2.
         training (bool): Is module in training phase? Defaults to True.
 
     Returns:
-        torch.Tensor: [B, M, L] or [B, H, M, L] attention scores
+        Tuple[torch.Tensor, None]: [B, H, L, A/H] attention output. Attention scores are not returned
     """
+    batch_size, num_heads, seq_length, head_size = k.size()
+    segment_length = math.ceil(seq_length / num_landmarks)
+    num_segments = math.ceil(seq_length / segment_length)
+    padding = num_segments * segment_length - seq_length
+
+    key_mask = _key_mask(attention_mask, True, "causal_nystrom_attention")
+    key_mask = (
+        key_mask.reshape(key_mask.size(0), -1, seq_length)[:, -1:]
+        .expand(batch_size, 1, seq_length)
+        .to(q.dtype)
+        if key_mask is not None
+        else q.new_ones(batch_size, 1, seq_length)
+    )
 
-    scores = attention_scores(
-        k, q, dk, attention_mask=attention_mask, dropout=dropout, training=training
+    if padding > 0:
+        # Pad on the right. Padded positions are only visible to (padded) future positions
+        k, q, v = [F.pad(t, (0, 0, 0, padding)) for t in (k, q, v)]
+        key_mask = F.pad(key_mask, (0, padding))
+
+    q = q / math.sqrt(dk)
+    segments = (batch_size, num_heads, num_segments, segment_length, head_size)
+    k, q, v = k.reshape(*segments), q.reshape(*segments), v.reshape(*segments)
+    # (B, 1, S, L/S)
+    key_mask = key_mask.reshape(batch_size, 1, num_segments, segment_length)
+
+    counts = key_mask.sum(-1)  # (B, 1, S)
+    denom = counts.clamp(min=1)[..., None]
+    k_landmarks = (k * key_mask[..., None]).sum(-2) / denom  # (B, H, S, A/H)
+    v_landmarks = (v * key_mask[..., None]).sum(-2) / denom  # (B, H, S, A/H)
+
+    # (B, H, S, L/S, S): Each query against every landmark
+    landmark_scores = torch.matmul(q, k_landmarks[:, :, None].transpose(-1, -2))
+    # Only landmarks of completed past segments are visible
+    past = torch.ones(num_segments, num_segments, device=q.device).tril(-1)
+    landmark_mask = past[:, None, :] * (counts > 0).to(q.dtype)[:, :, None, None, :]
+    landmark_scores = (
+        landmark_scores
+        + torch.log(counts.clamp(min=1))[:, :, None, None, :]
+        + additive_mask(landmark_mask, q.dtype)
     )
-    out = torch.matmul(scores, v)
 
-    return out, scores
+    # (B, H, S, L/S, L/S): Exact causal attention inside each segment
+    local_scores = torch.matmul(q, k.transpose(-1, -2))
+    local_causal = torch.ones(segment_length, segment_length, device=q.device).tril()
+    local_mask = local_causal * key_mask[..., None, :]
+    local_scores = local_scores + additive_mask(local_mask, q.dtype)
+
+    scores = safe_softmax(torch.cat([landmark_scores, local_scores], dim=-1), dim=-1)
+    scores = F.dropout(scores, p=dropout, training=training)
+    out = torch.matmul(
+        scores[..., :num_segments], v_landmarks[:, :, None]
+    ) + torch.matmul(scores[..., num_segments:], v)
+    out = out.reshape(batch_size, num_heads, -1, head_size)[:, :, :seq_length]
 
+    return out, None
 
-def pad_for_nystrom(
-    x: torch.Tensor, num_landmarks: int, attention_mask: Optional[torch.Tensor] = None
-) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
-    """Pad inputs and attention_mask to perform Nystrom Attention
 
-    Pad to nearest multiple of num_landmarks
+def gaussian_orthogonal_random_matrix(
+    num_rows: int, num_columns: int, device: Optional[torch.device] = None
+) -> torch.Tensor:
+    """Random projection with orthogonal blocks of rows, as used by FAVOR+
+
+    Rows are orthogonal within each block of num_columns rows and their norms follow the
+    chi distribution of gaussian vector norms
 
     Args:
-        x (torch.Tensor): [B, L, A] Input tensor
-        num_landmarks (int): Number of landmark points
-        attention_mask (Optional[torch.Tensor]): [B, L] Padding mask
+        num_rows (int): Number of random features
+        num_columns (int): Feature dimension
+        device (Optional[torch.device]): Device of the output. Defaults to None.
 
     Returns:
-        Tuple[torch.Tensor, Optional[torch.Tensor]]: Padded inputs and attention_mask
+        torch.Tensor: [num_rows, num_columns] projection matrix
     """
-    if attention_mask is not None:
-        attention_mask = attention_mask.squeeze()
+    blocks = []
 
-    _, seq_length, _ = x.size()
+    for _ in range(math.ceil(num_rows / num_columns)):
+        block, _ = _qr(torch.randn(num_columns, num_columns, device=device))
+        blocks.append(block.t())
+    projection = torch.cat(blocks, dim=0)[:num_rows]
+    norms = torch.randn(num_rows, num_columns, device=device).norm(dim=1)
 
-    _, remainder = (
-        math.ceil(seq_length / num_landmarks),
-        seq_length % num_landmarks,
-    )
+    return norms.unsqueeze(-1) * projection
 
-    if remainder > 0:
-        padding = num_landmarks - remainder
-        x = F.pad(x, (0, 0, padding, 0), value=0)
 
-        if attention_mask is not None:
-            attention_mask = F.pad(attention_mask, (padding, 0))
+def softmax_kernel_features(
+    x: torch.Tensor, projection: torch.Tensor, is_query: bool, eps: float = 1e-4
+) -> torch.Tensor:
+    r"""Positive random features, whose dot products approximate the softmax kernel
 
-    return x, attention_mask
+    $$\phi(x) = \frac{1}{\sqrt{m}} exp(W x - \frac{||x||^2}{2})$$
 
+    so that $E[\phi(q)^T \phi(k)] = exp(q^T k)$.
 
-def nystrom_attention(
+    A maximum is subtracted inside the exponential for numerical stability. It is taken per row for
+    queries and per head for keys, so it cancels out in the attention normalization.
+
+    Args:
+        x (torch.Tensor): [B, H, L, A/H] Scaled queries or keys
+        projection (torch.Tensor): [m, A/H] Random projection
+        is_query (bool): x are queries
+        eps (float): Small constant for numerical stability. Defaults to 1e-4.
+
+    Returns:
+        torch.Tensor: [B, H, L, m] random features
+    """
+    logits = torch.matmul(x, projection.t().to(x.dtype))
+    logits = logits - (x ** 2).sum(dim=-1, keepdim=True) / 2
+
+    if is_query:
+        stabilizer = logits.max(dim=-1, keepdim=True)[0]
+    else:
+        stabilizer = logits.amax(dim=(-1, -2), keepdim=True)
+
+    features = torch.exp(logits - stabilizer.detach()) + eps
+
+    return features / math.sqrt(projection.size(0))
+
+
+def performer_attention(
     k: torch.Tensor,
     q: torch.Tensor,
     v: torch.Tensor,
     dk: int,
-    num_landmarks: int,
+    projection: torch.Tensor,
     attention_mask: Optional[torch.Tensor] = None,
-    inverse_iterations: int = 6,
-    dropout: float = 0.2,
-    training: bool = True,
-):
-    """Calculate attention using nystrom approximation
+    causal: bool = False,
+    chunk_size: int = 128,
+) -> Tuple[torch.Tensor, None]:
+    r"""Linear time and memory kernelized attention (Performer / FAVOR+)
 
-    Implementation heavily based on: https://github.com/lucidrains/nystrom-attention
+    Reference: https://arxiv.org/abs/2009.14794
+
+    The softmax kernel is approximated with positive random features,
+
+    $$softmax(\frac{Q K^T}{\sqrt{d}}) V \approx \frac{\phi(Q) (\phi(K)^T V)}{\phi(Q) (\phi(K)^T 1)}$$
+
+    and the [L, L] attention matrix is never materialized.
+
+    For causal attention the sums over keys become prefix sums. They are computed block by block, with
+    exact masked products inside each block of chunk_size positions and a running [m, A/H] state
+    for the previous blocks.
+
+    Attention dropout is not applied, because there are no attention scores.
 
-    Reference: https://arxiv.org/abs/2102.03902
     * B: Batch size
-    * L: Keys Sequence length
-    * M: Queries Sequence length
+    * L: Keys sequence length
+    * M: Queries sequence length
     * H: Number of heads
     * A: Feature dimension
+    * m: Number of random features
 
     Args:
-        k (torch.Tensor): Single head [B, L, A] or multi-head [B, H, L, A/H] Keys tensor
-        q (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Keys tensor
-        v (torch.Tensor): Single head [B, M, A] or multi-head [B, H, M, A/H] Values tensor
+        k (torch.Tensor): [B, H, L, A/H] Keys tensor
+        q (torch.Tensor): [B, H, M, A/H] Queries tensor
+        v (torch.Tensor): [B, H, L, A/H] Values tensor
         dk (int): Model dimension
-        num_landmarks (int): Number of landmark points
-        attention_mask (Optional[torch.Tensor]): Optional [B, [H], 1, L] pad mask or [B, [H], M, L] pad mask + subsequent mask
-            tensor with zeros in sequence indices that should be masked and ones in sequence indices that should be
-            preserved. Defaults to None.
-        inverse_iterations (int): Number of iterations for Moore Penrose iterative inverse
-            approximation
-        dropout (float): Drop probability. Defaults to 0.2.
-        training (bool): Is module in training phase? Defaults to True.
+        projection (torch.Tensor): [m, A/H] Random projection. See gaussian_orthogonal_random_matrix
+        attention_mask (Optional[torch.Tensor]): Optional zero-one pad mask for the keys, [B, L] or [B, [H], 1, L].
+            [B, [H], M, L] pad + subsequent masks are only accepted with causal=True. Defaults to None.
+        causal (bool): Use causal prefix sums. Requires M == L. Defaults to False.
+        chunk_size (int): Block size for the causal prefix sums. Defaults to 128.
+
+    Raises:
+        ValueError: If a [B, [H], M, L] mask is passed without causal=True. Other mask structures than
+            key padding cannot be expressed with kernelized attention
 
     Returns:
-        torch.Tensor: [B, M, L] or [B, H, M, L] attention scores
+        Tuple[torch.Tensor, None]: [B, H, M, A/H] attention output and None, because attention scores are not computed
     """
-    _, num_heads, seq_length, head_size = k.size()
+    data_normalizer = dk ** -0.25
+    # The key stabilizer is shared by all positions. Without eps it cancels out exactly,
+    # so that future keys cannot affect causal outputs
+    eps = 0.0 if causal else 1e-4
+    q_features = softmax_kernel_features(q * data_normalizer, projection, True, eps)
+    k_features = softmax_kernel_features(k * data_normalizer, projection, False, eps)
+
+    key_mask = _key_mask(attention_mask, causal, "performer_attention")
+
+    if key_mask is not None:
+        key_mask = key_mask.reshape(key_mask.size(0), -1, key_mask.size(-1), 1)
+        k_features = k_features * key_mask.to(k_features.dtype)
+
+    if not causal:
+        kv = torch.matmul(k_features.transpose(-1, -2), v)  # (B, H, m, A/H)
+        normalizer = torch.matmul(q_features, k_features.sum(dim=-2).unsqueeze(-1))
+
+        return torch.matmul(q_features, kv) / normalizer, None
+
+    batch_shape = q_features.shape[:-2]
+    num_features = q_features.size(-1)
+    state = q_features.new_zeros(batch_shape + (num_features, v.size(-1)))
+    state_norm = q_features.new_zeros(batch_shape + (num_features, 1))
+    tril = torch.ones(
+        chunk_size, chunk_size, device=q.device, dtype=q_features.dtype
+    ).tril()
+    outputs = []
+
+    for start in range(0, q.size(-2), chunk_size):
+        q_chunk = q_features[..., start : start + chunk_size, :]
+        k_chunk = k_features[..., start : start + chunk_size, :]
+        v_chunk = v[..., start : start + chunk_size, :]
+        length = q_chunk.size(-2)
+        local = (
+            torch.matmul(q_chunk, k_chunk.transpose(-1, -2)) * tril[:length, :length]
+        )
+        numerator = torch.matmul(local, v_chunk) + torch.matmul(q_chunk, state)
+        normalizer = local.sum(dim=-1, keepdim=True) + torch.matmul(q_chunk, state_norm)
+        outputs.append(numerator / normalizer.clamp(min=1e-20))
+        state = state + torch.matmul(k_chunk.transpose(-1, -2), v_chunk)
+        state_norm = state_norm + k_chunk.sum(dim=-2).unsqueeze(-1)
 
-    masked_mean_denom = seq_length // num_landmarks
-    if attention_mask is not None:
-        attention_mask = attention_mask.unsqueeze(1)
-        masked_mean_denom = (
-            attention_mask.reshape(-1, 1, num_landmarks, seq_length // num_landmarks).sum(-1) + 1e-8  # type: ignore
-        )  # (B, 1, Landmarks)
-        mask_landmarks = (masked_mean_denom > 0).type(torch.float)  # type: ignore
-        masked_mean_denom = masked_mean_denom[..., None]  # type: ignore
-        attention_mask = attention_mask.unsqueeze(-1)
-        q = q * attention_mask  # (B, H, L, A/H)
-        k = k * attention_mask  # (B, H, L, A/H)
-        v = v * attention_mask  # (B, H, L, A/H)
-
-        scores_1_mask = attention_mask * mask_landmarks[..., None, :]
-        scores_2_mask = mask_landmarks[..., None] * mask_landmarks[..., None, :]
-        scores_3_mask = scores_1_mask.transpose(-1, -2)
+    return torch.cat(outputs, dim=-2), None
 
-    q = q / math.sqrt(dk)
 
-    q_landmarks = q.reshape(
-        q.size(0),  # batch_size
-        q.size(1),  # num_heads
-        num_landmarks,  # landmarks
-        seq_length // num_landmarks,  # reduced length
-        q.size(-1),  # head_size
-    ).sum(
-        dim=-2
-    )  # (B, H, Landmarks, A/H)
-
-    k_landmarks = k.reshape(
-        k.size(0),  # batch_size
-        k.size(1),  # num_heads
-        num_landmarks,  # landmarks
-        seq_length // num_landmarks,  # reduced length
-        k.size(-1),  # head size
-    ).sum(
-        dim=-2
-    )  # (B, H, Landmarks, A/H)
-
-    k_landmarks = k_landmarks / masked_mean_denom
-    q_landmarks = q_landmarks / masked_mean_denom
-
-    scores_1 = attention_scores(
-        k_landmarks,
-        q,
-        1,  # We have already accounted for dk
-        attention_mask=scores_1_mask,
-        dropout=dropout,
-        training=training,
-    )
+class PerformerKernel(nn.Module):
+    def __init__(
+        self,
+        head_size: int,
+        num_random_features: int = 256,
+        feature_redraw_interval: int = 0,
+    ):
+        """Random projection state for performer_attention
 
-    scores_2 = attention_scores(
-        k_landmarks,
-        q_landmarks,
-        1,  # We have already accounted for dk
-        attention_mask=scores_2_mask,
-        dropout=dropout,
-        training=training,
-    )
+        The projection is a buffer, so it is saved with the model and inference is deterministic.
 
-    scores_3 = attention_scores(
-        k,
-        q_landmarks,
-        1,  # We have already accounted for dk
-        attention_mask=scores_3_mask,
-        dropout=dropout,
-        training=training,
-    )
+        Args:
+            head_size (int): Features per attention head
+            num_random_features (int): Number of random features. Defaults to 256.
+            feature_redraw_interval (int): Draw a new projection every feature_redraw_interval
+                forward passes in training mode. 0 keeps the projection fixed. Defaults to 0.
+        """
+        super(PerformerKernel, self).__init__()
+        self.head_size = head_size
+        self.num_random_features = num_random_features
+        self.feature_redraw_interval = feature_redraw_interval
+        self.calls_since_redraw = 0
+        self.register_buffer(
+            "projection",
+            gaussian_orthogonal_random_matrix(num_random_features, head_size),
+        )
 
-    z_star = moore_penrose_pinv(scores_2, num_iter=inverse_iterations)
-    out = (scores_1 @ z_star) @ (scores_3 @ v)
+    @torch.no_grad()
+    def redraw_features(self) -> None:
+        """Draw a new random projection"""
+        projection = gaussian_orthogonal_random_matrix(
+            self.num_random_features, self.head_size, device=self.projection.device
+        )
+        self.projection.copy_(projection)
+        self.calls_since_redraw = 0
 
-    return out, (scores_1, scores_2, scores_3)
+    def forward(
+        self,
+        k: torch.Tensor,
+        q: torch.Tensor,
+        v: torch.Tensor,
+        dk: int,
+        attention_mask: Optional[torch.Tensor] = None,
+        causal: bool = False,
+    ) -> Tuple[torch.Tensor, None]:
+        """Run performer_attention. Redraw the projection first, if it is due
+
+        Args:
+            k (torch.Tensor): [B, H, L, A/H] Keys tensor
+            q (torch.Tensor): [B, H, M, A/H] Queries tensor
+            v (torch.Tensor): [B, H, L, A/H] Values tensor
+            dk (int): Model dimension
+            attention_mask (Optional[torch.Tensor]): Optional key pad mask. Defaults to None.
+            causal (bool): Use causal prefix sums. Defaults to False.
+
+        Returns:
+            Tuple[torch.Tensor, None]: [B, H, M, A/H] attention output and None
+        """
+
+        # Checkpointed layers are recomputed with the same projection
+        if self.training and self.feature_redraw_interval > 0 and not is_recomputing():
+            if self.calls_since_redraw >= self.feature_redraw_interval:
+                self.redraw_features()
+            self.calls_since_redraw += 1
+
+        return performer_attention(
+            k,
+            q,
+            v,
+            dk,
+            self.projection,
+            attention_mask=attention_mask,
+            causal=causal,
+        )
+
+
+def _with_subsequent_mask(
+    attention_mask: Optional[Union[torch.Tensor, AttentionMask]],
+    seq_length: int,
+    device: torch.device,
+) -> Union[torch.Tensor, AttentionMask]:
+    """Combine a [B, 1, 1|M, L] attention mask with a subsequent mask
+
+    For an AttentionMask the combined mask is built once and shared by all causal layers
+    """
+
+    if isinstance(attention_mask, AttentionMask) and attention_mask.mask is not None:
+        return attention_mask.with_causal()
+
+    attention_mask = _mask_tensor(attention_mask, torch.float)
+    causal = cached_subsequent_mask(seq_length, device).unsqueeze(1)  # (1, 1, L, L)
+
+    if attention_mask is None:
+        return causal
+
+    return attention_mask * causal
+
+
+def _key_padding_mask(attention_mask: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    """Extract the [B, 1, 1, L] key pad mask from a [B, 1, M, L] mask
+
+    The last row of a pad + subsequent mask equals the pad mask
+    """
+
+    if attention_mask is None:
+        return None
+
+    return attention_mask[..., -1:, :]
 
 
 class SelfAttention(nn.Module):
@@ -316,8 +1337,9 @@ class SelfAttention(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        attention_mask: Optional[torch.Tensor] = None,
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        attention_mask: Optional[Union[torch.Tensor, AttentionMask]] = None,
+        need_weights: bool = True,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         r"""Single-head scaled dot-product attention forward pass
 
         Outputs the values, where features for each sequence element are weighted by their respective attention scores
@@ -332,12 +1354,15 @@ class SelfAttention(nn.Module):
 
         Args:
             x (torch.Tensor): [B, L, D] Input tensor
-            attention_mask (Optional[torch.Tensor]): Optional [B, L] or [B, M, L] zero-one mask for sequence elements. Defaults to None.
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, L] or [B, M, L] zero-one mask
+                for sequence elements, or an AttentionMask. Defaults to None.
+            need_weights (bool): Return attention scores. If False, the scores are never materialized
+                when fused kernels are available and None is returned instead. Defaults to True.
 
         Returns:
-            Tuple[torch.Tensor, torch.Tensor]: (Reweighted values [B, L, D], attention scores [B, M, L])
+            Tuple[torch.Tensor, Optional[torch.Tensor]]: (Reweighted values [B, L, D], attention scores [B, M, L])
         """
-        if attention_mask is not None:
+        if attention_mask is not None and not isinstance(attention_mask, AttentionMask):
             if len(list(attention_mask.size())) == 2:
                 attention_mask = attention_mask.unsqueeze(1)
 
@@ -352,6 +1377,7 @@ class SelfAttention(nn.Module):
             attention_mask=attention_mask,
             dropout=self.dropout,
             training=self.training,
+            need_weights=need_weights,
         )
 
         return out, scores
@@ -377,18 +1403,24 @@ class Attention(nn.Module):
         if input_size is None:
             input_size = attention_size
         self.dk = input_size
-        self.k = nn.Linear(input_size, attention_size, bias=False)
-        self.q = nn.Linear(input_size, attention_size, bias=False)
-        self.v = nn.Linear(input_size, attention_size, bias=False)
+        self.attention_size = attention_size
+        # Fused [q; k; v] projection. Keys and values are contiguous for cross-attention
+        self.qkv = nn.Linear(input_size, 3 * attention_size, bias=False)
         self.dropout = dropout
         reset_parameters(self.named_parameters())
+        _reset_fused_projection(self.qkv.weight, 3)
+        # Checkpoints with separate k, q, v layers
+        self._register_load_state_dict_pre_hook(
+            _fuse_projections_hook(("q", "k", "v"), "qkv")
+        )
 
     def forward(
         self,
         keys: torch.Tensor,
         queries: Optional[torch.Tensor] = None,
-        attention_mask: Optional[torch.Tensor] = None,
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        attention_mask: Optional[Union[torch.Tensor, AttentionMask]] = None,
+        need_weights: bool = True,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         r"""Single-head scaled dot-product attention forward pass
 
         Outputs the values, where features for each sequence element are weighted by their respective attention scores
@@ -404,23 +1436,27 @@ class Attention(nn.Module):
         Args:
             keys (torch.Tensor): [B, L, D] Keys tensor
             queries (Optional[torch.Tensor]): Optional [B, M, D] Queries tensor. If None queries = keys. Defaults to None.
-            attention_mask (Optional[torch.Tensor]): Optional [B, L] or [B, M, L] zero-one mask for sequence elements. Defaults to None.
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, L] or [B, M, L] zero-one mask
+                for sequence elements, or an AttentionMask. Defaults to None.
+            need_weights (bool): Return attention scores. If False, the scores are never materialized
+                when fused kernels are available and None is returned instead. Defaults to True.
 
         Returns:
-            Tuple[torch.Tensor, torch.Tensor]: (Reweighted values [B, L, D], attention scores [B, M, L])
+            Tuple[torch.Tensor, Optional[torch.Tensor]]: (Reweighted values [B, L, D], attention scores [B, M, L])
         """
-        if attention_mask is not None:
+        if attention_mask is not None and not isinstance(attention_mask, AttentionMask):
             if len(list(attention_mask.size())) == 2:
                 attention_mask = attention_mask.unsqueeze(1)
 
         if queries is None:
-            queries = keys
-
-        values = keys
-
-        k = self.k(keys)  # (B, L, A)
-        q = self.q(queries)
-        v = self.v(values)
+            # Self-attention. Single GEMM
+            q, k, v = self.qkv(keys).chunk(3, dim=-1)  # (B, L, A)
+        else:
+            # Cross-attention. Fused keys / values GEMM
+            q = F.linear(queries, _linear_weight(self.qkv)[: self.attention_size])
+            k, v = F.linear(
+                keys, _linear_weight(self.qkv)[self.attention_size :]
+            ).chunk(2, dim=-1)
 
         # weights => (B, L, L)
         out, scores = attention(
@@ -431,6 +1467,7 @@ class Attention(nn.Module):
             attention_mask=attention_mask,
             dropout=self.dropout,
             training=self.training,
+            need_weights=need_weights,
         )
 
         return out, scores
@@ -447,6 +1484,13 @@ class MultiheadSelfAttention(nn.Module):
         num_landmarks: int = 64,
         inverse_iterations: int = 6,
         kernel_size: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        causal: bool = False,
+        performer: bool = False,
+        num_random_features: int = 256,
+        feature_redraw_interval: int = 0,
+        window_size: Optional[int] = None,
+        num_global_tokens: int = 0,
     ):
         """Multi-Headed Dot-product attention module
 
@@ -456,6 +1500,25 @@ class MultiheadSelfAttention(nn.Module):
             input_size (Optional[int]): Input features. Defaults to None.
                 If None input_size is set to attention_size.
             dropout (float): Drop probability. Defaults to 0.1.
+            chunk_size (Optional[int], optional): Use memory efficient chunked_attention with this chunk size.
+                Attention scores are not returned in this mode.
+                Ignored if nystrom, performer or window_size are set. Defaults to None.
+            causal (bool, optional): Apply a subsequent mask internally, for autoregressive tasks.
+                With nystrom=True, causal_nystrom_attention is used. Defaults to False.
+            performer (bool, optional): Use linear complexity performer_attention. Attention scores are not
+                returned in this mode. Defaults to False.
+            num_random_features (int, optional): Number of random features for performer attention. Defaults to 256.
+            feature_redraw_interval (int, optional): Redraw the performer random features every
+                feature_redraw_interval training steps. 0 keeps them fixed. Defaults to 0.
+            window_size (Optional[int], optional): Use sliding_window_attention, where each position attends
+                to positions at distance at most window_size. Attention scores are not returned in this mode.
+                Defaults to None.
+            num_global_tokens (int, optional): Number of global tokens at the start of the sequence
+                for sliding window attention. Defaults to 0.
+
+        Raises:
+            ValueError: If causal=True and kernel_size is not None. The residual convolution sees future tokens
+            ValueError: If more than one of nystrom, performer and window_size are set
         """
         super(MultiheadSelfAttention, self).__init__()
 
@@ -464,6 +1527,10 @@ class MultiheadSelfAttention(nn.Module):
         self.inverse_iterations = inverse_iterations
         self.num_landmarks = num_landmarks
         self.nystrom = nystrom
+        self.chunk_size = chunk_size
+        self.causal = causal
+        self.window_size = window_size
+        self.num_global_tokens = num_global_tokens
         self.num_heads = num_heads
         self.head_size = int(attention_size / num_heads)
         self.dk = self.head_size
@@ -474,6 +1541,23 @@ class MultiheadSelfAttention(nn.Module):
 
         self.conv = None
 
+        if causal and kernel_size is not None:
+            raise ValueError("Residual convolution cannot be used with causal=True")
+
+        if sum([nystrom, performer, window_size is not None]) > 1:
+            raise ValueError(
+                "Only one of nystrom, performer and window_size can be used"
+            )
+
+        self.performer = None
+
+        if performer:
+            self.performer = PerformerKernel(
+                self.head_size,
+                num_random_features=num_random_features,
+                feature_redraw_interval=feature_redraw_interval,
+            )
+
         if kernel_size is not None:
             self.conv = nn.Conv2d(
                 in_channels=self.num_heads,
@@ -486,7 +1570,7 @@ class MultiheadSelfAttention(nn.Module):
 
         reset_parameters(self.named_parameters())
 
-    def forward(self, x, attention_mask=None):
+    def forward(self, x, attention_mask=None, need_weights=True):
         r"""Multi-head scaled dot-product attention forward pass
 
         Outputs the values, where features for each sequence element are weighted by their respective attention scores
@@ -509,29 +1593,47 @@ class MultiheadSelfAttention(nn.Module):
 
         Args:
             x (torch.Tensor): [B, L, D] Keys tensor
-            attention_mask (Optional[torch.Tensor]): Optional [B, M, L] zero-one mask for sequence elements. Defaults to None.
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, M, L] zero-one mask
+                for sequence elements, or an AttentionMask. Defaults to None.
+            need_weights (bool): Return attention scores. If False, faster fused kernels can be used. Defaults to True.
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: (Reweighted values [B, L, D], attention scores [B, H, M, L])
         """
         _, seq_length, _ = x.size()
 
-        if attention_mask is not None:
-            if attention_mask.ndim == 2:
-                attention_mask = attention_mask.unsqueeze(1)
-            attention_mask = attention_mask.unsqueeze(1)
-
-        if self.nystrom:
-            x, attention_mask = pad_for_nystrom(
-                x, self.num_landmarks, attention_mask=attention_mask
-            )
+        attention_mask = _multihead_mask(attention_mask)
 
         k, q, v = self.kqv(x).chunk(3, dim=-1)
         k = split_heads(k, self.num_heads)
         q = split_heads(q, self.num_heads)
         v = split_heads(v, self.num_heads)
 
-        if self.nystrom:
+        if self.performer is not None:
+            # out = (B, H, L, A/H)
+            # scores = None
+            out, scores = self.performer(
+                k,
+                q,
+                v,
+                self.dk,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
+                causal=self.causal,
+            )
+        elif self.nystrom and self.causal:
+            # out = (B, H, L, A/H)
+            # scores = None
+            out, scores = causal_nystrom_attention(
+                k,
+                q,
+                v,
+                self.dk,
+                self.num_landmarks,
+                attention_mask=_key_padding_mask(_mask_tensor(attention_mask, k.dtype)),
+                dropout=self.dropout,
+                training=self.training,
+            )
+        elif self.nystrom:
             # out = (B, H, L, A/H)
             # scores = Tuple
             out, scores = nystrom_attention(
@@ -540,12 +1642,45 @@ class MultiheadSelfAttention(nn.Module):
                 v,
                 self.dk,
                 self.num_landmarks,
-                attention_mask=attention_mask,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
                 inverse_iterations=self.inverse_iterations,
                 dropout=self.dropout,
                 training=self.training,
             )
+        elif self.window_size is not None:
+            # out => (B, H, L, A/H)
+            # scores => None
+            out, scores = sliding_window_attention(
+                k,
+                q,
+                v,
+                self.dk,
+                self.window_size,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
+                num_global_tokens=self.num_global_tokens,
+                causal=self.causal,
+                dropout=self.dropout,
+                training=self.training,
+            )
+        elif self.chunk_size is not None:
+            # out => (B, H, L, A/H)
+            # scores => None
+            out, scores = chunked_attention(
+                k,
+                q,
+                v,
+                self.dk,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
+                chunk_size=self.chunk_size,
+                causal=self.causal,
+                dropout=self.dropout,
+                training=self.training,
+            )
         else:
+            if self.causal:
+                attention_mask = _with_subsequent_mask(
+                    attention_mask, seq_length, k.device
+                )
             # out => (B, H, L, A/H)
             # scores => (B, H, L, L)
             out, scores = attention(
@@ -556,19 +1691,20 @@ class MultiheadSelfAttention(nn.Module):
                 attention_mask=attention_mask,
                 dropout=self.dropout,
                 training=self.training,
+                need_weights=need_weights,
             )
 
         if self.conv is not None:
-            if attention_mask is None or attention_mask.ndim > 2:
+            mask = _mask_tensor(attention_mask, v.dtype)
+
+            if mask is None or mask.size(-2) > 1:
                 out = out + self.conv(v)
             else:
-                attention_mask = attention_mask.squeeze()
-                out = out + self.conv(v * attention_mask[:, None, :, None])
+                # (B, 1, 1, L) pad mask => (B, 1, L, 1)
+                out = out + self.conv(v * mask.transpose(-1, -2))
 
         # out => (B, H, L, A/H)
         out = merge_heads(out)
-        if out.size(1) != seq_length:
-            out = out[:, -seq_length:, :]
         out = self.output(out)
 
         return out, scores
@@ -585,6 +1721,14 @@ class MultiheadAttention(nn.Module):
         num_landmarks: int = 64,
         inverse_iterations: int = 6,
         kernel_size: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        causal: bool = False,
+        performer: bool = False,
+        num_random_features: int = 256,
+        feature_redraw_interval: int = 0,
+        window_size: Optional[int] = None,
+        num_global_tokens: int = 0,
+        rotary: bool = False,
     ):
         """Multi-Headed Dot-product attention module
 
@@ -598,6 +1742,27 @@ class MultiheadAttention(nn.Module):
             num_landmarks (int, optional): Number of landmark points for nystrom attention. Defaults to 64.
             inverse_iterations (int, optional): Number of iteration to calculate the inverse in nystrom attention. Defaults to 6.
             kernel_size (Optional[int], optional): Use residual convolution in the output. Defaults to None.
+            chunk_size (Optional[int], optional): Use memory efficient chunked_attention with this chunk size.
+                Attention scores are not returned in this mode.
+                Ignored if nystrom, performer or window_size are set. Defaults to None.
+            causal (bool, optional): Apply a subsequent mask internally, for autoregressive tasks.
+                With nystrom=True, causal_nystrom_attention is used. Defaults to False.
+            performer (bool, optional): Use linear complexity performer_attention. Attention scores are not
+                returned in this mode. Defaults to False.
+            num_random_features (int, optional): Number of random features for performer attention. Defaults to 256.
+            feature_redraw_interval (int, optional): Redraw the performer random features every
+                feature_redraw_interval training steps. 0 keeps them fixed. Defaults to 0.
+            window_size (Optional[int], optional): Use sliding_window_attention, where each position attends
+                to positions at distance at most window_size. Attention scores are not returned in this mode.
+                Defaults to None.
+            num_global_tokens (int, optional): Number of global tokens at the start of the sequence
+                for sliding window attention. Defaults to 0.
+            rotary (bool, optional): Apply rotary position embeddings to the queries and keys of self-attention.
+                Defaults to False.
+
+        Raises:
+            ValueError: If causal=True and kernel_size is not None. The residual convolution sees future tokens
+            ValueError: If more than one of nystrom, performer and window_size are set
         """
         super(MultiheadAttention, self).__init__()
 
@@ -606,17 +1771,38 @@ class MultiheadAttention(nn.Module):
         self.inverse_iterations = inverse_iterations
         self.num_landmarks = num_landmarks
         self.nystrom = nystrom
+        self.chunk_size = chunk_size
+        self.causal = causal
+        self.window_size = window_size
+        self.num_global_tokens = num_global_tokens
         self.num_heads = num_heads
         self.head_size = int(attention_size / num_heads)
         self.dk = self.head_size
         self.attention_size = attention_size
-        self.k = nn.Linear(input_size, attention_size, bias=False)
-        self.q = nn.Linear(input_size, attention_size, bias=False)
-        self.v = nn.Linear(input_size, attention_size, bias=False)
+        # Fused [q; k; v] projection. Keys and values are contiguous for cross-attention
+        self.qkv = nn.Linear(input_size, 3 * attention_size, bias=False)
         self.output = nn.Linear(attention_size, attention_size)
         self.dropout = dropout
 
         self.conv = None
+        self.rotary = RotaryEmbedding(self.head_size) if rotary else None
+
+        if causal and kernel_size is not None:
+            raise ValueError("Residual convolution cannot be used with causal=True")
+
+        if sum([nystrom, performer, window_size is not None]) > 1:
+            raise ValueError(
+                "Only one of nystrom, performer and window_size can be used"
+            )
+
+        self.performer = None
+
+        if performer:
+            self.performer = PerformerKernel(
+                self.head_size,
+                num_random_features=num_random_features,
+                feature_redraw_interval=feature_redraw_interval,
+            )
 
         if kernel_size is not None:
             self.conv = nn.Conv2d(
@@ -629,8 +1815,15 @@ class MultiheadAttention(nn.Module):
             )
 
         reset_parameters(self.named_parameters())
+        _reset_fused_projection(self.qkv.weight, 3)
+        # Checkpoints with separate k, q, v layers
+        self._register_load_state_dict_pre_hook(
+            _fuse_projections_hook(("q", "k", "v"), "qkv")
+        )
 
-    def forward(self, keys, queries=None, attention_mask=None):
+    def forward(
+        self, keys, queries=None, attention_mask=None, need_weights=True, cache=None
+    ):
         r"""Multi-head scaled dot-product attention forward pass
 
         Outputs the values, where features for each sequence element are weighted by their respective attention scores
@@ -654,36 +1847,149 @@ class MultiheadAttention(nn.Module):
         Args:
             keys (torch.Tensor): [B, L, D] Keys tensor
             queries (Optional[torch.Tensor]): Optional [B, M, D] Queries tensor. If None queries = keys. Defaults to None.
-            attention_mask (Optional[torch.Tensor]): Optional [B, M, L] zero-one mask for sequence elements. Defaults to None.
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, M, L] zero-one mask
+                for sequence elements, or an AttentionMask. Defaults to None.
+            need_weights (bool): Return attention scores. If False, faster fused kernels can be used. Defaults to True.
+            cache (Optional[Dict[str, torch.Tensor]]): Key / value cache for incremental decoding. Pass an empty dict
+                in the first step and the same dict in the next steps. For self-attention (queries=None) the keys and
+                values of the new positions are appended to the cache and attention_mask is [B, 1|M, past + L].
+                For cross-attention keys and values are computed in the first step and reused afterwards.
+                Defaults to None.
+
+        Unpadded inputs: For self-attention, keys can be the [T, D] valid tokens of a padded batch, with an
+        AttentionMask [B, L] pad mask (see AttentionMask.unpad_indices). The projections run on the T tokens only.
+        Queries, keys and values are scattered back to [B, H, L, A/H] for the attention kernel,
+        and the output is [T, D].
+
+        Raises:
+            ValueError: If causal=True and the queries length differs from the keys length
+            ValueError: If a cache is used with nystrom, performer, window_size or kernel_size
+            ValueError: If unpadded inputs are used without an AttentionMask, for cross-attention or with a cache
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: (Reweighted values [B, L, D], attention scores [B, H, M, L])
         """
-        _, seq_length, _ = keys.size()
+        indices = None
+
+        if keys.ndim == 2:
+            if (
+                not isinstance(attention_mask, AttentionMask)
+                or queries is not None
+                or cache is not None
+            ):
+                raise ValueError(
+                    "Unpadded inputs need an AttentionMask pad mask and are only supported for self-attention without cache"
+                )
+            indices = attention_mask.unpad_indices()
+            batch_size, seq_length = attention_mask.mask.size(0), attention_mask.mask.size(-1)  # type: ignore
+        else:
+            _, seq_length, _ = keys.size()
+
+        attention_mask = _multihead_mask(attention_mask)
+
+        if self.causal and queries is not None and queries.size(1) != seq_length:
+            raise ValueError("causal=True can only be used for self-attention")
+
+        if (
+            self.window_size is not None
+            and queries is not None
+            and queries.size(1) != seq_length
+        ):
+            raise ValueError("window_size can only be used for self-attention")
+
+        if cache is not None and (
+            self.nystrom
+            or self.performer is not None
+            or self.window_size is not None
+            or self.conv is not None
+        ):
+            raise ValueError(
+                "Key / value cache is only supported for dense attention without residual convolution"
+            )
 
-        if attention_mask is not None:
-            if attention_mask.ndim == 2:
-                attention_mask = attention_mask.unsqueeze(1)
-            attention_mask = attention_mask.unsqueeze(1)
+        self_attention = queries is None
 
-        if self.nystrom:
-            keys, attention_mask = pad_for_nystrom(
-                keys, self.num_landmarks, attention_mask=attention_mask
-            )
+        if self_attention:
+            # Single GEMM for queries, keys and values
+            qkv = self.qkv(keys)
 
-        if queries is None:
-            queries = keys
+            if indices is not None:
+                # Projections run on the valid tokens. Attention runs on the re-padded batch
+                qkv = pad_unpadded_sequences(qkv, indices, batch_size, seq_length)
+            q, k, v = qkv.chunk(3, dim=-1)
+            k = split_heads(k, self.num_heads)
+            v = split_heads(v, self.num_heads)
+        else:
+            q = F.linear(queries, _linear_weight(self.qkv)[: self.attention_size])
 
-        values = keys
+            if cache is not None and "k" in cache:
+                # Cross-attention keys and values are computed once per source
+                k, v = cache["k"], cache["v"]
+            else:
+                # Fused keys / values GEMM
+                k, v = F.linear(
+                    keys, _linear_weight(self.qkv)[self.attention_size :]
+                ).chunk(2, dim=-1)
+                k = split_heads(k, self.num_heads)
+                v = split_heads(v, self.num_heads)
 
-        k = self.k(keys)
-        q = self.q(queries)
-        v = self.v(values)
-        k = split_heads(k, self.num_heads)
         q = split_heads(q, self.num_heads)
-        v = split_heads(v, self.num_heads)
 
-        if self.nystrom:
+        if self.rotary is not None and self_attention:
+            # Cached keys are already rotated. New positions start after them
+            offset = cache["k"].size(-2) if cache is not None and "k" in cache else 0
+            q, k = self.rotary(q, offset=offset), self.rotary(k, offset=offset)
+
+        if cache is not None:
+            if self_attention and "k" in cache:
+                k = torch.cat([cache["k"], k], dim=-2)
+                v = torch.cat([cache["v"], v], dim=-2)
+            cache["k"], cache["v"] = k, v
+
+        if cache is not None:
+            if self.causal:
+                # New queries are the last positions of the cached sequence
+                past = k.size(-2) - q.size(-2)
+                future = torch.ones(q.size(-2), k.size(-2), device=k.device).tril(past)
+                mask = _mask_tensor(attention_mask, q.dtype)
+                attention_mask = future[None, None] if mask is None else mask * future
+            # out => (B, H, M, A/H)
+            # scores => (B, H, M, past + L)
+            out, scores = attention(
+                k,
+                q,
+                v,
+                self.dk,
+                attention_mask=attention_mask,
+                dropout=self.dropout,
+                training=self.training,
+                need_weights=need_weights,
+            )
+        elif self.performer is not None:
+            # out = (B, H, L, A/H)
+            # scores = None
+            out, scores = self.performer(
+                k,
+                q,
+                v,
+                self.dk,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
+                causal=self.causal,
+            )
+        elif self.nystrom and self.causal:
+            # out = (B, H, L, A/H)
+            # scores = None
+            out, scores = causal_nystrom_attention(
+                k,
+                q,
+                v,
+                self.dk,
+                self.num_landmarks,
+                attention_mask=_key_padding_mask(_mask_tensor(attention_mask, k.dtype)),
+                dropout=self.dropout,
+                training=self.training,
+            )
+        elif self.nystrom:
             # out = (B, H, L, A/H)
             # scores = Tuple
             out, scores = nystrom_attention(
@@ -692,12 +1998,45 @@ class MultiheadAttention(nn.Module):
                 v,
                 self.dk,
                 self.num_landmarks,
-                attention_mask=attention_mask,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
                 inverse_iterations=self.inverse_iterations,
                 dropout=self.dropout,
                 training=self.training,
             )
+        elif self.window_size is not None:
+            # out => (B, H, L, A/H)
+            # scores => None
+            out, scores = sliding_window_attention(
+                k,
+                q,
+                v,
+                self.dk,
+                self.window_size,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
+                num_global_tokens=self.num_global_tokens,
+                causal=self.causal,
+                dropout=self.dropout,
+                training=self.training,
+            )
+        elif self.chunk_size is not None:
+            # out => (B, H, L, A/H)
+            # scores => None
+            out, scores = chunked_attention(
+                k,
+                q,
+                v,
+                self.dk,
+                attention_mask=_mask_tensor(attention_mask, k.dtype),
+                chunk_size=self.chunk_size,
+                causal=self.causal,
+                dropout=self.dropout,
+                training=self.training,
+            )
         else:
+            if self.causal:
+                attention_mask = _with_subsequent_mask(
+                    attention_mask, seq_length, k.device
+                )
             # out => (B, H, L, A/H)
             # scores => (B, H, L, L)
             out, scores = attention(
@@ -708,19 +2047,24 @@ class MultiheadAttention(nn.Module):
                 attention_mask=attention_mask,
                 dropout=self.dropout,
                 training=self.training,
+                need_weights=need_weights,
             )
 
         if self.conv is not None:
-            if attention_mask is None or attention_mask.ndim > 2:
+            mask = _mask_tensor(attention_mask, v.dtype)
+
+            if mask is None or mask.size(-2) > 1:
                 out += self.conv(v)
             else:
-                attention_mask = attention_mask.squeeze()
-                out += self.conv(v * attention_mask[:, None, :, None])
+                # (B, 1, 1, L) pad mask => (B, 1, L, 1)
+                out += self.conv(v * mask.transpose(-1, -2))
 
         # out => (B, H, L, A/H)
         out = merge_heads(out)
-        if out.size(1) != seq_length:
-            out = out[:, :seq_length, :]
+
+        if indices is not None:
+            # (B, L, A) => (T, A)
+            out = unpad_sequences(out, indices)
         out = self.output(out)
 
         return out, scores
@@ -794,8 +2138,12 @@ class MultiheadTwowayAttention(nn.Module):
         queries : (B, L, D)
         values : (B, L, D)
         """
-        out_mod1, _ = self.xy(mod1, queries=mod2, attention_mask=attention_mask)
-        out_mod2, _ = self.yx(mod2, queries=mod1, attention_mask=attention_mask)
+        out_mod1, _ = self.xy(
+            mod1, queries=mod2, attention_mask=attention_mask, need_weights=False
+        )
+        out_mod2, _ = self.yx(
+            mod2, queries=mod1, attention_mask=attention_mask, need_weights=False
+        )
 
         if not self.residual:
             return out_mod1, out_mod2
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 import numpy as np
 import torch
@@ -7,6 +7,7 @@ from slp.modules.embed import PositionalEncoding
 from slp.modules.mmdrop import MultimodalDropout
 from slp.modules.rnn import AttentiveRNN, TokenRNN
 from slp.modules.transformer import (
+    ExitHead,
     TransformerSequenceEncoder,
     TransformerTokenSequenceEncoder,
 )
@@ -61,6 +62,7 @@ class Classifier(nn.Module):
 class TransformerSequenceClassifier(Classifier):
     def __init__(
         self,
+        input_size,
         num_classes,
         num_layers=6,
         hidden_size=512,
@@ -73,8 +75,11 @@ class TransformerSequenceClassifier(Classifier):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        varlen=False,
+        position_encoding="sinusoidal",
     ):
         encoder = TransformerSequenceEncoder(
+            input_size,
             num_layers=num_layers,
             hidden_size=hidden_size,
             num_heads=num_heads,
@@ -86,6 +91,8 @@ class TransformerSequenceClassifier(Classifier):
             kernel_size=kernel_size,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            varlen=varlen,
+            position_encoding=position_encoding,
         )
 
         super(TransformerSequenceClassifier, self).__init__(
@@ -109,6 +116,8 @@ class TransformerTokenSequenceClassifier(Classifier):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        varlen=False,
+        position_encoding="sinusoidal",
     ):
         encoder = TransformerTokenSequenceEncoder(
             vocab_size=vocab_size,
@@ -123,6 +132,8 @@ class TransformerTokenSequenceClassifier(Classifier):
             kernel_size=kernel_size,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            varlen=varlen,
+            position_encoding=position_encoding,
         )
 
         super(TransformerTokenSequenceClassifier, self).__init__(
@@ -130,6 +141,81 @@ class TransformerTokenSequenceClassifier(Classifier):
         )
 
 
+class TransformerEarlyExitClassifier(nn.Module):
+    def __init__(
+        self,
+        encoder: nn.Module,
+        num_classes: int,
+        exit_layers: Optional[List[int]] = None,
+        threshold: Optional[float] = None,
+        dropout: float = 0.2,
+    ):
+        """Classifier with early exits after intermediate transformer layers
+
+        An ExitHead is attached after each of exit_layers and after the last layer.
+
+        * Training: returns the [E, B, num_classes] logits of all E exits, so that the heads are trained jointly.
+          TransformerClassificationPLModule averages the loss over the exits
+        * Evaluation: each example stops at the first exit with confidence >= threshold, and the remaining layers
+          run only for the examples that have not exited. The number of layers used by each example of the last batch
+          is stored in self.layers_used. With threshold=None all layers run and the last exit is used.
+
+        Args:
+            encoder (nn.Module): TransformerSequenceEncoder or TransformerTokenSequenceEncoder, with varlen=False
+            num_classes (int): Number of classes
+            exit_layers (Optional[List[int]]): Exits after these layers (0-based). Defaults to None (all layers).
+            threshold (Optional[float]): Confidence threshold for early exits during evaluation. Defaults to None.
+            dropout (float): Drop probability. Defaults to 0.2.
+        """
+        super(TransformerEarlyExitClassifier, self).__init__()
+        self.encoder = encoder
+        num_layers = len(encoder.transformer_block.encoder)
+
+        if exit_layers is None:
+            exit_layers = list(range(num_layers))
+        self.exit_layers_idx = sorted(set(exit_layers) | {num_layers - 1})
+        self.heads = nn.ModuleList(
+            [
+                ExitHead(encoder.out_size, num_classes, dropout=dropout)
+                for _ in self.exit_layers_idx
+            ]
+        )
+        self.threshold = threshold
+        self.layers_used: Optional[torch.Tensor] = None
+
+    def forward(self, x, attention_mask=None):
+        """Classify input sequences
+
+        Args:
+            x (torch.Tensor): [B, L] token ids or [B, L, input_size] features, depending on the encoder
+            attention_mask (Optional[torch.Tensor]): Optional [B, L] zero-one pad mask. Defaults to None.
+
+        Returns:
+            torch.Tensor: [E, B, num_classes] logits of all exits in training mode, [B, num_classes] otherwise
+        """
+        x = self.encoder.embed_sequence(x)
+        exit_heads = dict(zip(self.exit_layers_idx, self.heads))
+
+        if self.training or self.threshold is None:
+            exits = self.encoder.transformer_block.early_exit(
+                x, exit_heads, attention_mask=attention_mask
+            )
+
+            if self.training:
+                return torch.stack(exits)
+            self.layers_used = torch.full(
+                (x.size(0),), self.exit_layers_idx[-1] + 1, device=x.device
+            )
+
+            return exits[-1]
+
+        logits, self.layers_used = self.encoder.transformer_block.early_exit(
+            x, exit_heads, attention_mask=attention_mask, threshold=self.threshold
+        )
+
+        return logits
+
+
 class RNNSequenceClassifier(Classifier):
     def __init__(
         self,
@@ -247,9 +333,11 @@ class TransformerLateFusionClassifier(nn.Module):
         multi_modal_drop="mmdrop",
         p_mmdrop=0.5,
         p_drop_modalities=None,
+        varlen=False,
+        position_encoding="sinusoidal",
     ):
         super(TransformerLateFusionClassifier, self).__init__()
-        self.modalities = modality_feature_sizes.keys()
+        self.modalities = list(modality_feature_sizes.keys())
         self.modality_encoders = nn.ModuleDict(
             {
                 m: TransformerSequenceEncoder(
@@ -266,6 +354,8 @@ class TransformerLateFusionClassifier(nn.Module):
                     kernel_size=kernel_size,
                     prenorm=prenorm,
                     scalenorm=scalenorm,
+                    varlen=varlen,
+                    position_encoding=position_encoding,
                 )
                 for m in self.modalities
             }
@@ -359,7 +449,7 @@ class RNNLateFusionClassifier(nn.Module):
         mmdrop_mode="hard",
     ):
         super(RNNLateFusionClassifier, self).__init__()
-        self.modalities = modality_feature_sizes.keys()
+        self.modalities = list(modality_feature_sizes.keys())
         self.modality_encoders = nn.ModuleDict(
             {
                 m: AttentiveRNN(
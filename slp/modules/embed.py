@@ -1,5 +1,5 @@
 import math
-from typing import Optional
+from typing import Dict, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -9,7 +9,112 @@ from loguru import logger
 from slp.modules.regularization import GaussianNoise
 
 
-class PositionalEncoding(nn.Module):
+# Sinusoid tables shared by all positional encodings in the process, keyed by (dim, dtype, device)
+_SINUSOID_CACHE: Dict[Tuple[int, torch.dtype, torch.device], torch.Tensor] = {}
+
+POSITION_ENCODINGS = ["sinusoidal", "rotary"]
+
+
+def _sinusoids(length: int, dim: int) -> torch.Tensor:
+    pe = torch.zeros(length, dim)
+    position = torch.arange(0, length, dtype=torch.float).unsqueeze(1)
+    div_term = torch.exp(torch.arange(0, dim, 2).float() * (-math.log(10000.0) / dim))
+    pe[:, 0::2] = torch.sin(position * div_term)
+    pe[:, 1::2] = torch.cos(position * div_term)
+
+    return pe
+
+
+def sinusoid_table(
+    length: int,
+    dim: int,
+    dtype: torch.dtype = torch.float,
+    device: Optional[Union[str, torch.device]] = None,
+) -> torch.Tensor:
+    """Sinusoidal positional encoding table, from a process-wide cache
+
+    Tables are created once per (dim, dtype, device) and shared by all modules. The returned
+    tensor is a view of the cached table. When a longer table is requested, the cache grows to
+    at least twice its length, so that it is rebuilt a logarithmic number of times.
+
+    Args:
+        length (int): Number of positions
+        dim (int): Embedding dimension
+        dtype (torch.dtype): Table dtype. Defaults to torch.float.
+        device (Optional[Union[str, torch.device]]): Table device. Defaults to None (cpu).
+
+    Returns:
+        torch.Tensor: [length, dim] table. Even features are sin(pos / 10000^(2i/d)), odd features
+            are the matching cos
+    """
+    key = (dim, dtype, torch.device(device if device is not None else "cpu"))
+    table = _SINUSOID_CACHE.get(key)
+
+    if table is None or table.size(0) < length:
+        cached_length = table.size(0) if table is not None else 0
+        table = _sinusoids(max(length, 2 * cached_length), dim)
+        table = table.to(device=key[2], dtype=dtype)
+        _SINUSOID_CACHE[key] = table
+
+    return table[:length]
+
+
+def _drop_table_hook(state_dict, prefix, *args):
+    """State dict pre-hook that ignores the tables saved in checkpoints with persistent buffers"""
+    state_dict.pop(f"{prefix}pe", None)
+
+
+class _SinusoidTable(nn.Module):
+    def __init__(self, dim: int, max_len: int):
+        """Holds a view of the shared sinusoid table of dim features as a non-persistent buffer
+
+        The table is not saved in checkpoints and grows on demand beyond max_len
+
+        Args:
+            dim (int): Table dimension
+            max_len (int): Initial number of positions
+        """
+        super(_SinusoidTable, self).__init__()
+        self.dim = dim
+        self.register_buffer("pe", sinusoid_table(max_len, dim), persistent=False)
+        self._register_load_state_dict_pre_hook(_drop_table_hook)
+
+    @property
+    def max_len(self) -> int:
+        return self.pe.size(0)  # type: ignore
+
+    def _apply(self, fn, *args, **kwargs):
+        """Apply fn to the buffers, e.g. in .to(), .double() or .cuda()
+
+        fn returns a private copy of the table. It is replaced by a view of the shared table with the new
+        dtype and device
+        """
+        module = super(_SinusoidTable, self)._apply(fn, *args, **kwargs)
+        self.pe = sinusoid_table(
+            self.max_len, self.dim, dtype=self.pe.dtype, device=self.pe.device  # type: ignore
+        )
+
+        return module
+
+    def table(self, length: int) -> torch.Tensor:
+        """The [length, dim] table. Grows the buffer if length > max_len
+
+        Args:
+            length (int): Number of positions
+
+        Returns:
+            torch.Tensor: [length, dim] table, with the dtype and device of the module
+        """
+
+        if length > self.max_len:
+            self.pe = sinusoid_table(
+                length, self.dim, dtype=self.pe.dtype, device=self.pe.device  # type: ignore
+            )
+
+        return self.pe[:length]  # type: ignore
+
+
+class PositionalEncoding(_SinusoidTable):
     def __init__(self, embedding_dim: int = 512, max_len: int = 5000):
         r"""Inject some information about the relative or absolute position of the tokens in the sequence.
 
@@ -29,23 +134,21 @@ class PositionalEncoding(nn.Module):
 
         Implementation modified from pytorch/examples/word_language_model.py
 
+        The table is a view of a process-wide cache (see sinusoid_table), registered as a non-persistent
+        buffer. Modules with the same embedding_dim share it and it is not saved in checkpoints.
+
         Args:
             embedding_dim (int): Embedding / model dimension. Defaults to 512.
-            max_len (int): Maximum sequence length that can be encoded. Defaults to 5000.
+            max_len (int): Initial number of positions. Longer sequences grow the table. Defaults to 5000.
         """
-        super(PositionalEncoding, self).__init__()
-        pe = torch.zeros(max_len, embedding_dim)
-        position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(
-            torch.arange(0, embedding_dim, 2).float()
-            * (-math.log(10000.0) / embedding_dim)
-        )
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer("pe", pe)
+        super(PositionalEncoding, self).__init__(embedding_dim, max_len)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        x: torch.Tensor,
+        offset: int = 0,
+        positions: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
         """Calculate positional embeddings for input and add them to input tensor
 
         $$out = x + PosEmbed(x)$$
@@ -53,15 +156,64 @@ class PositionalEncoding(nn.Module):
         x is assumed to be batch first
 
         Args:
-            x (torch.Tensor): [B, L, D] input embeddings
+            x (torch.Tensor): [B, L, D] input embeddings, or [T, D] unpadded tokens if positions are given
+            offset (int): Position of the first element of x. Used in incremental decoding,
+                where x contains only the new positions. Defaults to 0.
+            positions (Optional[torch.Tensor]): [T] position of each token in its sequence, for unpadded
+                tokens, or [B, L] for packed batches. Defaults to None.
 
         Returns:
             torch.Tensor: Embeddings + positional embeddings
         """
-        x = x + self.pe[:, : x.size(1), :]  # type: ignore
+
+        if positions is not None:
+            # Positions are bounded by the row length of packed [B, L] positions, and by the number of
+            # tokens T of unpadded [T] positions. Sizing from the shape avoids a device sync
+            return x + self.table(positions.size(-1))[positions]
+
+        x = x + self.table(offset + x.size(1))[offset:]
         return x
 
 
+class RotaryEmbedding(_SinusoidTable):
+    def __init__(self, head_size: int, max_len: int = 512):
+        r"""Rotary position embeddings (RoFormer, Su et al. 2021)
+
+        Each pair of query / key features $(x_{2i}, x_{2i+1})$ at position $pos$ is rotated by the angle
+        $\frac{pos}{10000^{\frac{2i}{d}}}$. The dot product of a rotated query and key depends only
+        on their relative position. The angles are the sinusoid table of PositionalEncoding,
+        served by the same process-wide cache.
+
+        Args:
+            head_size (int): Features per attention head. Must be even
+            max_len (int): Initial number of positions. Longer sequences grow the table. Defaults to 512.
+
+        Raises:
+            ValueError: If head_size is odd
+        """
+
+        if head_size % 2 != 0:
+            raise ValueError("Rotary embeddings require an even head size")
+        super(RotaryEmbedding, self).__init__(head_size, max_len)
+
+    def forward(self, x: torch.Tensor, offset: int = 0) -> torch.Tensor:
+        """Rotate queries or keys according to their positions
+
+        Args:
+            x (torch.Tensor): [..., L, head_size] queries or keys
+            offset (int): Position of the first element of x. Used in incremental decoding. Defaults to 0.
+
+        Returns:
+            torch.Tensor: [..., L, head_size] rotated input
+        """
+        table = self.table(offset + x.size(-2))[offset:].to(x.dtype)
+        sin, cos = table[:, 0::2], table[:, 1::2]
+        x1, x2 = x[..., 0::2], x[..., 1::2]
+        out = torch.stack([x1 * cos - x2 * sin, x1 * sin + x2 * cos], dim=-1)
+
+        return out.flatten(-2)
+
+
 class Embed(nn.Module):
     def __init__(
         self,
@@ -6,7 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from slp.modules.attention import Attention
 from slp.modules.rnn import AttentiveRNN
-from slp.modules.twowayattention import TwowayAttention
+from slp.modules.twowayattention import TwowayAttention, batched_twoway_attention
 
 
 class Conv1dProjection(nn.Module):
@@ -956,6 +956,7 @@ class AttentionFuser(TrimodalCombinatorialFuser):
         use_all_trimodal: bool = False,
         residual: bool = True,
         dropout: float = 0.1,
+        batch_pairs: bool = False,
         **kwargs,
     ):
         """Fuse all combinations of three modalities using a base module using bilinear fusion
@@ -971,6 +972,8 @@ class AttentionFuser(TrimodalCombinatorialFuser):
             use_all_trimodal (bool): Use all optional trimodal combinations
             residual (bool): Use residual connection in TwowayAttention. Defaults to True
             dropout (float): Dropout probability
+            batch_pairs (bool): Compute the three bimodal TwowayAttention modules in a single batched call.
+                Outputs are identical. Defaults to False
         """
         kwargs["dropout"] = dropout
         kwargs["residual"] = residual
@@ -980,6 +983,7 @@ class AttentionFuser(TrimodalCombinatorialFuser):
             use_all_trimodal=use_all_trimodal,
             **kwargs,
         )
+        self.batch_pairs = batch_pairs
 
     def _bimodal_fusion_module(self, feature_size: int, **kwargs):
         """TwowayAttention module to fuse bimodal combinations
@@ -1028,21 +1032,27 @@ class AttentionFuser(TrimodalCombinatorialFuser):
 
         """
         txt, au, vi = mods
-        ta, at = self.ta(txt, au)
-        va, av = self.va(vi, au)
-        tv, vt = self.tv(txt, vi)
+
+        if self.batch_pairs:
+            (ta, at), (va, av), (tv, vt) = batched_twoway_attention(
+                [self.ta, self.va, self.tv], [(txt, au), (vi, au), (txt, vi)]
+            )
+        else:
+            ta, at = self.ta(txt, au)
+            va, av = self.va(vi, au)
+            tv, vt = self.tv(txt, vi)
 
         va = va + av
         tv = vt + tv
         ta = ta + at
 
-        tav, _ = self.tav(txt, queries=va)
+        tav, _ = self.tav(txt, queries=va, need_weights=False)
 
         out_list = [txt, au, vi, ta, tv, va, tav]
 
         if self.use_all_trimodal:
-            vat, _ = self.vat(vi, queries=ta)
-            atv, _ = self.atv(au, queries=tv)
+            vat, _ = self.vat(vi, queries=ta, need_weights=False)
+            atv, _ = self.atv(au, queries=tv, need_weights=False)
 
             out_list = out_list + [vat, atv]
 
@@ -1,4 +1,3 @@
-import random
 from typing import List, Optional
 
 import torch
@@ -30,7 +29,9 @@ class HardMultimodalDropout(nn.Module):
     def forward(self, *mods):
         """Naive mmdrop forward
 
-        Iterate over batch and randomly choose modality to drop
+        Randomly choose a modality to drop for each sample in the batch.
+        Sampling uses the torch RNG without python control flow on random values,
+        so the module can be compiled with torch.compile
 
         Args:
             mods (varargs torch.Tensor): [B, L, D_m] Modality representations
@@ -43,18 +44,17 @@ class HardMultimodalDropout(nn.Module):
         # List of [B, L, D]
 
         if self.training:
-            if random.random() < self.p:
-                # Drop different modality for each sample in batch
-
-                for batch in range(mods[0].size(0)):
-                    m = random.choices(
-                        list(range(self.n_modalities)), weights=self.p_mod, k=1
-                    )[0]
-
-                    # m = random.randint(0, self.n_modalities - 1)
-                    mask = torch.ones_like(mods[m])
-                    mask[batch] = 0.0
-                    mods[m] = mods[m] * mask
+            batch_size = mods[0].size(0)
+            device = mods[0].device
+            # Drop different modality for each sample in batch, with probability p
+            drop = (torch.rand(1, device=device) < self.p).float()
+            p_mod = torch.tensor(self.p_mod, device=device)
+            dropped = torch.multinomial(p_mod, batch_size, replacement=True)
+
+            for m in range(len(mods)):
+                mask = 1.0 - drop * (dropped == m).float()
+                mask = mask.view(-1, *([1] * (mods[m].ndim - 1)))
+                mods[m] = mods[m] * mask.to(mods[m].dtype)
 
             if self.p > 0:
                 for m in range(len(mods)):
@@ -89,7 +89,8 @@ class SoftMultimodalDropout(nn.Module):
     def forward(self, *mods):
         """Soft mmdrop forward
 
-        Sample a binomial mask to mask a random modality in this batch
+        Sample a binomial mask to mask a random modality in this batch.
+        Sampling uses the torch RNG, as in HardMultimodalDropout
 
         Args:
             mods (varargs torch.Tensor): [B, L, D_m] Modality representations
@@ -100,13 +101,15 @@ class SoftMultimodalDropout(nn.Module):
         mods = list(mods)
 
         if self.training:
-            # m = random.randint(0, self.n_modalities - 1)
-            m = random.choices(list(range(self.n_modalities)), weights=self.p_mod, k=1)[
-                0
-            ]
+            p_mod = torch.tensor(self.p_mod, device=mods[0].device)
+            dropped = torch.multinomial(p_mod, 1)
 
-            binomial = torch.distributions.binomial.Binomial(probs=1 - self.p)
-            mods[m] = mods[m] * binomial.sample(mods[m].size()).to(mods[m].device)
+            for m in range(self.n_modalities):
+                # Binomial mask for the dropped modality, ones for the rest
+                keep = torch.bernoulli(torch.full_like(mods[m], 1 - self.p))
+                mods[m] = mods[m] * torch.where(
+                    dropped == m, keep, torch.ones_like(keep)
+                )
 
             for m in range(self.n_modalities):
                 mods[m] = mods[m] * (1.0 / (1 - self.p / self.n_modalities))
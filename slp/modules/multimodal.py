@@ -122,6 +122,7 @@ class UnimodalEncoder(BaseEncoder):
         attention: bool = True,
         merge_bi: str = "sum",
         aggregate_encoded: bool = False,
+        checkpoint_activations: bool = False,
         **kwargs,
     ):
         """Single modality encoder
@@ -138,6 +139,8 @@ class UnimodalEncoder(BaseEncoder):
             attention (bool, optional): Use attention over hidden states. Defaults to True.
             merge_bi (str, optional): How to merge hidden states [sum|cat]. Defaults to sum.
             aggregate_encoded (bool, optional): Aggregate hidden states. Defaults to False.
+            checkpoint_activations (bool, optional): Recompute the RNN activations in the backward pass
+                instead of storing them. Defaults to False.
         """
         super(UnimodalEncoder, self).__init__(
             input_size,
@@ -162,6 +165,7 @@ class UnimodalEncoder(BaseEncoder):
             packed_sequence=True,
             attention=attention,
             return_hidden=True,
+            checkpoint_activations=checkpoint_activations,
         )
 
     def _make_fusion_pipeline(
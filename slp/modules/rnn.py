@@ -7,7 +7,14 @@ from loguru import logger
 from slp.modules.attention import MultiheadSelfAttention as MultiheadAttention
 from slp.modules.attention import SelfAttention as Attention
 from slp.modules.embed import Embed
-from slp.util.pytorch import PackSequence, PadPackedSequence, pad_mask
+from slp.util.pytorch import (
+    PackSequence,
+    PadPackedSequence,
+    checkpoint,
+    is_compiling,
+    pad_mask,
+)
+from torch.nn.utils.rnn import PackedSequence
 
 # from slp.modules.attention import (
 #     Attention,
@@ -28,6 +35,7 @@ class RNN(nn.Module):
         rnn_type: str = "lstm",
         packed_sequence: bool = True,
         max_length: int = -1,
+        checkpoint_activations: bool = False,
     ):
         """LSTM - GRU wrapper with packed sequence support and handling for bidirectional / last output states
 
@@ -43,6 +51,9 @@ class RNN(nn.Module):
             dropout (float): Dropout probability. Defaults to 0.0.
             rnn_type (str): lstm or gru. Defaults to "lstm".
             packed_sequence (bool): Use packed sequences. Defaults to True.
+            checkpoint_activations (bool): Recompute the recurrent activations in the backward pass
+                instead of storing them. The stacked layers run as a single fused op, so they are
+                checkpointed as one segment. Defaults to False.
         """
         super(RNN, self).__init__()
         self.bidirectional = bidirectional
@@ -71,6 +82,7 @@ class RNN(nn.Module):
         )
         self.drop = nn.Dropout(dropout)
         self.packed_sequence = packed_sequence
+        self.checkpoint_activations = checkpoint_activations
 
         if packed_sequence:
             self.pack = PackSequence(batch_first=batch_first)
@@ -165,6 +177,39 @@ class RNN(nn.Module):
 
         return out, self._merge_bi(last_forward_out, last_backward_out)
 
+    def _checkpointed_rnn(
+        self, x: Union[torch.Tensor, PackedSequence]
+    ) -> Tuple[
+        Union[torch.Tensor, PackedSequence],
+        Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
+    ]:
+        """Run the recurrent layers with activation checkpointing
+
+        checkpoint expects tensor inputs and outputs, so packed sequences are unpacked to their data
+
+        Args:
+            x (Union[torch.Tensor, PackedSequence]): Padded or packed input features
+
+        Returns:
+            Tuple[Union[torch.Tensor, PackedSequence], Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]:
+                RNN outputs and hidden states, as returned by nn.LSTM / nn.GRU
+        """
+        packed = isinstance(x, PackedSequence)
+
+        def run(data: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+            out, hidden = self.rnn(x._replace(data=data) if packed else data)  # type: ignore
+            out = out.data if packed else out
+            hidden = hidden if isinstance(hidden, tuple) else (hidden,)
+
+            return (out,) + hidden
+
+        out, *hidden = checkpoint(run, x.data if packed else x)  # type: ignore
+
+        if packed:
+            out = x._replace(data=out)  # type: ignore
+
+        return out, tuple(hidden) if self.rnn_type == "lstm" else hidden[0]
+
     def forward(
         self, x: torch.Tensor, lengths: torch.Tensor
     ) -> Tuple[
@@ -185,13 +230,19 @@ class RNN(nn.Module):
                 hidden states tuple of [num_layers * num_directions, B, H] for LSTM or tensor [num_layers * num_directions, B, H] for GRU
             )
         """
-        self.rnn.flatten_parameters()
+        if hasattr(self.rnn, "flatten_parameters") and not is_compiling():
+            # Dynamically quantized RNNs have no flat weights
+            self.rnn.flatten_parameters()
 
         if self.packed_sequence:
             # Latest pytorch allows only cpu tensors for packed sequence
             lengths = lengths.to("cpu")
             x, lengths = self.pack(x, lengths)
-        out, hidden = self.rnn(x)
+
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            out, hidden = self._checkpointed_rnn(x)
+        else:
+            out, hidden = self.rnn(x)
 
         if self.packed_sequence:
             out = self.unpack(out, lengths)
@@ -222,7 +273,11 @@ class AttentiveRNN(nn.Module):
         num_landmarks: int = 32,
         kernel_size: Optional[int] = 33,
         inverse_iterations: int = 6,
+        performer: bool = False,
+        num_random_features: int = 256,
+        feature_redraw_interval: int = 0,
         return_hidden: bool = False,
+        checkpoint_activations: bool = False,
     ):
         """RNN with embedding layer and optional attention mechanism
 
@@ -247,7 +302,14 @@ class AttentiveRNN(nn.Module):
             kernel_size (int): Kernel size for multihead attention output residual convolution
             inverse_iterations (int): Number of iterations for moore-penrose inverse approximation
                 in nystrom attention. 6 is a good value
+            performer (bool): Use performer (FAVOR+) linear attention for multihead attention.
+                Requires nystrom=False. Defaults to False.
+            num_random_features (int): Number of random features for performer attention. Defaults to 256.
+            feature_redraw_interval (int): Redraw performer random features every feature_redraw_interval
+                training steps. 0 keeps them fixed. Defaults to 0.
             return_hidden (bool): Return all hidden states. Defaults to False.
+            checkpoint_activations (bool): Recompute the RNN activations in the backward pass
+                instead of storing them. Defaults to False.
         """
         super(AttentiveRNN, self).__init__()
         self.rnn = RNN(
@@ -261,6 +323,7 @@ class AttentiveRNN(nn.Module):
             rnn_type=rnn_type,
             packed_sequence=packed_sequence,
             max_length=max_length,
+            checkpoint_activations=checkpoint_activations,
         )
         self.out_size = (
             hidden_size
@@ -285,6 +348,9 @@ class AttentiveRNN(nn.Module):
                     nystrom=nystrom,
                     num_landmarks=num_landmarks,
                     inverse_iterations=inverse_iterations,
+                    performer=performer,
+                    num_random_features=num_random_features,
+                    feature_redraw_interval=feature_redraw_interval,
                     dropout=dropout,
                 )
 
@@ -317,6 +383,7 @@ class AttentiveRNN(nn.Module):
                     lengths,
                     max_length=states.size(1) if self.batch_first else states.size(0),
                 ),
+                need_weights=False,
             )
             out = states.mean(dim=1)
 
@@ -349,6 +416,9 @@ class TokenRNN(nn.Module):
         num_landmarks: int = 32,
         kernel_size: Optional[int] = 33,
         inverse_iterations: int = 6,
+        performer: bool = False,
+        num_random_features: int = 256,
+        feature_redraw_interval: int = 0,
         return_hidden=False,
     ):
         """RNN with embedding layer and optional attention mechanism
@@ -378,6 +448,11 @@ class TokenRNN(nn.Module):
             kernel_size (int): Kernel size for multihead attention output residual convolution
             inverse_iterations (int): Number of iterations for moore-penrose inverse approximation
                 in nystrom attention. 6 is a good value
+            performer (bool): Use performer (FAVOR+) linear attention for multihead attention.
+                Requires nystrom=False. Defaults to False.
+            num_random_features (int): Number of random features for performer attention. Defaults to 256.
+            feature_redraw_interval (int): Redraw performer random features every feature_redraw_interval
+                training steps. 0 keeps them fixed. Defaults to 0.
         """
         super(TokenRNN, self).__init__()
 
@@ -418,6 +493,9 @@ class TokenRNN(nn.Module):
             num_landmarks=num_landmarks,
             kernel_size=kernel_size,
             inverse_iterations=inverse_iterations,
+            performer=performer,
+            num_random_features=num_random_features,
+            feature_redraw_interval=feature_redraw_interval,
             return_hidden=return_hidden,
         )
 
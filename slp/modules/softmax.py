@@ -0,0 +1,287 @@
+import math
+from typing import List, Optional, Sequence
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+SUPPORTED_OUTPUT_LAYERS = ["softmax", "adaptive", "sampled"]
+"""Output layers of the language models"""
+
+
+def frequency_ranks(token_counts: Sequence[int]) -> torch.Tensor:
+    """Rank of each token id by decreasing occurence count
+
+    Ties keep the token id order
+
+    Args:
+        token_counts (Sequence[int]): Occurence count of each token id, e.g. from create_vocab
+
+    Returns:
+        torch.Tensor: [V] rank of each token id. 0 is the most frequent token
+    """
+    order = sorted(range(len(token_counts)), key=lambda i: -token_counts[i])
+    ranks = torch.empty(len(token_counts), dtype=torch.long)
+    ranks[torch.tensor(order)] = torch.arange(len(token_counts))
+
+    return ranks
+
+
+def frequency_cutoffs(
+    token_counts: Sequence[int], coverage: Sequence[float] = (0.8, 0.95)
+) -> List[int]:
+    """Adaptive softmax cluster boundaries, from the token frequencies
+
+    The head contains the most frequent tokens that make up coverage[0] of the corpus,
+    the first tail cluster the tokens up to coverage[1] etc.
+
+    Args:
+        token_counts (Sequence[int]): Occurence count of each token id
+        coverage (Sequence[float]): Fraction of the corpus covered by the head and each tail cluster.
+            Defaults to (0.8, 0.95).
+
+    Returns:
+        List[int]: Increasing cutoffs in (0, V), for tokens ordered by frequency
+    """
+    vocab_size = len(token_counts)
+    counts = torch.tensor(sorted(token_counts, reverse=True), dtype=torch.double)
+    covered = counts.cumsum(0) / counts.sum().clamp(min=1)
+    cutoffs = []
+
+    for c in coverage:
+        cutoff = int((covered < c).sum().item()) + 1
+
+        if 0 < cutoff < vocab_size and (not cutoffs or cutoff > cutoffs[-1]):
+            cutoffs.append(cutoff)
+
+    return cutoffs
+
+
+def _flatten_targets(hidden, targets, ignore_index):
+    """Flatten to [N, H] hidden states and [N] targets and drop the ignored targets"""
+    hidden = hidden.reshape(-1, hidden.size(-1))
+    targets = targets.reshape(-1)
+    keep = targets != ignore_index
+
+    return hidden[keep], targets[keep]
+
+
+class AdaptiveSoftmax(nn.Module):
+    def __init__(
+        self,
+        hidden_size: int,
+        vocab_size: int,
+        token_counts: Optional[Sequence[int]] = None,
+        cutoffs: Optional[Sequence[int]] = None,
+        div_value: float = 4.0,
+        ignore_index: int = -100,
+    ):
+        """Adaptive softmax output layer (Grave et al. 2017)
+
+        Tokens are clustered by frequency. The head scores the frequent tokens and one entry per
+        tail cluster. Rare tokens are scored by smaller projections, of size hidden_size / div_value ** i
+        for the i-th cluster, only for the targets that belong to the cluster. The model is an exactly
+        normalized distribution over the vocabulary, so perplexity is exact.
+
+        Token ids do not need to be ordered by frequency. They are mapped to their frequency rank
+        with token_counts, e.g. the counts computed by create_vocab (see PLDataModuleFromCorpus.token_counts).
+
+        Call it as a loss: adaptive(hidden, targets). Use log_prob for decoding.
+
+        Args:
+            hidden_size (int): Dimension of the hidden states
+            vocab_size (int): Number of tokens
+            token_counts (Optional[Sequence[int]]): Occurence count of each token id. If None, token ids are
+                assumed to be ordered by frequency. Defaults to None.
+            cutoffs (Optional[Sequence[int]]): Cluster boundaries of the frequency ranks. Defaults to None,
+                which uses frequency_cutoffs(token_counts).
+            div_value (float): Projection size reduction of each cluster. Defaults to 4.0.
+            ignore_index (int): Target ignored in the loss. Defaults to -100, as nn.CrossEntropyLoss.
+
+        Raises:
+            ValueError: If both token_counts and cutoffs are None
+        """
+        super(AdaptiveSoftmax, self).__init__()
+
+        if cutoffs is None:
+            if token_counts is None:
+                raise ValueError("Adaptive softmax requires token_counts or cutoffs")
+            cutoffs = frequency_cutoffs(token_counts)
+
+        ranks = (
+            frequency_ranks(token_counts)
+            if token_counts is not None
+            else torch.arange(vocab_size)
+        )
+        self.register_buffer("ranks", ranks)
+        self.ignore_index = ignore_index
+        self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(
+            hidden_size, vocab_size, list(cutoffs), div_value=div_value
+        )
+
+    def forward(self, hidden: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+        """Mean negative log-likelihood of the targets
+
+        Args:
+            hidden (torch.Tensor): [..., H] hidden states
+            targets (torch.Tensor): [...] target token ids
+
+        Returns:
+            torch.Tensor: Loss
+        """
+        hidden, targets = _flatten_targets(hidden, targets, self.ignore_index)
+
+        return self.adaptive(hidden, self.ranks[targets]).loss
+
+    def log_prob(self, hidden: torch.Tensor) -> torch.Tensor:
+        """Log-probabilities of all tokens
+
+        Args:
+            hidden (torch.Tensor): [..., H] hidden states
+
+        Returns:
+            torch.Tensor: [..., V] log-probabilities, indexed by token id
+        """
+        out = self.adaptive.log_prob(hidden.reshape(-1, hidden.size(-1)))
+        out = out.index_select(-1, self.ranks)
+
+        return out.view(hidden.shape[:-1] + (-1,))
+
+
+class SampledSoftmax(nn.Module):
+    def __init__(
+        self,
+        hidden_size: int,
+        vocab_size: int,
+        num_sampled: int = 1024,
+        token_counts: Optional[Sequence[int]] = None,
+        ignore_index: int = -100,
+    ):
+        """Softmax output layer trained with sampled softmax (Jean et al. 2015)
+
+        In training, each target is scored against num_sampled negative tokens shared by the batch,
+        instead of the whole vocabulary. Negatives are drawn from a log-uniform (Zipfian) distribution
+        over the frequency ranks of token_counts, or uniformly if token_counts is None, and the logits
+        are corrected by the log sampling probabilities. Sampled targets are removed from the negatives.
+
+        In eval mode the loss is the exact full softmax cross-entropy, so perplexity is exact.
+
+        Call it as a loss: sampled(hidden, targets). Use log_prob for decoding. The weight can be tied
+        with the input embeddings.
+
+        Args:
+            hidden_size (int): Dimension of the hidden states
+            vocab_size (int): Number of tokens
+            num_sampled (int): Negative samples per batch. Defaults to 1024.
+            token_counts (Optional[Sequence[int]]): Occurence count of each token id. Defaults to None.
+            ignore_index (int): Target ignored in the loss. Defaults to -100, as nn.CrossEntropyLoss.
+        """
+        super(SampledSoftmax, self).__init__()
+        self.num_sampled = num_sampled
+        self.ignore_index = ignore_index
+        self.weight = nn.Parameter(torch.empty(vocab_size, hidden_size))
+        self.bias = nn.Parameter(torch.zeros(vocab_size))
+        bound = 1 / math.sqrt(hidden_size)
+        nn.init.uniform_(self.weight, -bound, bound)
+
+        if token_counts is not None:
+            # P(r) = log((r + 2) / (r + 1)) / log(V + 1) for frequency rank r
+            ranks = frequency_ranks(token_counts).double()
+            probs = torch.log((ranks + 2) / (ranks + 1)) / math.log(vocab_size + 1)
+        else:
+            probs = torch.full((vocab_size,), 1.0 / vocab_size, dtype=torch.double)
+        self.register_buffer("sampling_probs", probs.float())
+
+    def logits(self, hidden: torch.Tensor) -> torch.Tensor:
+        """Full softmax logits
+
+        Args:
+            hidden (torch.Tensor): [..., H] hidden states
+
+        Returns:
+            torch.Tensor: [..., V] logits
+        """
+
+        return F.linear(hidden, self.weight, self.bias)
+
+    def forward(self, hidden: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+        """Sampled softmax loss in training, full softmax cross-entropy in eval mode
+
+        Args:
+            hidden (torch.Tensor): [..., H] hidden states
+            targets (torch.Tensor): [...] target token ids
+
+        Returns:
+            torch.Tensor: Loss
+        """
+        hidden, targets = _flatten_targets(hidden, targets, self.ignore_index)
+
+        if not self.training:
+            return F.cross_entropy(self.logits(hidden), targets)
+
+        sampled = torch.multinomial(
+            self.sampling_probs, self.num_sampled, replacement=True
+        )
+        log_q = torch.log(self.sampling_probs)
+        # (N,)
+        target_logits = (hidden * self.weight[targets]).sum(-1) + self.bias[targets]
+        target_logits = target_logits - log_q[targets]
+        # (N, S)
+        sampled_logits = F.linear(hidden, self.weight[sampled], self.bias[sampled])
+        sampled_logits = sampled_logits - log_q[sampled]
+        sampled_logits = sampled_logits.masked_fill(
+            sampled.unsqueeze(0) == targets.unsqueeze(-1), -1e4
+        )
+        logits = torch.cat([target_logits.unsqueeze(-1), sampled_logits], dim=-1)
+
+        return F.cross_entropy(logits, targets.new_zeros(targets.size(0)))
+
+    def log_prob(self, hidden: torch.Tensor) -> torch.Tensor:
+        """Log-probabilities of all tokens
+
+        Args:
+            hidden (torch.Tensor): [..., H] hidden states
+
+        Returns:
+            torch.Tensor: [..., V] log-probabilities
+        """
+
+        return F.log_softmax(self.logits(hidden), dim=-1)
+
+
+def make_output_layer(
+    output_layer: str,
+    hidden_size: int,
+    vocab_size: int,
+    token_counts: Optional[Sequence[int]] = None,
+    **kwargs,
+) -> nn.Module:
+    """Helper function to instantiate a language model output layer
+
+    Args:
+        output_layer (str): One of the supported output layers [softmax|adaptive|sampled]
+        hidden_size (int): Dimension of the hidden states
+        vocab_size (int): Number of tokens
+        token_counts (Optional[Sequence[int]]): Occurence count of each token id. Defaults to None.
+        **kwargs: Variable keyword arguments to pass to the output layer, e.g. cutoffs or num_sampled
+
+    Returns:
+        nn.Module: nn.Linear for softmax. An AdaptiveSoftmax or SampledSoftmax loss module otherwise
+    """
+
+    if output_layer not in SUPPORTED_OUTPUT_LAYERS:
+        raise NotImplementedError(
+            f"The supported output layers are {SUPPORTED_OUTPUT_LAYERS}. You provided {output_layer}"
+        )
+
+    if output_layer == "adaptive":
+        return AdaptiveSoftmax(
+            hidden_size, vocab_size, token_counts=token_counts, **kwargs
+        )
+
+    if output_layer == "sampled":
+        return SampledSoftmax(
+            hidden_size, vocab_size, token_counts=token_counts, **kwargs
+        )
+
+    return nn.Linear(hidden_size, vocab_size)
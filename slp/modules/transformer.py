@@ -1,11 +1,23 @@
 import math
 
+import torch
 import torch.nn as nn
-from slp.modules.attention import MultiheadAttention
-from slp.modules.embed import Embed, PositionalEncoding
+import torch.nn.functional as F
+from slp.modules.attention import AttentionMask, MultiheadAttention
+from slp.modules.embed import POSITION_ENCODINGS, Embed, PositionalEncoding
 from slp.modules.feedforward import PositionwiseFF
 from slp.modules.norm import LayerNorm, ScaleNorm
-from slp.util.pytorch import repeat_layer
+from slp.modules.softmax import make_output_layer
+from slp.util.pytorch import (
+    block_diagonal_mask,
+    checkpoint,
+    masked_mean,
+    pool_segments,
+    repeat_layer,
+    segment_positions,
+    unpad_sequences,
+    unpadded_mean,
+)
 
 
 def reset_parameters(named_parameters, gain=1.0):
@@ -20,6 +32,104 @@ def reset_parameters(named_parameters, gain=1.0):
                 nn.init.constant_(p, 0.0)
 
 
+def _positional_encoding(position_encoding, hidden_size, max_length):
+    """Positional encoding module added to the input embeddings
+
+    Args:
+        position_encoding (str): sinusoidal or rotary
+        hidden_size (int): Embedding dimension
+        max_length (int): Initial length of the sinusoid table
+
+    Raises:
+        ValueError: If position_encoding is not supported
+
+    Returns:
+        Optional[PositionalEncoding]: The positional encoding. None for rotary embeddings,
+            which are applied to the queries and keys in the self-attention layers
+    """
+
+    if position_encoding not in POSITION_ENCODINGS:
+        raise ValueError(
+            f"position_encoding should be one of {POSITION_ENCODINGS}. Got {position_encoding}"
+        )
+
+    if position_encoding == "rotary":
+        return None
+
+    return PositionalEncoding(embedding_dim=hidden_size, max_len=max_length)
+
+
+def _shared_mask(attention_mask):
+    """Wrap a mask tensor in an AttentionMask, built once and shared by all layers
+
+    Args:
+        attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): [B, L] or [B, M, L] zero-one mask
+
+    Returns:
+        Optional[AttentionMask]: The shared mask. Masks that are already wrapped are returned as they are
+    """
+
+    if attention_mask is None or isinstance(attention_mask, AttentionMask):
+        return attention_mask
+
+    return AttentionMask(attention_mask)
+
+
+def _checkpointed_layers(layers, segment_size, run_layer, x, *args):
+    """Run layers in segments of segment_size consecutive layers with activation checkpointing
+
+    Only the inputs of each segment are kept for the backward pass. The activations inside
+    a segment are recomputed, with the same dropout masks
+
+    Args:
+        layers (nn.ModuleList): Layers to run
+        segment_size (int): Number of layers per checkpointed segment
+        run_layer (Callable): run_layer(layer, x, *args) runs a single layer
+        x (torch.Tensor): Input of the first layer
+        *args: Extra tensor inputs of every layer, e.g. the encoder outputs for the decoder
+
+    Returns:
+        torch.Tensor: Output of the last layer
+    """
+
+    for start in range(0, len(layers), segment_size):
+        segment = layers[start : start + segment_size]
+
+        def run_segment(x, *args, segment=segment):
+            for layer in segment:
+                x = run_layer(layer, x, *args)
+
+            return x
+
+        x = checkpoint(run_segment, x, *args)
+
+    return x
+
+
+def _mean_pool(x, attention_mask, indices, batch_size, seq_length):
+    """Mean over the valid positions of each sequence
+
+    Args:
+        x (torch.Tensor): [B, L, D] encoded sequences, or [T, D] unpadded tokens if indices are given
+        attention_mask (Optional[AttentionMask]): Shared attention mask. Padding is excluded from
+            the mean for [B, L] pad masks
+        indices (Optional[torch.Tensor]): [T] indices of the unpadded tokens in the flattened [B * L] batch
+        batch_size (int): Batch size B
+        seq_length (int): Padded sequence length L
+
+    Returns:
+        torch.Tensor: [B, D] pooled sequences
+    """
+
+    if indices is not None:
+        return unpadded_mean(x, indices, batch_size, seq_length)
+
+    if attention_mask is None or attention_mask.mask.size(1) > 1:
+        return x.mean(dim=1)
+
+    return masked_mean(x, attention_mask.as_bool().squeeze(1))
+
+
 class Sublayer1(nn.Module):
     def __init__(
         self,
@@ -31,6 +141,13 @@ class Sublayer1(nn.Module):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        causal=False,
+        performer=False,
+        num_random_features=256,
+        feature_redraw_interval=0,
+        window_size=None,
+        num_global_tokens=0,
+        rotary=False,
     ):
         super(Sublayer1, self).__init__()
         self.sublayer = MultiheadAttention(
@@ -40,27 +157,42 @@ class Sublayer1(nn.Module):
             nystrom=nystrom,
             kernel_size=kernel_size,
             num_landmarks=num_landmarks,
+            causal=causal,
+            performer=performer,
+            num_random_features=num_random_features,
+            feature_redraw_interval=feature_redraw_interval,
+            window_size=window_size,
+            num_global_tokens=num_global_tokens,
+            rotary=rotary,
         )
         self.prenorm = prenorm
         self.lnorm = LayerNorm(hidden_size) if not scalenorm else ScaleNorm(hidden_size)
 
-    def _prenorm(self, x, attention_mask=None):
-        out, _ = self.sublayer(self.lnorm(x), attention_mask=attention_mask)
+    def _prenorm(self, x, attention_mask=None, cache=None, need_weights=False):
+        out, weights = self.sublayer(
+            self.lnorm(x),
+            attention_mask=attention_mask,
+            need_weights=need_weights,
+            cache=cache,
+        )
 
-        return out + x
+        return out + x, weights
 
-    def _postnorm(self, x, attention_mask=None):
-        out, _ = self.sublayer(x, attention_mask=attention_mask)
+    def _postnorm(self, x, attention_mask=None, cache=None, need_weights=False):
+        out, weights = self.sublayer(
+            x, attention_mask=attention_mask, need_weights=need_weights, cache=cache
+        )
 
-        return self.lnorm(x + out)
+        return self.lnorm(x + out), weights
 
-    def forward(self, x, attention_mask=None):
-        return (
-            self._prenorm(x, attention_mask=attention_mask)
-            if self.prenorm
-            else self._postnorm(x, attention_mask=attention_mask)
+    def forward(self, x, attention_mask=None, cache=None, need_weights=False):
+        sublayer = self._prenorm if self.prenorm else self._postnorm
+        out, weights = sublayer(
+            x, attention_mask=attention_mask, cache=cache, need_weights=need_weights
         )
 
+        return (out, weights) if need_weights else out
+
 
 class Sublayer2(nn.Module):
     def __init__(
@@ -110,25 +242,39 @@ class Sublayer3(nn.Module):
                 LayerNorm(hidden_size) if not scalenorm else ScaleNorm(hidden_size)
             )
 
-    def _prenorm(self, x, y, attention_mask=None):
-        out, _ = self.sublayer(
-            self.lnorm(x), queries=self.lnormy(y), attention_mask=attention_mask
+    def _prenorm(self, x, y, attention_mask=None, cache=None, need_weights=False):
+        # Cached keys and values are already computed from the normalized x
+        keys = x if cache else self.lnorm(x)
+        out, weights = self.sublayer(
+            keys,
+            queries=self.lnormy(y),
+            attention_mask=attention_mask,
+            need_weights=need_weights,
+            cache=cache,
         )
 
-        return out + x
+        # The residual is the decoder stream y, which has the length of the queries
+        return out + y, weights
 
-    def _postnorm(self, x, y, attention_mask=None):
-        out, _ = self.sublayer(x, queries=y, attention_mask=attention_mask)
+    def _postnorm(self, x, y, attention_mask=None, cache=None, need_weights=False):
+        out, weights = self.sublayer(
+            x,
+            queries=y,
+            attention_mask=attention_mask,
+            need_weights=need_weights,
+            cache=cache,
+        )
 
-        return self.lnorm(x + out)
+        return self.lnorm(y + out), weights
 
-    def forward(self, x, y, attention_mask=None):
-        return (
-            self._prenorm(x, y, attention_mask=attention_mask)
-            if self.prenorm
-            else self._postnorm(x, y, attention_mask=attention_mask)
+    def forward(self, x, y, attention_mask=None, cache=None, need_weights=False):
+        sublayer = self._prenorm if self.prenorm else self._postnorm
+        out, weights = sublayer(
+            x, y, attention_mask=attention_mask, cache=cache, need_weights=need_weights
         )
 
+        return (out, weights) if need_weights else out
+
 
 class EncoderLayer(nn.Module):
     def __init__(
@@ -142,6 +288,13 @@ class EncoderLayer(nn.Module):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        causal=False,
+        performer=False,
+        num_random_features=256,
+        feature_redraw_interval=0,
+        window_size=None,
+        num_global_tokens=0,
+        rotary=False,
     ):
         super(EncoderLayer, self).__init__()
         self.l1 = Sublayer1(
@@ -153,6 +306,13 @@ class EncoderLayer(nn.Module):
             kernel_size=kernel_size,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            causal=causal,
+            performer=performer,
+            num_random_features=num_random_features,
+            feature_redraw_interval=feature_redraw_interval,
+            window_size=window_size,
+            num_global_tokens=num_global_tokens,
+            rotary=rotary,
         )
         self.l2 = Sublayer2(
             hidden_size=hidden_size,
@@ -162,7 +322,12 @@ class EncoderLayer(nn.Module):
             scalenorm=scalenorm,
         )
 
-    def forward(self, x, attention_mask=None):
+    def forward(self, x, attention_mask=None, need_weights=False):
+        if need_weights:
+            out, weights = self.l1(x, attention_mask=attention_mask, need_weights=True)
+
+            return self.l2(out), weights
+
         out = self.l1(x, attention_mask=attention_mask)
         out = self.l2(out)
 
@@ -182,8 +347,17 @@ class Encoder(nn.Module):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        causal=False,
+        performer=False,
+        num_random_features=256,
+        feature_redraw_interval=0,
+        window_size=None,
+        num_global_tokens=0,
+        checkpoint_activations=0,
+        rotary=False,
     ):
         super(Encoder, self).__init__()
+        self.checkpoint_activations = checkpoint_activations
         self.encoder = nn.ModuleList(
             repeat_layer(
                 EncoderLayer(
@@ -196,16 +370,172 @@ class Encoder(nn.Module):
                     kernel_size=kernel_size,
                     prenorm=prenorm,
                     scalenorm=scalenorm,
+                    causal=causal,
+                    performer=performer,
+                    num_random_features=num_random_features,
+                    feature_redraw_interval=feature_redraw_interval,
+                    window_size=window_size,
+                    num_global_tokens=num_global_tokens,
+                    rotary=rotary,
                 ),
                 num_layers,
             )
         )
 
-    def forward(self, x, attention_mask=None):
+    def forward(self, x, attention_mask=None, need_weights=False):
+        """Encoder forward pass
+
+        Args:
+            x (torch.Tensor): [B, L, D] Input tensor, or [T, D] valid tokens of the batch with an AttentionMask
+                pad mask. Unpadded tokens are ordered as in AttentionMask.unpad_indices
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, L] or [B, L, L] zero-one mask.
+                Tensors are converted once to an AttentionMask that is shared by all layers. Defaults to None.
+            need_weights (bool): Also return the self-attention scores of each layer. When False,
+                scores are never materialized and faster fused kernels are used. Activations are not checkpointed
+                when need_weights=True. Defaults to False.
+
+        Returns:
+            Union[torch.Tensor, Tuple[torch.Tensor, List[torch.Tensor]]]: [B, L, D] (or [T, D]) Encoded sequence,
+                and attention scores per layer if need_weights=True
+        """
+        weights = []
+        attention_mask = _shared_mask(attention_mask)
+
+        if (
+            self.checkpoint_activations > 0
+            and not need_weights
+            and torch.is_grad_enabled()
+        ):
+            return _checkpointed_layers(
+                self.encoder,
+                self.checkpoint_activations,
+                lambda layer, x: layer(x, attention_mask=attention_mask),
+                x,
+            )
+
         for layer in self.encoder:
+            x = layer(x, attention_mask=attention_mask, need_weights=need_weights)
+
+            if need_weights:
+                x, layer_weights = x
+                weights.append(layer_weights)
+
+        return (x, weights) if need_weights else x
+
+    def early_exit(self, x, exit_heads, attention_mask=None, threshold=None):
+        """Encoder forward pass with classifiers after intermediate layers
+
+        When threshold is None, all layers run and the outputs of all exit heads are returned,
+        e.g. to train the heads jointly.
+
+        Otherwise each example stops at the first exit where the confidence (max class probability)
+        of its head reaches threshold. Exited examples are removed from the batch, so the remaining
+        layers run only for the examples that have not exited.
+
+        Args:
+            x (torch.Tensor): [B, L, D] Input tensor
+            exit_heads (Mapping[int, Callable]): Exit head after layer i (0-based). Heads are called as
+                head(x, attention_mask) and return [B, C] logits. A head after the last layer is required.
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, L] or [B, L, L] zero-one mask.
+                Defaults to None.
+            threshold (Optional[float]): Confidence threshold for early exits. Defaults to None.
+
+        Raises:
+            ValueError: If there is no exit head after the last layer
+
+        Returns:
+            Union[List[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]]: [B, C] logits of each exit head,
+                in layer order, if threshold is None. Otherwise ([B, C] logits of the exit of each example,
+                [B] number of layers used for each example)
+        """
+
+        if len(self.encoder) - 1 not in exit_heads:
+            raise ValueError("An exit head after the last layer is required")
+
+        attention_mask = _shared_mask(attention_mask)
+
+        if threshold is None:
+            exits = []
+
+            for i, layer in enumerate(self.encoder):
+                x = layer(x, attention_mask=attention_mask)
+
+                if i in exit_heads:
+                    exits.append(exit_heads[i](x, attention_mask))
+
+            return exits
+
+        remaining = torch.arange(x.size(0), device=x.device)
+        exit_layers = torch.full_like(remaining, len(self.encoder))
+        logits = None
+
+        for i, layer in enumerate(self.encoder):
             x = layer(x, attention_mask=attention_mask)
 
-        return x
+            if i not in exit_heads:
+                continue
+
+            out = exit_heads[i](x, attention_mask)
+
+            if logits is None:
+                logits = out.new_zeros(exit_layers.size(0), out.size(-1))
+
+            if i == len(self.encoder) - 1:
+                logits[remaining] = out
+
+                break
+
+            if out.size(-1) == 1:
+                probs = torch.sigmoid(out)
+                confidence = torch.max(probs, 1 - probs).squeeze(-1)
+            else:
+                confidence = F.softmax(out, dim=-1).max(dim=-1)[0]
+            confident = confidence >= threshold
+            logits[remaining[confident]] = out[confident]
+            exit_layers[remaining[confident]] = i + 1
+
+            if confident.all():
+                break
+
+            # Drop exited examples from the batch
+            keep = (~confident).nonzero().squeeze(-1)
+            remaining = remaining[keep]
+            x = x.index_select(0, keep)
+
+            if attention_mask is not None:
+                attention_mask = attention_mask.select(keep)
+
+        return logits, exit_layers
+
+
+class ExitHead(nn.Module):
+    def __init__(self, hidden_size, num_classes, dropout=0.1):
+        """Lightweight classifier after an intermediate encoder layer, for Encoder.early_exit
+
+        Masked mean pooling followed by a linear layer
+
+        Args:
+            hidden_size (int): Encoder hidden size
+            num_classes (int): Number of classes
+            dropout (float): Drop probability. Defaults to 0.1.
+        """
+        super(ExitHead, self).__init__()
+        self.drop = nn.Dropout(dropout)
+        self.clf = nn.Linear(hidden_size, num_classes)
+
+    def forward(self, x, attention_mask=None):
+        """Classify encoded sequences
+
+        Args:
+            x (torch.Tensor): [B, L, D] Encoded sequences
+            attention_mask (Optional[AttentionMask]): Shared attention mask. Defaults to None.
+
+        Returns:
+            torch.Tensor: [B, num_classes] logits
+        """
+        pooled = _mean_pool(x, attention_mask, None, x.size(0), x.size(1))
+
+        return self.clf(self.drop(pooled))
 
 
 class DecoderLayer(nn.Module):
@@ -217,6 +547,7 @@ class DecoderLayer(nn.Module):
         dropout=0.1,
         prenorm=True,
         scalenorm=True,
+        rotary=False,
     ):
         super(DecoderLayer, self).__init__()
         self.in_layer = Sublayer1(
@@ -227,6 +558,7 @@ class DecoderLayer(nn.Module):
             kernel_size=None,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            rotary=rotary,
         )
         self.fuse_layer = Sublayer3(
             hidden_size=hidden_size,
@@ -243,9 +575,35 @@ class DecoderLayer(nn.Module):
             scalenorm=scalenorm,
         )
 
-    def forward(self, targets, encoded, source_mask=None, target_mask=None):
-        targets = self.in_layer(targets, attention_mask=target_mask)
-        out = self.fuse_layer(encoded, targets, attention_mask=source_mask)
+    def forward(
+        self,
+        targets,
+        encoded,
+        source_mask=None,
+        target_mask=None,
+        cache=None,
+        need_weights=False,
+    ):
+        self_cache, cross_cache = (None, None) if cache is None else cache
+
+        if need_weights:
+            targets, self_weights = self.in_layer(
+                targets, attention_mask=target_mask, cache=self_cache, need_weights=True
+            )
+            out, cross_weights = self.fuse_layer(
+                encoded,
+                targets,
+                attention_mask=source_mask,
+                cache=cross_cache,
+                need_weights=True,
+            )
+
+            return self.out_layer(out), (self_weights, cross_weights)
+
+        targets = self.in_layer(targets, attention_mask=target_mask, cache=self_cache)
+        out = self.fuse_layer(
+            encoded, targets, attention_mask=source_mask, cache=cross_cache
+        )
         out = self.out_layer(out)
 
         return out
@@ -261,8 +619,11 @@ class Decoder(nn.Module):
         dropout=0.1,
         prenorm=True,
         scalenorm=True,
+        checkpoint_activations=0,
+        rotary=False,
     ):
         super(Decoder, self).__init__()
+        self.checkpoint_activations = checkpoint_activations
         self.decoder = nn.ModuleList(
             repeat_layer(
                 DecoderLayer(
@@ -272,19 +633,101 @@ class Decoder(nn.Module):
                     dropout=dropout,
                     prenorm=prenorm,
                     scalenorm=scalenorm,
+                    rotary=rotary,
                 ),
                 num_layers,
             )
         )
 
-    def forward(self, target, encoded, source_mask=None, target_mask=None):
+    def init_cache(self):
+        """Create an empty key / value cache for incremental decoding
+
+        The cache holds one (self-attention, cross-attention) pair of dicts per layer
+
+        Returns:
+            List[Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]]: The empty cache
+        """
+
+        return [({}, {}) for _ in self.decoder]
+
+    @staticmethod
+    def reorder_cache(cache, indices):
+        """Select batch elements of the self-attention cache, e.g. when beams are reordered
+
+        Cross-attention keys and values are shared by all beams of a source and are not reordered
+
+        Args:
+            cache (List[Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]]): Cache from init_cache
+            indices (torch.Tensor): [B] Batch indices to keep
+        """
 
-        for l in self.decoder:
-            target = l(
-                target, encoded, source_mask=source_mask, target_mask=target_mask
+        for self_cache, _ in cache:
+            for key, value in self_cache.items():
+                self_cache[key] = value.index_select(0, indices)
+
+    def forward(
+        self,
+        target,
+        encoded,
+        source_mask=None,
+        target_mask=None,
+        cache=None,
+        need_weights=False,
+    ):
+        """Decoder forward pass
+
+        Args:
+            target (torch.Tensor): [B, M, D] Target embeddings. With a cache only the new positions
+            encoded (torch.Tensor): [B, L, D] Encoder outputs
+            source_mask (Optional[Union[torch.Tensor, AttentionMask]]): [B, 1, L] Source pad mask. Defaults to None.
+            target_mask (Optional[Union[torch.Tensor, AttentionMask]]): [B, M, M] Target pad and subsequent mask.
+                With a cache, None or a [B, 1, past + M] pad mask. Masks are converted once to AttentionMask
+                objects that are shared by all layers. Defaults to None.
+            cache (Optional[List]): Key / value cache from init_cache, updated in place. Defaults to None.
+            need_weights (bool): Also return the (self-attention, cross-attention) scores of each layer.
+                When False, scores are never materialized and faster fused kernels are used. Defaults to False.
+                Activations are checkpointed only without a cache and with need_weights=False.
+
+        Returns:
+            Union[torch.Tensor, Tuple[torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor]]]]: [B, M, D]
+                Decoder outputs, and attention scores per layer if need_weights=True
+        """
+        weights = []
+        source_mask = _shared_mask(source_mask)
+        target_mask = _shared_mask(target_mask)
+
+        if (
+            self.checkpoint_activations > 0
+            and cache is None
+            and not need_weights
+            and torch.is_grad_enabled()
+        ):
+            return _checkpointed_layers(
+                self.decoder,
+                self.checkpoint_activations,
+                lambda layer, x, encoded: layer(
+                    x, encoded, source_mask=source_mask, target_mask=target_mask
+                ),
+                target,
+                encoded,
+            )
+
+        for i, l in enumerate(self.decoder):
+            out = l(
+                target,
+                encoded,
+                source_mask=source_mask,
+                target_mask=target_mask,
+                cache=cache[i] if cache is not None else None,
+                need_weights=need_weights,
             )
 
-        return target
+            if need_weights:
+                out, layer_weights = out
+                weights.append(layer_weights)
+            target = out
+
+        return (target, weights) if need_weights else target
 
 
 class EncoderDecoder(nn.Module):
@@ -300,6 +743,8 @@ class EncoderDecoder(nn.Module):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        checkpoint_activations=0,
+        rotary=False,
     ):
         super(EncoderDecoder, self).__init__()
         self.encoder = Encoder(
@@ -313,6 +758,8 @@ class EncoderDecoder(nn.Module):
             kernel_size=kernel_size,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            checkpoint_activations=checkpoint_activations,
+            rotary=rotary,
         )
         self.decoder = Decoder(
             num_layers=num_layers,
@@ -322,9 +769,13 @@ class EncoderDecoder(nn.Module):
             dropout=dropout,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            checkpoint_activations=checkpoint_activations,
+            rotary=rotary,
         )
 
     def forward(self, source, target, source_mask=None, target_mask=None):
+        # The source mask is shared by the encoder and the decoder cross-attention
+        source_mask = _shared_mask(source_mask)
         encoded = self.encoder(source, attention_mask=source_mask)
         decoded = self.decoder(
             target, encoded, source_mask=source_mask, target_mask=target_mask
@@ -348,8 +799,40 @@ class Transformer(nn.Module):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        checkpoint_activations=0,
+        position_encoding="sinusoidal",
+        output_layer="softmax",
+        token_counts=None,
+        **output_layer_kwargs,
     ):
+        """Encoder-decoder transformer for sequence to sequence tasks
+
+        With output_layer="adaptive" or "sampled", forward returns the [B, M, hidden_size] decoder outputs
+        and the loss is computed by the output layer, model.predict(outputs, targets)
+        (see slp.modules.softmax). Pass model.predict as the criterion of TransformerPLModule.
+
+        Args:
+            vocab_size (int): Number of tokens. Defaults to 30000.
+            max_length (int): Default maximum length for generate. Defaults to 256.
+            num_layers (int): Encoder and decoder layers. Defaults to 6.
+            hidden_size (int): Model dimension. Defaults to 512.
+            num_heads (int): Attention heads. Defaults to 8.
+            inner_size (int): Feedforward dimension. Defaults to 2048.
+            dropout (float): Drop probability. Defaults to 0.1.
+            nystrom (bool): Nystrom encoder self-attention. Defaults to False.
+            num_landmarks (int): Nystrom landmarks. Defaults to 32.
+            kernel_size (Optional[int]): Residual convolution in the encoder self-attention. Defaults to None.
+            prenorm (bool): Normalize the inputs of each sublayer. Defaults to True.
+            scalenorm (bool): Use ScaleNorm instead of LayerNorm. Defaults to True.
+            checkpoint_activations (int): Checkpointed segment size. 0 disables checkpointing. Defaults to 0.
+            position_encoding (str): sinusoidal or rotary. Defaults to "sinusoidal".
+            output_layer (str): softmax, adaptive or sampled. Defaults to "softmax".
+            token_counts (Optional[Sequence[int]]): Occurence count of each token id, for the adaptive clusters
+                and the sampling distribution. Defaults to None.
+            **output_layer_kwargs: Extra arguments of the output layer, e.g. cutoffs or num_sampled
+        """
         super(Transformer, self).__init__()
+        self.max_length = max_length
         self.embed = Embed(
             vocab_size,
             hidden_size,
@@ -357,7 +840,7 @@ class Transformer(nn.Module):
             dropout=dropout,
             trainable=True,
         )
-        self.pe = PositionalEncoding(embedding_dim=hidden_size, max_len=max_length)
+        self.pe = _positional_encoding(position_encoding, hidden_size, max_length)
         self.transformer_block = EncoderDecoder(
             num_layers=num_layers,
             hidden_size=hidden_size,
@@ -369,27 +852,172 @@ class Transformer(nn.Module):
             kernel_size=kernel_size,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            checkpoint_activations=checkpoint_activations,
+            rotary=position_encoding == "rotary",
         )
         self.drop = nn.Dropout(dropout)
-        self.predict = nn.Linear(hidden_size, vocab_size)
+        self.output_layer = output_layer
+        self.predict = make_output_layer(
+            output_layer,
+            hidden_size,
+            vocab_size,
+            token_counts=token_counts,
+            **output_layer_kwargs,
+        )
         reset_parameters(self.named_parameters(), gain=(2.5 * hidden_size) ** -0.5)
         # nn.init.normal_(self.embed.embedding.weight, mean=0, std=hidden_size**-0.5)
 
+    def embed_sequence(self, tokens, offset=0):
+        """Embed tokens and add positional encodings
+
+        Args:
+            tokens (torch.Tensor): [B, L] Token ids
+            offset (int): Position of the first token. Used in incremental decoding. Defaults to 0.
+
+        Returns:
+            torch.Tensor: [B, L, hidden_size] Embeddings. Rotary embeddings are applied in the attention layers
+        """
+        x = self.embed(tokens)
+
+        return self.pe(x, offset=offset) if self.pe is not None else x
+
     def forward(self, source, target, source_mask=None, target_mask=None):
-        source = self.embed(source)
-        target = self.embed(target)
-        # Adding embeddings + pos embeddings
-        # is done in PositionalEncoding class
-        source = self.pe(source)
-        target = self.pe(target)
+        source = self.embed_sequence(source)
+        target = self.embed_sequence(target)
         out = self.transformer_block(
             source, target, source_mask=source_mask, target_mask=target_mask
         )
         out = self.drop(out)
+
+        if self.output_layer != "softmax":
+            # The output layer computes the loss from the decoder outputs
+            return out
+
         out = self.predict(out)
 
         return out
 
+    def log_prob(self, out):
+        """Log-probabilities of the next tokens
+
+        Args:
+            out (torch.Tensor): [..., hidden_size] Decoder outputs
+
+        Returns:
+            torch.Tensor: [..., vocab_size] Log-probabilities
+        """
+
+        if self.output_layer != "softmax":
+            return self.predict.log_prob(out)
+
+        return F.log_softmax(self.predict(out), dim=-1)
+
+    def _decode_step(self, tokens, encoded, source_mask, cache, step):
+        """Log-probabilities of the next token, given the last generated tokens [B, 1]"""
+        target = self.embed_sequence(tokens, offset=step)
+        out = self.transformer_block.decoder(
+            target, encoded, source_mask=source_mask, cache=cache
+        )
+
+        return self.log_prob(self.drop(out[:, -1]))
+
+    @torch.no_grad()
+    def generate(
+        self,
+        source,
+        bos_idx,
+        eos_idx,
+        source_mask=None,
+        max_length=None,
+        beam_size=1,
+        length_penalty=1.0,
+        pad_idx=0,
+    ):
+        """Generate target sequences with greedy or beam search decoding
+
+        The decoder runs incrementally. Self-attention keys and values of previous positions are cached
+        in every layer and cross-attention keys and values are computed once per source.
+        The model should be in eval mode, so that dropout is disabled.
+
+        Args:
+            source (torch.Tensor): [B, L] Source token ids
+            bos_idx (int): Token id that starts target sequences
+            eos_idx (int): Token id that ends target sequences
+            source_mask (Optional[torch.Tensor]): [B, L] or [B, 1, L] source pad mask. Defaults to None.
+            max_length (Optional[int]): Maximum target length, including bos. Defaults to None,
+                which is the max_length of the model.
+            beam_size (int): Beam size. 1 is greedy decoding. Defaults to 1.
+            length_penalty (float): Final beam scores are sum of log-probabilities / length ** length_penalty.
+                Defaults to 1.0.
+            pad_idx (int): Token id used after eos. Defaults to 0.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: [B, T] generated token ids, starting with bos, and [B] scores
+        """
+        batch_size = source.size(0)
+        max_length = max_length if max_length is not None else self.max_length
+        encoded = self.transformer_block.encoder(
+            self.embed_sequence(source), attention_mask=source_mask
+        )
+
+        if beam_size > 1:
+            encoded = encoded.repeat_interleave(beam_size, dim=0)
+
+            if source_mask is not None:
+                source_mask = source_mask.repeat_interleave(beam_size, dim=0)
+
+        # Built once and reused by all decoding steps
+        source_mask = _shared_mask(source_mask)
+
+        num_hypotheses = batch_size * beam_size
+        cache = self.transformer_block.decoder.init_cache()
+        tokens = source.new_full((num_hypotheses, 1), bos_idx)
+        finished = torch.zeros(num_hypotheses, dtype=torch.bool, device=source.device)
+        lengths = torch.ones(num_hypotheses, device=source.device)
+        scores = torch.zeros(batch_size, beam_size, device=source.device)
+        # Only the first beam is active in the first step. The rest are duplicates
+        scores[:, 1:] = -float("inf")
+        scores = scores.view(-1)
+
+        for step in range(max_length - 1):
+            log_probs = self._decode_step(
+                tokens[:, -1:], encoded, source_mask, cache, step
+            )
+            vocab_size = log_probs.size(-1)
+            # Finished hypotheses keep their score and emit padding
+            log_probs[finished] = -float("inf")
+            log_probs[finished, pad_idx] = 0.0
+
+            candidates = (scores.unsqueeze(-1) + log_probs).view(batch_size, -1)
+            scores, indices = candidates.topk(beam_size, dim=-1)
+            beams = indices // vocab_size
+            next_tokens = (indices % vocab_size).view(-1)
+            beams = (
+                beams
+                + torch.arange(batch_size, device=source.device).unsqueeze(-1)
+                * beam_size
+            ).view(-1)
+            scores = scores.view(-1)
+
+            if beam_size > 1:
+                tokens = tokens.index_select(0, beams)
+                finished = finished.index_select(0, beams)
+                lengths = lengths.index_select(0, beams)
+                self.transformer_block.decoder.reorder_cache(cache, beams)
+
+            tokens = torch.cat([tokens, next_tokens.unsqueeze(-1)], dim=-1)
+            lengths = lengths + (~finished).float()
+            finished = finished | (next_tokens == eos_idx)
+
+            if finished.all():
+                break
+
+        normalized = (scores / lengths ** length_penalty).view(batch_size, beam_size)
+        best = normalized.argmax(dim=-1)
+        best = best + torch.arange(batch_size, device=source.device) * beam_size
+
+        return tokens[best], scores[best]
+
 
 class TransformerSequenceEncoder(nn.Module):
     def __init__(
@@ -407,10 +1035,19 @@ class TransformerSequenceEncoder(nn.Module):
         prenorm=True,
         scalenorm=True,
         feature_normalization=False,
+        performer=False,
+        num_random_features=256,
+        feature_redraw_interval=0,
+        window_size=None,
+        num_global_tokens=0,
+        checkpoint_activations=0,
+        varlen=False,
+        position_encoding="sinusoidal",
     ):
         super(TransformerSequenceEncoder, self).__init__()
+        self.varlen = varlen
         self.embed = nn.Linear(input_size, hidden_size)
-        self.pe = PositionalEncoding(embedding_dim=hidden_size, max_len=max_length)
+        self.pe = _positional_encoding(position_encoding, hidden_size, max_length)
         self.feature_norm = None
 
         if feature_normalization:
@@ -426,19 +1063,61 @@ class TransformerSequenceEncoder(nn.Module):
             kernel_size=kernel_size,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            performer=performer,
+            num_random_features=num_random_features,
+            feature_redraw_interval=feature_redraw_interval,
+            window_size=window_size,
+            num_global_tokens=num_global_tokens,
+            checkpoint_activations=checkpoint_activations,
+            rotary=position_encoding == "rotary",
         )
         self.out_size = hidden_size
         reset_parameters(self.named_parameters(), gain=(2.5 * hidden_size) ** -0.5)
 
-    def forward(self, x, attention_mask=None):
+    def embed_sequence(self, x, positions=None):
+        """Project the input features and add positional encodings
+
+        Args:
+            x (torch.Tensor): [B, L, input_size] Input features, or [T, input_size] unpadded tokens
+            positions (Optional[torch.Tensor]): Position of each unpadded token. Defaults to None.
+
+        Returns:
+            torch.Tensor: [B, L, hidden_size] (or [T, hidden_size]) Inputs of the first encoder layer
+        """
+
         if self.feature_norm:
             x = self.feature_norm(x)
 
         x = self.embed(x)
-        x = self.pe(x)
-        out = self.transformer_block(x, attention_mask=attention_mask).mean(dim=1)
 
-        return out
+        return self.pe(x, positions=positions) if self.pe is not None else x
+
+    def forward(self, x, attention_mask=None):
+        """Encode a batch of feature sequences to fixed size vectors
+
+        Args:
+            x (torch.Tensor): [B, L, input_size] Input features
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, L] zero-one pad mask.
+                With varlen=True, all layers except the attention kernels run on the valid tokens only.
+                Defaults to None.
+
+        Returns:
+            torch.Tensor: [B, hidden_size] Mean of the encoded valid positions
+        """
+        attention_mask = _shared_mask(attention_mask)
+        batch_size, seq_length = x.size(0), x.size(1)
+        indices, positions = None, None
+
+        if self.varlen and attention_mask is not None:
+            # x => (T, input_size)
+            indices = attention_mask.unpad_indices()
+            positions = indices % seq_length
+            x = unpad_sequences(x, indices)
+
+        x = self.embed_sequence(x, positions=positions)
+        out = self.transformer_block(x, attention_mask=attention_mask)
+
+        return _mean_pool(out, attention_mask, indices, batch_size, seq_length)
 
 
 class TransformerTokenSequenceEncoder(nn.Module):
@@ -456,8 +1135,28 @@ class TransformerTokenSequenceEncoder(nn.Module):
         kernel_size=None,
         prenorm=True,
         scalenorm=True,
+        performer=False,
+        num_random_features=256,
+        feature_redraw_interval=0,
+        window_size=None,
+        num_global_tokens=0,
+        checkpoint_activations=0,
+        varlen=False,
+        position_encoding="sinusoidal",
     ):
         super(TransformerTokenSequenceEncoder, self).__init__()
+        self.varlen = varlen
+        # Attention kernels that mix positions outside the block diagonal mask of packed batches
+        self.segment_unaware = [
+            name
+            for name, used in [
+                ("performer", performer),
+                ("nystrom", nystrom),
+                ("window_size", window_size is not None),
+                ("kernel_size", kernel_size is not None),
+            ]
+            if used
+        ]
         self.embed = Embed(
             vocab_size,
             hidden_size,
@@ -465,7 +1164,7 @@ class TransformerTokenSequenceEncoder(nn.Module):
             dropout=dropout,
             trainable=True,
         )
-        self.pe = PositionalEncoding(embedding_dim=hidden_size, max_len=max_length)
+        self.pe = _positional_encoding(position_encoding, hidden_size, max_length)
         self.transformer_block = Encoder(
             num_layers=num_layers,
             hidden_size=hidden_size,
@@ -477,14 +1176,88 @@ class TransformerTokenSequenceEncoder(nn.Module):
             kernel_size=kernel_size,
             prenorm=prenorm,
             scalenorm=scalenorm,
+            performer=performer,
+            num_random_features=num_random_features,
+            feature_redraw_interval=feature_redraw_interval,
+            window_size=window_size,
+            num_global_tokens=num_global_tokens,
+            checkpoint_activations=checkpoint_activations,
+            rotary=position_encoding == "rotary",
         )
         self.out_size = hidden_size
         reset_parameters(self.named_parameters(), gain=(2.5 * hidden_size) ** -0.5)
         # nn.init.normal_(self.embed.embedding.weight, mean=0, std=hidden_size**-0.5)
 
-    def forward(self, x, attention_mask=None):
+    def embed_sequence(self, x, positions=None):
+        """Embed the input tokens and add positional encodings
+
+        Args:
+            x (torch.Tensor): [B, L] Input token ids, or [T] unpadded tokens
+            positions (Optional[torch.Tensor]): Position of each token, for unpadded or packed inputs.
+                Defaults to None.
+
+        Returns:
+            torch.Tensor: [B, L, hidden_size] (or [T, hidden_size]) Inputs of the first encoder layer
+        """
         x = self.embed(x)
-        x = self.pe(x)
-        out = self.transformer_block(x, attention_mask=attention_mask).mean(dim=1)
 
-        return out
+        return self.pe(x, positions=positions) if self.pe is not None else x
+
+    def forward(self, x, attention_mask=None, segment_ids=None, position_ids=None):
+        """Encode a batch of token sequences to fixed size vectors
+
+        Packed batches, where each row contains several sequences, are encoded when segment_ids are given
+        (see slp.data.collators.PackedSequenceClassificationCollator). Each sequence attends only to itself
+        and is pooled separately.
+
+        Args:
+            x (torch.Tensor): [B, L] Input token ids
+            attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, L] zero-one pad mask.
+                With varlen=True, all layers except the attention kernels run on the valid tokens only.
+                For packed batches it defaults to the block diagonal mask of segment_ids. Defaults to None.
+            segment_ids (Optional[torch.Tensor]): [B, L] 1-based index of the sequence of each position in a packed
+                batch. 0 for padding. Defaults to None.
+            position_ids (Optional[torch.Tensor]): [B, L] position of each token in its sequence, for packed
+                batches. Derived from segment_ids if None. Not used with rotary embeddings, where attention
+                depends only on the relative positions inside each sequence. Defaults to None.
+
+        Returns:
+            torch.Tensor: [B, hidden_size] Mean of the encoded valid positions, or [N, hidden_size]
+                for the N sequences of a packed batch, ordered by segment id
+
+        Raises:
+            ValueError: If segment_ids are given and the encoder uses performer, nystrom, window_size or
+                kernel_size. These kernels do not respect the block diagonal mask and mix sequences
+        """
+
+        if segment_ids is not None:
+            if self.segment_unaware:
+                raise ValueError(
+                    f"Packed batches are not supported with {', '.join(self.segment_unaware)}. "
+                    "Use dense or chunked attention"
+                )
+
+            if attention_mask is None:
+                attention_mask = block_diagonal_mask(segment_ids)
+
+            if position_ids is None:
+                position_ids = segment_positions(segment_ids)
+            x = self.embed_sequence(x, positions=position_ids)
+            out = self.transformer_block(x, attention_mask=attention_mask)
+
+            return pool_segments(out, segment_ids, int(segment_ids.max()))
+
+        attention_mask = _shared_mask(attention_mask)
+        batch_size, seq_length = x.size(0), x.size(1)
+        indices, positions = None, None
+
+        if self.varlen and attention_mask is not None:
+            # x => (T,)
+            indices = attention_mask.unpad_indices()
+            positions = indices % seq_length
+            x = unpad_sequences(x, indices)
+
+        x = self.embed_sequence(x, positions=positions)
+        out = self.transformer_block(x, attention_mask=attention_mask)
+
+        return _mean_pool(out, attention_mask, indices, batch_size, seq_length)
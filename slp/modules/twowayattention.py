@@ -1,8 +1,8 @@
-import math
+from typing import List, Optional, Sequence, Tuple, Union
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from slp.modules.attention import AttentionMask, attention
 from slp.modules.norm import LayerNorm
 
 
@@ -22,12 +22,10 @@ class TwowayAttention(nn.Module):
         if input_size is None:
             input_size = attention_size
         self.dk = input_size
-        self.kx = nn.Linear(input_size, attention_size, bias=False)
-        self.qx = nn.Linear(input_size, attention_size, bias=False)
-        self.vx = nn.Linear(input_size, attention_size, bias=False)
-        self.ky = nn.Linear(input_size, attention_size, bias=False)
-        self.qy = nn.Linear(input_size, attention_size, bias=False)
-        self.vy = nn.Linear(input_size, attention_size, bias=False)
+        self.attention_size = attention_size
+        # Fused [k; q; v] projections of mod1 (x) and mod2 (y)
+        self.kqvx = nn.Linear(input_size, 3 * attention_size, bias=False)
+        self.kqvy = nn.Linear(input_size, 3 * attention_size, bias=False)
         self.drop = nn.Dropout(dropout)
         self.layernorm = False
 
@@ -37,6 +35,8 @@ class TwowayAttention(nn.Module):
             self.lny = LayerNorm(attention_size)
         self.residual = residual
         self._reset_parameters()
+        # Checkpoints with separate kx, qx, vx, ky, qy, vy layers
+        self._register_load_state_dict_pre_hook(self._stack_projections_hook)
 
     def forward(self, mod1, mod2, attention_mask=None):
         """
@@ -44,31 +44,47 @@ class TwowayAttention(nn.Module):
         queries : (B, L, D)
         values : (B, L, D)
         """
-        k_mod1 = self.kx(mod1)
-        q_mod2 = self.qy(mod2)
-        v_mod1 = self.vx(mod1)
 
-        k_mod2 = self.ky(mod2)  # (B, L, A)
-        q_mod1 = self.qx(mod1)
-        v_mod2 = self.vy(mod2)
+        if mod1.size(1) == mod2.size(1):
+            out_mod1, out_mod2 = batched_twoway_attention(
+                [self], [(mod1, mod2)], attention_mask=attention_mask
+            )[0]
 
-        # weights => (B, L, L)
+            return out_mod1, out_mod2
 
-        scores_mod1 = torch.bmm(q_mod2, k_mod1.transpose(1, 2)) / math.sqrt(self.dk)
-        scores_mod2 = torch.bmm(q_mod1, k_mod2.transpose(1, 2)) / math.sqrt(self.dk)
+        # Sequences of different lengths cannot be stacked. One fused projection per modality
+        k_mod1, q_mod1, v_mod1 = self.kqvx(mod1).chunk(3, dim=-1)
+        k_mod2, q_mod2, v_mod2 = self.kqvy(mod2).chunk(3, dim=-1)
 
-        if attention_mask is not None:
-            scores_mod1 = scores_mod1 + ((1 - attention_mask.unsqueeze(1)) * -1e5)
-            scores_mod2 = scores_mod2 + ((1 - attention_mask.unsqueeze(1)) * -1e5)
-        scores_mod1 = F.softmax(scores_mod1, dim=-1)
-        scores_mod1 = self.drop(scores_mod1)
-        scores_mod2 = F.softmax(scores_mod2, dim=-1)
-        scores_mod2 = self.drop(scores_mod2)
+        if attention_mask is not None and not isinstance(attention_mask, AttentionMask):
+            attention_mask = attention_mask.unsqueeze(1)
 
+        # Attention scores are not needed, so fused kernels are used when available
         # out => (B, L, A)
-        out_mod1 = torch.bmm(scores_mod1, v_mod1)
-        out_mod2 = torch.bmm(scores_mod2, v_mod2)
-
+        out_mod1, _ = attention(
+            k_mod1,
+            q_mod2,
+            v_mod1,
+            self.dk,
+            attention_mask=attention_mask,
+            dropout=self.drop.p,
+            training=self.training,
+            need_weights=False,
+        )
+        out_mod2, _ = attention(
+            k_mod2,
+            q_mod1,
+            v_mod2,
+            self.dk,
+            attention_mask=attention_mask,
+            dropout=self.drop.p,
+            training=self.training,
+            need_weights=False,
+        )
+
+        return self._output(out_mod1, out_mod2, mod1, mod2)
+
+    def _output(self, out_mod1, out_mod2, mod1, mod2):
         if self.layernorm:
             out_mod1 = self.lnx(out_mod1)
             out_mod2 = self.lny(out_mod2)
@@ -80,15 +96,103 @@ class TwowayAttention(nn.Module):
 
             # v + attention(v->a)
             # a + attention(a->v)
-            out_mod1 += mod2
-            out_mod2 += mod1
+            out_mod1 = out_mod1 + mod2
+            out_mod2 = out_mod2 + mod1
 
             return out_mod1, out_mod2
 
+    def _stack_projections_hook(self, state_dict, prefix, *args):
+        keys = [
+            f"{prefix}{name}.weight" for name in ["kx", "qx", "vx", "ky", "qy", "vy"]
+        ]
+
+        if all(key in state_dict for key in keys):
+            weights = [state_dict.pop(key) for key in keys]
+            state_dict[f"{prefix}kqvx.weight"] = torch.cat(weights[:3], dim=0)
+            state_dict[f"{prefix}kqvy.weight"] = torch.cat(weights[3:], dim=0)
+
+        if f"{prefix}kqv" in state_dict:
+            # [2, 3A, D] stacked projections of both modalities
+            kqvx, kqvy = state_dict.pop(f"{prefix}kqv")
+            state_dict[f"{prefix}kqvx.weight"] = kqvx
+            state_dict[f"{prefix}kqvy.weight"] = kqvy
+
     def _reset_parameters(self):
-        nn.init.xavier_uniform_(self.kx.weight)
-        nn.init.xavier_uniform_(self.qx.weight)
-        nn.init.xavier_uniform_(self.vx.weight)
-        nn.init.xavier_uniform_(self.ky.weight)
-        nn.init.xavier_uniform_(self.qy.weight)
-        nn.init.xavier_uniform_(self.vy.weight)
+        with torch.no_grad():
+            # Same initialization as six separate [A, D] projections
+            for projection in (self.kqvx, self.kqvy):
+                for weight in projection.weight.view(3, self.attention_size, -1):
+                    nn.init.xavier_uniform_(weight)
+
+
+def batched_twoway_attention(
+    modules: Sequence[TwowayAttention],
+    pairs: Sequence[Tuple[torch.Tensor, torch.Tensor]],
+    attention_mask: Optional[Union[torch.Tensor, AttentionMask]] = None,
+) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Run TwowayAttention modules for several modality pairs with one projection and one attention call
+
+    Both directions of all P pairs are stacked, so the projections run as a single batched matmul
+    over [2P, B * L, D] and the attention as a single call over [2P, B] sequences.
+    Dynamically quantized projections (slp.deploy.quantize_dynamic) run one by one.
+    Outputs are identical to calling each module separately.
+
+    All modalities must have the same shape. Dropout and the training mode are taken from the first module.
+
+    Args:
+        modules (Sequence[TwowayAttention]): One module per modality pair
+        pairs (Sequence[Tuple[torch.Tensor, torch.Tensor]]): [B, L, D] (mod1, mod2) inputs of each module
+        attention_mask (Optional[Union[torch.Tensor, AttentionMask]]): Optional [B, L] zero-one pad mask,
+            shared by all pairs. Defaults to None.
+
+    Returns:
+        List[Tuple[torch.Tensor, torch.Tensor]]: [B, L, A] (out_mod1, out_mod2) for each pair
+    """
+    num_pairs = len(pairs)
+    batch_size, seq_length, input_size = pairs[0][0].size()
+    attention_size = modules[0].attention_size
+
+    mods = [mod for pair in pairs for mod in pair]
+    projections = [p for m in modules for p in (m.kqvx, m.kqvy)]
+
+    if all(isinstance(p.weight, torch.Tensor) for p in projections):
+        # x => (2P, B * L, D), weight => (2P, 3A, D)
+        x = torch.stack(mods).view(2 * num_pairs, -1, input_size)
+        weight = torch.stack([p.weight for p in projections])
+        # (2P, B * L, 3A)
+        kqv = torch.matmul(x, weight.transpose(1, 2))
+    else:
+        # Quantized projections have packed weights, which cannot be stacked
+        kqv = torch.stack([p(mod) for p, mod in zip(projections, mods)])
+    k, q, v = kqv.view(2 * num_pairs, batch_size, seq_length, -1).chunk(3, dim=-1)
+
+    # Keys and values of each modality attend to the queries of the other modality in the pair
+    # Swap with stack instead of flip, which torch.compile (inductor) miscompiles before attention
+    q = q.reshape(num_pairs, 2, batch_size, seq_length, attention_size)
+    q = torch.stack([q[:, 1], q[:, 0]], dim=1)
+    q = q.reshape(2 * num_pairs, batch_size, seq_length, attention_size)
+
+    if isinstance(attention_mask, AttentionMask):
+        attention_mask = attention_mask.as_float(k.dtype)
+    elif attention_mask is not None:
+        attention_mask = attention_mask.unsqueeze(1)
+
+    # Attention scores are not needed, so fused kernels are used when available
+    # Pairs and directions are batched in the first dimension. The [B, 1, L] mask broadcasts
+    # out => (2P, B, L, A)
+    out, _ = attention(
+        k,
+        q,
+        v,
+        modules[0].dk,
+        attention_mask=attention_mask,
+        dropout=modules[0].drop.p,
+        training=modules[0].training,
+        need_weights=False,
+    )
+    out = out.view(num_pairs, 2, batch_size, seq_length, attention_size)
+
+    return [
+        m._output(out[i, 0], out[i, 1], mod1, mod2)
+        for i, (m, (mod1, mod2)) in enumerate(zip(modules, pairs))
+    ]
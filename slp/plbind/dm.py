@@ -1,5 +1,11 @@
 import argparse
-from typing import Any, Callable, List, Optional, Union
+import functools
+import inspect
+import itertools
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import numpy as np
 import pytorch_lightning as pl
@@ -11,6 +17,8 @@ from transformers import ALL_PRETRAINED_CONFIG_ARCHIVE_MAP
 
 from slp.data.corpus import HfCorpus, TokenizedCorpus, WordCorpus
 from slp.data.datasets import CorpusDataset, CorpusLMDataset
+from slp.data.prefetch import PrefetchDataLoader
+from slp.data.snapshot import read_snapshot, write_snapshot
 from slp.data.transforms import ToTensor
 from slp.util.types import dir_path
 
@@ -52,7 +60,34 @@ def split_data(dataset, test_size, seed):
     return train, test
 
 
+def worker_init(worker_id: int, num_threads: Optional[int] = None) -> None:
+    """Initialize a DataLoader worker process
+
+    * Propagate the per-worker seed torch has assigned to python and numpy. torch draws a new base seed
+      from the DataLoader generator every epoch, so seeding the generator makes the worker random
+      streams reproducible, while still different in each epoch.
+    * Limit the intra-op threads torch can use inside the worker.
+      On CPU-only nodes this avoids oversubscription, e.g. 8 workers x 8 threads on an 8 core machine.
+
+    Use functools.partial to bind num_threads, so that the resulting function can be
+    pickled for the "spawn" and "forkserver" multiprocessing contexts.
+
+    Args:
+        worker_id (int): Worker index, provided by the DataLoader
+        num_threads (Optional[int]): Number of torch threads in the worker. Defaults to None.
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+
+    if num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
 class PLDataModuleFromDatasets(pl.LightningDataModule):
+    # Constructor arguments that affect the contents of a snapshot
+    snapshot_keys: List[str] = ["val_percent", "test_percent", "seed", "no_test_set"]
+
     def __init__(
         self,
         train: Dataset,
@@ -65,6 +100,13 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
         seed: Optional[int] = None,
         num_workers: int = 1,
         pin_memory: bool = True,
+        persistent_workers: bool = False,
+        prefetch_factor: int = 2,
+        seed_workers: bool = False,
+        multiprocessing_context: Optional[str] = None,
+        num_threads_per_worker: Optional[int] = None,
+        prefetch_batches: int = 0,
+        prefetch_device: Optional[str] = None,
         drop_last: bool = False,
         sampler_train: Sampler = None,
         sampler_val: Sampler = None,
@@ -92,6 +134,21 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
             seed (Optional[int]): Seed for deterministic run. Defaults to None.
             num_workers (int): Number of workers in the DataLoader. Defaults to 1.
             pin_memory (bool): Pin tensors to GPU memory. Defaults to True.
+            persistent_workers (bool): Keep workers alive between epochs. Only used if num_workers > 0.
+                Defaults to False.
+            prefetch_factor (int): Number of batches loaded in advance by each worker.
+                Only used if num_workers > 0. Defaults to 2.
+            seed_workers (bool): Seed python, numpy and torch in each worker. The worker seeds are drawn
+                from a generator seeded with seed, so they are reproducible and change every epoch.
+                Defaults to False.
+            multiprocessing_context (Optional[str]): Multiprocessing context for the workers
+                [fork|spawn|forkserver]. Defaults to None, which uses the platform default.
+            num_threads_per_worker (Optional[int]): Call torch.set_num_threads in each worker.
+                Defaults to None.
+            prefetch_batches (int): Prepare this many batches ahead in a background thread using
+                slp.data.prefetch.PrefetchDataLoader. Defaults to 0 (disabled).
+            prefetch_device (Optional[str]): Move prefetched batches to this device in the background
+                thread. Only used if prefetch_batches > 0. Defaults to None.
             drop_last (bool): Drop last incomplete batch. Defaults to False.
             sampler_train (Sampler): Sampler for train loader. Defaults to None.
             sampler_val (Sampler): Sampler for validation loader. Defaults to None.
@@ -134,6 +191,13 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
         self.batch_sampler_test = batch_sampler_test
         self.num_workers = num_workers
         self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.seed_workers = seed_workers
+        self.multiprocessing_context = multiprocessing_context
+        self.num_threads_per_worker = num_threads_per_worker
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_device = prefetch_device
         self.drop_last = drop_last
 
         self.shuffle_eval = shuffle_eval
@@ -217,6 +281,62 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
 
         self.setup_has_run = True
 
+    def _worker_kwargs(self) -> Dict[str, Any]:
+        """DataLoader keyword arguments that control the worker processes
+
+        persistent_workers, prefetch_factor and multiprocessing_context are only
+        valid when num_workers > 0, so they are omitted otherwise.
+
+        Returns:
+            Dict[str, Any]: Keyword arguments to pass to the DataLoader
+        """
+        kwargs: Dict[str, Any] = {
+            "num_workers": self.num_workers,
+            "pin_memory": self.pin_memory,
+        }
+
+        if self.num_workers <= 0:
+            return kwargs
+
+        kwargs["persistent_workers"] = self.persistent_workers
+        kwargs["prefetch_factor"] = self.prefetch_factor
+
+        if self.multiprocessing_context is not None:
+            kwargs["multiprocessing_context"] = self.multiprocessing_context
+
+        if self.seed_workers or self.num_threads_per_worker is not None:
+            kwargs["worker_init_fn"] = functools.partial(
+                worker_init, num_threads=self.num_threads_per_worker
+            )
+
+        if self.seed_workers and self.seed is not None:
+            # Worker seeds are drawn from the generator. Reproducible, but different in each epoch
+            kwargs["generator"] = torch.Generator().manual_seed(self.seed)
+
+        return kwargs
+
+    def _make_loader(self, dataset: Dataset, **kwargs) -> DataLoader:
+        """Create a DataLoader, or a PrefetchDataLoader if prefetch_batches > 0
+
+        Args:
+            dataset (Dataset): Dataset to load
+            **kwargs: Extra DataLoader arguments
+
+        Returns:
+            DataLoader: The configured DataLoader
+        """
+
+        if self.prefetch_batches > 0:
+            return PrefetchDataLoader(
+                dataset,
+                prefetch_batches=self.prefetch_batches,
+                device=self.prefetch_device,
+                **self._worker_kwargs(),
+                **kwargs,
+            )
+
+        return DataLoader(dataset, **self._worker_kwargs(), **kwargs)
+
     def train_dataloader(self) -> DataLoader:
         """Configure train DataLoader
 
@@ -224,11 +344,9 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
             DataLoader: Pytorch DataLoader for train set
         """
 
-        return DataLoader(
+        return self._make_loader(
             self.train,
             batch_size=self.batch_size if self.batch_sampler_train is None else 1,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
             drop_last=self.drop_last and (self.batch_sampler_train is None),
             sampler=self.sampler_train,
             batch_sampler=self.batch_sampler_train,
@@ -242,11 +360,9 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
         Returns:
             DataLoader: Pytorch DataLoader for validation set
         """
-        val = DataLoader(
+        val = self._make_loader(
             self.val,
             batch_size=self.batch_size_eval if self.batch_sampler_val is None else 1,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
             drop_last=self.drop_last and (self.batch_sampler_val is None),
             sampler=self.sampler_val,
             batch_sampler=self.batch_sampler_val,
@@ -267,11 +383,9 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
             DataLoader: Pytorch DataLoader for test set
         """
 
-        return DataLoader(
+        return self._make_loader(
             self.test,
             batch_size=self.batch_size_eval if self.batch_sampler_test is None else 1,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
             drop_last=self.drop_last and (self.batch_sampler_test is None),
             sampler=self.sampler_test,
             batch_sampler=self.batch_sampler_test,
@@ -283,6 +397,221 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
             collate_fn=self.collate_fn,
         )
 
+    def tune_loader(
+        self,
+        num_batches: int = 50,
+        num_workers: Optional[List[int]] = None,
+        num_threads_per_worker: Optional[List[Optional[int]]] = None,
+        persistent_workers: Optional[List[bool]] = None,
+        apply: bool = True,
+    ) -> Dict[str, Any]:
+        """Benchmark DataLoader configurations on the train set and pick the fastest one
+
+        Iterates num_batches from the train DataLoader for every combination of the provided
+        values and measures the throughput. The first batch is excluded from the
+        measurement, so that worker startup time does not dominate short runs.
+        When apply=True the fastest configuration is stored in this data module and is used by
+        the train_dataloader, val_dataloader and test_dataloader methods.
+
+        If a grid is not provided a sensible default for the current machine is used:
+
+        * num_workers: 0, 1, 2, 4, ... up to os.cpu_count()
+        * num_threads_per_worker: 1 and cpu_count // num_workers
+        * persistent_workers: the current value
+
+        Example:
+            >>> ldm = PLDataModuleFromDatasets(train, batch_size=32, collate_fn=collate_fn)
+            >>> ldm.setup()
+            >>> best = ldm.tune_loader(num_batches=100)
+            >>> best
+            {'num_workers': 4, 'num_threads_per_worker': 1, 'persistent_workers': False, 'batches_per_sec': 152.3}
+
+        Args:
+            num_batches (int): Number of batches to load for each configuration. Defaults to 50.
+            num_workers (Optional[List[int]]): Candidate values for num_workers. Defaults to None.
+            num_threads_per_worker (Optional[List[Optional[int]]]): Candidate values for
+                num_threads_per_worker. Defaults to None.
+            persistent_workers (Optional[List[bool]]): Candidate values for persistent_workers.
+                Defaults to None.
+            apply (bool): Keep the fastest configuration. Defaults to True.
+
+        Returns:
+            Dict[str, Any]: The fastest configuration and its throughput in batches / sec
+        """
+        if not self.setup_has_run:
+            self.setup()
+
+        cpu_count = os.cpu_count() or 1
+
+        if num_workers is None:
+            num_workers = [0] + [
+                2 ** i
+                for i in range(int(np.log2(cpu_count)) + 1)
+                if 2 ** i <= cpu_count
+            ]
+
+        if persistent_workers is None:
+            persistent_workers = [self.persistent_workers]
+
+        current = {
+            "num_workers": self.num_workers,
+            "num_threads_per_worker": self.num_threads_per_worker,
+            "persistent_workers": self.persistent_workers,
+        }
+
+        results = []
+
+        for nw, pw in itertools.product(num_workers, persistent_workers):
+            if nw == 0 and pw:
+                # Persistence is meaningless without worker processes
+                continue
+
+            if nw == 0:
+                thread_grid: List[Optional[int]] = [None]
+            elif num_threads_per_worker is None:
+                thread_grid = sorted({1, max(1, cpu_count // nw)})
+            else:
+                thread_grid = num_threads_per_worker
+
+            for nt in thread_grid:
+                self.num_workers = nw
+                self.num_threads_per_worker = nt
+                self.persistent_workers = pw
+                elapsed, loaded = self._time_loader(num_batches)
+                bps = loaded / elapsed if elapsed > 0 else float("inf")
+                logger.info(
+                    f"num_workers={nw} num_threads_per_worker={nt} persistent_workers={pw}: {bps:.2f} batches/sec"
+                )
+                results.append(
+                    {
+                        "num_workers": nw,
+                        "num_threads_per_worker": nt,
+                        "persistent_workers": pw,
+                        "batches_per_sec": bps,
+                    }
+                )
+
+        best = max(results, key=lambda r: r["batches_per_sec"])
+        logger.info(f"Fastest DataLoader configuration: {best}")
+
+        chosen = best if apply else current
+        self.num_workers = chosen["num_workers"]
+        self.num_threads_per_worker = chosen["num_threads_per_worker"]
+        self.persistent_workers = chosen["persistent_workers"]
+
+        return best
+
+    def _time_loader(self, num_batches: int):
+        """Time loading num_batches from the train DataLoader
+
+        Args:
+            num_batches (int): Number of batches to load
+
+        Returns:
+            Tuple[float, int]: (elapsed seconds, number of timed batches)
+        """
+        loader_iter = iter(self.train_dataloader())
+        # Exclude worker startup from the measurement
+        next(loader_iter, None)
+        loaded = 0
+        start = time.perf_counter()
+
+        for _ in range(num_batches):
+            if next(loader_iter, None) is None:
+                break
+            loaded += 1
+        elapsed = time.perf_counter() - start
+        del loader_iter
+
+        return elapsed, loaded
+
+    def _snapshot_config(self) -> Dict[str, Any]:
+        """Preprocessing configuration stored with snapshots
+
+        Returns:
+            Dict[str, Any]: Values of self.snapshot_keys
+        """
+
+        return {k: getattr(self, k) for k in self.snapshot_keys}
+
+    @classmethod
+    def _snapshot_config_from_kwargs(cls, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """Preprocessing configuration that the constructor would produce for kwargs
+
+        Args:
+            kwargs (Dict[str, Any]): Constructor keyword arguments
+
+        Returns:
+            Dict[str, Any]: Values of cls.snapshot_keys, filled with the constructor defaults
+        """
+        params = inspect.signature(cls.__init__).parameters
+        config = {k: params[k].default for k in cls.snapshot_keys}
+        config.update({k: v for k, v in kwargs.items() if k in cls.snapshot_keys})
+
+        return config
+
+    def save_snapshot(self, path: str) -> None:
+        """Save the fully preprocessed train, validation and test sets
+
+        Samples are saved after all transforms are applied, in the memory mapped layout of
+        slp.data.snapshot. The snapshot is versioned and tagged with a hash of the
+        preprocessing configuration. Use from_snapshot to restore it and skip preprocessing.
+
+        Args:
+            path (str): Snapshot directory. Must not exist, be empty or contain a previous snapshot
+
+        Raises:
+            ValueError: If path exists and is neither a snapshot nor an empty directory
+        """
+
+        if not self.setup_has_run:
+            self.setup()
+
+        splits = {"train": self.train, "val": self.val}
+
+        if not self.no_test_set:
+            splits["test"] = self.test
+        write_snapshot(
+            path,
+            splits,  # type: ignore
+            self._snapshot_config(),
+            corpus=self._snapshot_corpus(),
+        )
+
+    def _snapshot_corpus(self) -> Optional[Any]:
+        return None
+
+    @classmethod
+    def from_snapshot(cls, path: str, mmap: bool = True, **kwargs):
+        """Create a data module from a snapshot saved with save_snapshot
+
+        Keyword arguments are the usual constructor arguments. Preprocessing arguments
+        (self.snapshot_keys) are validated against the configuration stored in the snapshot.
+        DataLoader arguments (batch size, workers, samplers, collate_fn etc.) can be freely changed.
+
+        Args:
+            path (str): Snapshot directory
+            mmap (bool): Memory map the saved arrays instead of loading them in memory. Defaults to True.
+            **kwargs: Constructor keyword arguments
+
+        Returns:
+            PLDataModuleFromDatasets: The restored data module
+
+        Examples:
+            >>> dm = PLDataModuleFromDatasets(train, batch_size=32, seed=42)
+            >>> dm.save_snapshot("cache/snapshot")
+            >>> dm = PLDataModuleFromDatasets.from_snapshot("cache/snapshot", batch_size=64, seed=42)
+        """
+        splits, _ = read_snapshot(
+            path, cls._snapshot_config_from_kwargs(kwargs), mmap=mmap
+        )
+        params = inspect.signature(cls.__init__).parameters
+        kwargs = {k: v for k, v in kwargs.items() if k in params}
+
+        return cls(
+            splits["train"], val=splits["val"], test=splits.get("test"), **kwargs
+        )
+
     @classmethod
     def add_argparse_args(
         cls, parent_parser: argparse.ArgumentParser
@@ -343,6 +672,61 @@ class PLDataModuleFromDatasets(pl.LightningDataModule):
             help="Don't pin data to GPU memory when transferring",
         )
 
+        parser.add_argument(
+            "--persistent-workers",
+            dest="data.persistent_workers",
+            action="store_true",
+            help="Keep DataLoader workers alive between epochs",
+        )
+
+        parser.add_argument(
+            "--prefetch-factor",
+            dest="data.prefetch_factor",
+            type=int,
+            default=2,
+            help="Number of batches loaded in advance by each DataLoader worker",
+        )
+
+        parser.add_argument(
+            "--seed-workers",
+            dest="data.seed_workers",
+            action="store_true",
+            help="Seed python, numpy and torch in each DataLoader worker. Reproducible with --seed",
+        )
+
+        parser.add_argument(
+            "--multiprocessing-context",
+            dest="data.multiprocessing_context",
+            type=str,
+            choices=["fork", "spawn", "forkserver"],
+            default=None,
+            help="Multiprocessing context for DataLoader workers. Defaults to platform default",
+        )
+
+        parser.add_argument(
+            "--num-threads-per-worker",
+            dest="data.num_threads_per_worker",
+            type=int,
+            default=None,
+            help="Number of torch intra-op threads in each DataLoader worker",
+        )
+
+        parser.add_argument(
+            "--prefetch-batches",
+            dest="data.prefetch_batches",
+            type=int,
+            default=0,
+            help="Number of batches to prepare ahead in a background thread. 0 disables prefetching",
+        )
+
+        parser.add_argument(
+            "--prefetch-device",
+            dest="data.prefetch_device",
+            type=str,
+            default=None,
+            help="Move prefetched batches to this device in the background thread",
+        )
+
         parser.add_argument(
             "--drop-last",
             dest="data.drop_last",
@@ -364,6 +748,10 @@ class PLDataModuleFromCorpus(PLDataModuleFromDatasets):
     accepted_tokenizers: List[str] = ["tokenized", "spacy"] + list(
         ALL_PRETRAINED_CONFIG_ARCHIVE_MAP.keys()
     )
+    snapshot_keys: List[str] = PLDataModuleFromDatasets.snapshot_keys + [
+        "language_model",
+        "tokenizer",
+    ]
 
     def __init__(
         self,
@@ -380,6 +768,13 @@ class PLDataModuleFromCorpus(PLDataModuleFromDatasets):
         seed: int = None,
         num_workers: int = 1,
         pin_memory: bool = True,
+        persistent_workers: bool = False,
+        prefetch_factor: int = 2,
+        seed_workers: bool = False,
+        multiprocessing_context: Optional[str] = None,
+        num_threads_per_worker: Optional[int] = None,
+        prefetch_batches: int = 0,
+        prefetch_device: Optional[str] = None,
         drop_last: bool = False,
         shuffle_eval: bool = False,
         sampler_train: Sampler = None,
@@ -414,6 +809,13 @@ class PLDataModuleFromCorpus(PLDataModuleFromDatasets):
             seed (Optional[int]): Seed for deterministic run. Defaults to None.
             num_workers (int): Number of workers in the DataLoader. Defaults to 1.
             pin_memory (bool): Pin tensors to GPU memory. Defaults to True.
+            persistent_workers (bool): Keep workers alive between epochs. Defaults to False.
+            prefetch_factor (int): Number of batches loaded in advance by each worker. Defaults to 2.
+            seed_workers (bool): Seed each worker from a generator seeded with seed. Defaults to False.
+            multiprocessing_context (Optional[str]): Multiprocessing context for the workers. Defaults to None.
+            num_threads_per_worker (Optional[int]): Call torch.set_num_threads in each worker. Defaults to None.
+            prefetch_batches (int): Batches to prepare ahead in a background thread. Defaults to 0.
+            prefetch_device (Optional[str]): Move prefetched batches to this device. Defaults to None.
             drop_last (bool): Drop last incomplete batch. Defaults to False.
             sampler_train (Sampler): Sampler for train loader. Defaults to None.
             sampler_val (Sampler): Sampler for validation loader. Defaults to None.
@@ -452,6 +854,13 @@ class PLDataModuleFromCorpus(PLDataModuleFromDatasets):
             seed=seed,
             num_workers=num_workers,
             pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor,
+            seed_workers=seed_workers,
+            multiprocessing_context=multiprocessing_context,
+            num_threads_per_worker=num_threads_per_worker,
+            prefetch_batches=prefetch_batches,
+            prefetch_device=prefetch_device,
             drop_last=drop_last,
             shuffle_eval=shuffle_eval,
             sampler_train=sampler_train,
@@ -477,7 +886,7 @@ class PLDataModuleFromCorpus(PLDataModuleFromDatasets):
             test_corpus, test_labels = zip(*self.test)  # type: ignore
 
         self.train_corpus, self.val_corpus, self.test_corpus = self._create_corpora(
-            train_corpus, val_corpus, test_corpus, self.corpus_args
+            train_corpus, val_corpus, test_corpus, dict(self.corpus_args)
         )
 
         to_tensor = ToTensor(device="cpu")
@@ -588,6 +997,53 @@ class PLDataModuleFromCorpus(PLDataModuleFromDatasets):
 
         return train_corpus, val_corpus, test_corpus
 
+    def _snapshot_config(self) -> Dict[str, Any]:
+        config = super(PLDataModuleFromCorpus, self)._snapshot_config()
+        config["corpus_args"] = self.corpus_args
+
+        return config
+
+    @classmethod
+    def _snapshot_config_from_kwargs(cls, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        config = super(PLDataModuleFromCorpus, cls)._snapshot_config_from_kwargs(kwargs)
+        params = inspect.signature(cls.__init__).parameters
+        config["corpus_args"] = {k: v for k, v in kwargs.items() if k not in params}
+
+        return config
+
+    def _snapshot_corpus(self) -> Optional[Any]:
+        return self.train_corpus
+
+    @classmethod
+    def from_snapshot(cls, path: str, mmap: bool = True, **kwargs):
+        """Create a data module from a snapshot saved with save_snapshot
+
+        Skips tokenization, vocabulary creation and embeddings loading. The vocabulary and the
+        embeddings matrix are restored from the snapshot.
+
+        Args:
+            path (str): Snapshot directory
+            mmap (bool): Memory map the saved arrays instead of loading them in memory. Defaults to True.
+            **kwargs: Constructor keyword arguments, including extra corpus arguments
+
+        Returns:
+            PLDataModuleFromCorpus: The restored data module
+
+        Examples:
+            >>> dm = PLDataModuleFromCorpus.from_snapshot("cache/snapshot", **config.data)
+            >>> dm.vocab_size, dm.embeddings
+        """
+        splits, corpus = read_snapshot(
+            path, cls._snapshot_config_from_kwargs(kwargs), mmap=mmap
+        )
+        # Raw corpora are not needed. Datasets and vocabulary come from the snapshot
+        dm = cls([], train_labels=[], **kwargs)
+        dm.train, dm.val, dm.test = splits["train"], splits["val"], splits.get("test")
+        dm.train_corpus = corpus
+        dm.setup_has_run = True
+
+        return dm
+
     @property
     def embeddings(self) -> Optional[np.ndarray]:
         """Embeddings matrix
@@ -610,6 +1066,32 @@ class PLDataModuleFromCorpus(PLDataModuleFromDatasets):
 
         return vsz
 
+    @property
+    def token_counts(self) -> List[int]:
+        """Occurence count of each token id in the training corpus, e.g. for adaptive softmax clusters
+
+        Special tokens and tokens missing from the training corpus have zero counts
+
+        Raises:
+            ValueError: If the corpus has no word level vocabulary, e.g. with huggingface tokenizers
+            ValueError: If the counts are not available, e.g. in snapshots saved without them
+
+        Returns:
+            List[int]: Count of each token id
+        """
+        frequencies = self.train_corpus.frequencies
+        idx2word = self.train_corpus.idx2word
+
+        if idx2word is None:
+            raise ValueError("Token counts require a word level vocabulary")
+
+        if frequencies is None:
+            raise ValueError(
+                "Token counts are not available. Save the snapshot again to include them"
+            )
+
+        return [frequencies.get(idx2word.get(i), 0) for i in range(self.vocab_size)]
+
     @classmethod
     def add_argparse_args(cls, parent_parser):
         """Augment input parser with arguments for data loading and corpus processing
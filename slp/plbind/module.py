@@ -1,3 +1,4 @@
+import contextlib
 from abc import ABC, abstractmethod
 from argparse import Namespace
 from typing import Any, Dict, List, Optional, Tuple, Union, cast
@@ -8,7 +9,13 @@ import torch.nn as nn
 from loguru import logger
 from omegaconf import DictConfig
 from slp.config.omegaconf import OmegaConf
-from slp.util.pytorch import pad_mask, subsequent_mask
+from slp.modules.classifier import TransformerEarlyExitClassifier
+from slp.util.pytorch import (
+    block_diagonal_mask,
+    cached_subsequent_mask,
+    is_low_precision,
+    pad_mask,
+)
 from slp.util.system import print_separator
 from slp.util.types import Configuration, LossType
 from torch.optim import Optimizer
@@ -178,14 +185,26 @@ class _TransformerClassification(_Predictor):
         Comes from slp.data.collators.SequentialCollator.
         Create pad masks to be passed to transformer attention
 
+        Packed batches from slp.data.collators.PackedSequenceClassificationCollator also contain
+        segment ids and position ids. A block diagonal mask is created for them
+
         Args:
-            batch (Tuple[torch.Tensor]): (inputs)
+            batch (Tuple[torch.Tensor]): (inputs, targets, lengths) or
+                (inputs, targets, lengths, segment_ids, position_ids)
 
         Returns:
-            Tuple[torch.Tensor, torch.Tensor]: (inputs, inputs)
+            Tuple[torch.Tensor, ...]: (inputs, targets, attention_mask), followed by
+                (segment_ids, position_ids) for packed batches
         """
         inputs = batch[0]
         targets = batch[1]
+
+        if len(batch) == 5:
+            segment_ids, position_ids = batch[3], batch[4]
+            attention_mask = block_diagonal_mask(segment_ids)
+
+            return inputs, targets, attention_mask, segment_ids, position_ids
+
         lengths = batch[2]
         attention_mask = pad_mask(lengths, max_length=inputs.size(1))
 
@@ -200,11 +219,38 @@ class _TransformerClassification(_Predictor):
             model (nn.Module): Model to use for prediction
             batch (Tuple[torch.Tensor, torch.Tensor]): (inputs, inputs)
 
+        Early exit models (slp.modules.classifier.TransformerEarlyExitClassifier) return the logits of all exits
+        in training mode. These are flattened to [E * B, C] and the targets are repeated for each exit,
+        so that all exit heads are trained jointly.
+
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: (logits, inputs)
         """
-        inputs, targets, attention_mask = self.parse_batch(batch)
-        y_pred = model(inputs, attention_mask=attention_mask)
+        inputs, targets, attention_mask, *packing = self.parse_batch(batch)
+
+        if packing:
+            # One prediction per packed example, in the original example order
+            segment_ids, position_ids = packing
+            y_pred = model(
+                inputs,
+                attention_mask=attention_mask,
+                segment_ids=segment_ids,
+                position_ids=position_ids,
+            )
+        else:
+            y_pred = model(inputs, attention_mask=attention_mask)
+
+        # SimplePLModule passes itself during validation and test
+        classifier = model.model if isinstance(model, SimplePLModule) else model
+
+        if (
+            isinstance(classifier, TransformerEarlyExitClassifier)
+            and classifier.training
+        ):
+            # [E, B, C] logits of all exits. The loss is averaged over the exits
+            num_exits = y_pred.size(0)
+            targets = targets.squeeze().repeat(num_exits)
+            y_pred = y_pred.flatten(0, 1)
 
         return y_pred.squeeze(), targets.squeeze()
 
@@ -282,8 +328,8 @@ class _Transformer(_Predictor):
             lengths_targets,
             max_length=targets.size(1),
         )
-        sub_m = subsequent_mask(targets.size(1))  # type: ignore
-        pad_targets = pad_targets.unsqueeze(-2) * sub_m.to(pad_targets.device)
+        sub_m = cached_subsequent_mask(targets.size(1), pad_targets.device)
+        pad_targets = pad_targets.unsqueeze(-2) * sub_m
 
         return inputs, targets, pad_inputs, pad_targets
 
@@ -370,6 +416,7 @@ class SimplePLModule(pl.LightningModule):
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         predictor_cls=_Classification,
         calculate_perplexity: bool = False,  # for LM. Dirty but much more efficient
+        autocast_dtype: Optional[torch.dtype] = None,
     ):
         """Wraps a (model, optimizer, criterion, lr_scheduler) tuple in a LightningModule
 
@@ -387,9 +434,25 @@ class SimplePLModule(pl.LightningModule):
                     get_predictions_and_targets method. Defaults to _Classification.
             calculate_perplexity (bool, optional): Whether to calculate perplexity.
                     Would be cleaner as a metric, but this is more efficient. Defaults to False.
+            autocast_dtype (Optional[torch.dtype], optional): Run the forward pass and the loss under
+                    torch.autocast with this dtype, e.g. torch.bfloat16 for mixed precision training on CPUs
+                    with native bfloat16 support (AVX512-BF16 / AMX) or on Ampere GPUs. Weights, gradients and
+                    optimizer states stay in float32. Loss and metrics are computed on float32 outputs.
+                    Use it instead of the trainer precision, which only supports float16 on GPU.
+                    Defaults to None (no autocast).
+
+        Raises:
+            ValueError: If autocast_dtype is set and torch.autocast is not available (pytorch < 1.10)
         """
         super(SimplePLModule, self).__init__()
+
+        if autocast_dtype is not None and not hasattr(torch, "autocast"):
+            raise ValueError(
+                f"autocast_dtype={autocast_dtype} requires torch.autocast (pytorch >= 1.10). "
+                f"Found pytorch {torch.__version__}"
+            )
         self.calculate_perplexity = calculate_perplexity
+        self.autocast_dtype = autocast_dtype
         self.model = model
         self.optimizer = optimizer
         self.lr_scheduler = lr_scheduler
@@ -440,6 +503,38 @@ class SimplePLModule(pl.LightningModule):
 
         return self.model(*args, **kwargs)
 
+    def _autocast(self):
+        """Autocast context for the forward pass
+
+        Returns:
+            ContextManager: torch.autocast on the module device with autocast_dtype, or a no-op
+        """
+
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype)
+
+    def _predict(self, model, batch):
+        """Run the predictor and the criterion, under autocast if autocast_dtype is set
+
+        Args:
+            model (nn.Module): Model passed to the predictor
+            batch (Tuple[torch.Tensor, ...]): Input batch
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: (float32 predictions, targets, float32 loss)
+        """
+        with self._autocast():
+            y_hat, targets = self.predictor.get_predictions_and_targets(model, batch)
+            loss = self.criterion(y_hat, targets)
+
+        if is_low_precision(y_hat.dtype):
+            # Metrics accumulate in float32
+            y_hat = y_hat.float()
+
+        return y_hat, targets, loss.float()
+
     def _compute_metrics(self, metrics, loss, y_hat, targets, mode="train"):
         """Compute all metrics and aggregate in a dict
 
@@ -516,8 +611,7 @@ class SimplePLModule(pl.LightningModule):
         Returns:
             Dict[str, torch.Tensor]: computed metrics
         """
-        y_hat, targets = self.predictor.get_predictions_and_targets(self.model, batch)
-        loss = self.criterion(y_hat, targets)
+        y_hat, targets, loss = self._predict(self.model, batch)
         metrics = self._compute_metrics(
             self.train_metrics, loss, y_hat, targets, mode="train"
         )
@@ -553,8 +647,7 @@ class SimplePLModule(pl.LightningModule):
         Returns:
             Dict[str, torch.Tensor]: computed metrics
         """
-        y_hat, targets = self.predictor.get_predictions_and_targets(self, batch)
-        loss = self.criterion(y_hat, targets)
+        y_hat, targets, loss = self._predict(self, batch)
         metrics = self._compute_metrics(
             self.val_metrics, loss, y_hat, targets, mode="val"
         )
@@ -592,8 +685,7 @@ class SimplePLModule(pl.LightningModule):
         Returns:
             Dict[str, torch.Tensor]: computed metrics
         """
-        y_hat, targets = self.predictor.get_predictions_and_targets(self, batch)
-        loss = self.criterion(y_hat, targets)
+        y_hat, targets, loss = self._predict(self, batch)
         metrics = self._compute_metrics(
             self.test_metrics, loss, y_hat, targets, mode="test"
         )
@@ -620,6 +712,7 @@ class PLModule(SimplePLModule):
         hparams: Configuration = None,
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         calculate_perplexity=False,
+        autocast_dtype=None,
     ):
         """Pass arguments through to base class"""
         super(PLModule, self).__init__(
@@ -631,6 +724,7 @@ class PLModule(SimplePLModule):
             hparams=hparams,
             metrics=metrics,
             calculate_perplexity=calculate_perplexity,
+            autocast_dtype=autocast_dtype,
         )
 
 
@@ -644,6 +738,7 @@ class AutoEncoderPLModule(SimplePLModule):
         hparams: Configuration = None,
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         calculate_perplexity=False,
+        autocast_dtype=None,
     ):
         """Pass arguments through to base class"""
         super(AutoEncoderPLModule, self).__init__(
@@ -655,6 +750,7 @@ class AutoEncoderPLModule(SimplePLModule):
             hparams=hparams,
             metrics=metrics,
             calculate_perplexity=calculate_perplexity,
+            autocast_dtype=autocast_dtype,
         )
 
 
@@ -668,6 +764,7 @@ class RnnPLModule(SimplePLModule):
         hparams: Configuration = None,
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         calculate_perplexity=False,
+        autocast_dtype=None,
     ):
         """Pass arguments through to base class"""
         super(RnnPLModule, self).__init__(
@@ -679,6 +776,7 @@ class RnnPLModule(SimplePLModule):
             hparams=hparams,
             metrics=metrics,
             calculate_perplexity=calculate_perplexity,
+            autocast_dtype=autocast_dtype,
         )
 
 
@@ -692,6 +790,7 @@ class TransformerClassificationPLModule(SimplePLModule):
         hparams: Configuration = None,
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         calculate_perplexity=False,
+        autocast_dtype=None,
     ):
         """Pass arguments through to base class"""
         super(TransformerClassificationPLModule, self).__init__(
@@ -703,6 +802,7 @@ class TransformerClassificationPLModule(SimplePLModule):
             hparams=hparams,
             metrics=metrics,
             calculate_perplexity=calculate_perplexity,
+            autocast_dtype=autocast_dtype,
         )
 
 
@@ -711,13 +811,24 @@ class TransformerPLModule(SimplePLModule):
         self,
         model: nn.Module,
         optimizer: Union[Optimizer, List[Optimizer]],
-        criterion: LossType,
+        criterion: Optional[LossType],
         lr_scheduler: Union[_LRScheduler, List[_LRScheduler]] = None,
         hparams: Configuration = None,
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         calculate_perplexity=False,
+        autocast_dtype=None,
     ):
-        """Pass arguments through to base class"""
+        """Pass arguments through to base class
+
+        Models with an adaptive or sampled softmax output layer (slp.modules.softmax) return hidden states,
+        and their output layer model.predict is the loss. It is used when criterion is None.
+        Sampled softmax computes the exact full softmax loss in eval mode, so validation and test
+        perplexity are exact.
+        """
+
+        if criterion is None:
+            criterion = model.predict
+
         super(TransformerPLModule, self).__init__(
             model,
             optimizer,
@@ -727,6 +838,7 @@ class TransformerPLModule(SimplePLModule):
             hparams=hparams,
             metrics=metrics,
             calculate_perplexity=calculate_perplexity,
+            autocast_dtype=autocast_dtype,
         )
 
 
@@ -740,6 +852,7 @@ class BertPLModule(SimplePLModule):
         hparams: Configuration = None,
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         calculate_perplexity=False,
+        autocast_dtype=None,
     ):
         """Pass arguments through to base class"""
         super(BertPLModule, self).__init__(
@@ -751,6 +864,7 @@ class BertPLModule(SimplePLModule):
             hparams=hparams,
             metrics=metrics,
             calculate_perplexity=calculate_perplexity,
+            autocast_dtype=autocast_dtype,
         )
 
 
@@ -764,6 +878,7 @@ class MultimodalTransformerClassificationPLModule(SimplePLModule):
         hparams: Configuration = None,
         metrics: Optional[Dict[str, pl.metrics.Metric]] = None,
         calculate_perplexity=False,
+        autocast_dtype=None,
     ):
         """Pass arguments through to base class"""
         super(MultimodalTransformerClassificationPLModule, self).__init__(
@@ -775,4 +890,5 @@ class MultimodalTransformerClassificationPLModule(SimplePLModule):
             hparams=hparams,
             metrics=metrics,
             calculate_perplexity=calculate_perplexity,
+            autocast_dtype=autocast_dtype,
         )
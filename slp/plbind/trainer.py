@@ -384,7 +384,9 @@ def make_trainer(
         gpus (int, optional): number of GPUs to use. Defaults to 0.
         check_val_every_n_epoch (int, optional): Run validation every n epochs. Defaults to 1.
         gradient_clip_val (float, optional): Clip gradient norm value. Defaults to 0 (no clipping).
-        precision (int, optional): Floating point precision. Defaults to 32.
+        precision (int, optional): Floating point precision. 16 enables native amp on GPU. For bfloat16
+            mixed precision (e.g. on CPU) keep 32 and pass autocast_dtype=torch.bfloat16 to the PLModule.
+            Defaults to 32.
         num_nodes (int): Number of nodes to run on
         max_epochs (Optional[int], optional): Maximum number of epochs for training. Defaults to 100.
         max_steps (Optional[int], optional): Maximum number of steps for training. Defaults to None.
@@ -542,7 +544,9 @@ def make_trainer_for_ray_tune(
         stochastic_weight_avg (bool, optional): Use stochastic weight averaging. Defaults to False.
         gpus (int, optional): number of GPUs to use. Defaults to 0.
         gradient_clip_val (float, optional): Clip gradient norm value. Defaults to 0 (no clipping).
-        precision (int, optional): Floating point precision. Defaults to 32.
+        precision (int, optional): Floating point precision. 16 enables native amp on GPU. For bfloat16
+            mixed precision (e.g. on CPU) keep 32 and pass autocast_dtype=torch.bfloat16 to the PLModule.
+            Defaults to 32.
         max_epochs (Optional[int], optional): Maximum number of epochs for training. Defaults to 100.
         max_steps (Optional[int], optional): Maximum number of steps for training. Defaults to None.
         truncated_bptt_steps (Optional[int], optional): Truncated back prop breaks performs backprop every k steps of much longer
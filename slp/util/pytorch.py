@@ -1,4 +1,7 @@
+import contextlib
 import copy
+import functools
+import inspect
 from typing import Callable, List, Optional, Tuple, Union, cast
 
 import torch
@@ -6,6 +9,13 @@ import torch.nn as nn
 from loguru import logger
 from slp.util import system, types
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint as _torch_checkpoint
+
+_CHECKPOINT_KWARGS = (
+    {"use_reentrant": False}
+    if "use_reentrant" in inspect.signature(_torch_checkpoint).parameters
+    else {}
+)
 
 
 class NoOp(nn.Module):
@@ -98,6 +108,8 @@ def pad_mask(
     Args:
         lengths (torch.Tensor): Original sequence lengths before padding
         max_length (Optional[Union[torch.Tensor, int]], optional): Maximum sequence length. Defaults to None.
+            If None, it is read from lengths, which synchronizes with the device and breaks torch.compile graphs.
+            Pass the padded length, e.g. x.size(1), in modules.
 
     Returns:
         torch.Tensor: padding mask
@@ -112,6 +124,132 @@ def pad_mask(
     return mask
 
 
+def unpad_sequences(x: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """Gather the valid positions of a padded batch into a flat tensor of tokens
+
+    Args:
+        x (torch.Tensor): [B, L, *] Padded batch
+        indices (torch.Tensor): [T] Indices of the valid positions in the flattened [B * L] batch
+
+    Returns:
+        torch.Tensor: [T, *] Unpadded tokens, ordered by sequence and position
+    """
+
+    return x.flatten(0, 1).index_select(0, indices)
+
+
+def pad_unpadded_sequences(
+    x: torch.Tensor, indices: torch.Tensor, batch_size: int, max_length: int
+) -> torch.Tensor:
+    """Scatter unpadded tokens back to a zero padded batch. Inverse of unpad_sequences
+
+    Args:
+        x (torch.Tensor): [T, *] Unpadded tokens
+        indices (torch.Tensor): [T] Indices of the tokens in the flattened [B * L] batch
+        batch_size (int): Batch size B
+        max_length (int): Padded sequence length L
+
+    Returns:
+        torch.Tensor: [B, L, *] Padded batch
+    """
+    out = x.new_zeros(batch_size * max_length, *x.shape[1:])
+    out = out.index_copy(0, indices, x)
+
+    return out.view(batch_size, max_length, *x.shape[1:])
+
+
+def masked_mean(x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Mean over the valid positions of each sequence
+
+    Args:
+        x (torch.Tensor): [B, L, D] Padded batch
+        mask (torch.Tensor): [B, L] zero-one pad mask
+
+    Returns:
+        torch.Tensor: [B, D] Mean of the valid positions
+    """
+    mask = mask.to(x.dtype).unsqueeze(-1)
+
+    return (x * mask).sum(1) / mask.sum(1).clamp(min=1)
+
+
+def unpadded_mean(
+    x: torch.Tensor, indices: torch.Tensor, batch_size: int, max_length: int
+) -> torch.Tensor:
+    """Mean over the tokens of each sequence, for unpadded tokens
+
+    Same result as masked_mean on the padded batch, without re-padding
+
+    Args:
+        x (torch.Tensor): [T, D] Unpadded tokens
+        indices (torch.Tensor): [T] Indices of the tokens in the flattened [B * L] batch
+        batch_size (int): Batch size B
+        max_length (int): Padded sequence length L
+
+    Returns:
+        torch.Tensor: [B, D] Mean of the tokens of each sequence
+    """
+    sequence = indices // max_length
+    lengths = torch.bincount(sequence, minlength=batch_size).clamp(min=1)
+    out = x.new_zeros(batch_size, x.size(-1)).index_add(0, sequence, x)
+
+    return out / lengths.unsqueeze(-1).to(x.dtype)
+
+
+def block_diagonal_mask(segment_ids: torch.Tensor) -> torch.Tensor:
+    """Attention mask for packed sequences, where each position attends only to its own segment
+
+    Args:
+        segment_ids (torch.Tensor): [B, L] segment id of each position. 0 for padding
+
+    Returns:
+        torch.Tensor: [B, L, L] boolean block diagonal mask
+    """
+    same_segment = segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2)
+
+    return same_segment & (segment_ids != 0).unsqueeze(-2)
+
+
+def segment_positions(segment_ids: torch.Tensor) -> torch.Tensor:
+    """Position of each token in its own segment, for packed sequences
+
+    Args:
+        segment_ids (torch.Tensor): [B, L] segment id of each position. Segments are contiguous
+
+    Returns:
+        torch.Tensor: [B, L] position ids, restarting from 0 at the start of each segment
+    """
+    idx = torch.arange(segment_ids.size(-1), device=segment_ids.device).expand_as(
+        segment_ids
+    )
+    starts = torch.ones_like(segment_ids, dtype=torch.bool)
+    starts[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    start_idx = torch.where(starts, idx, torch.zeros_like(idx)).cummax(-1)[0]
+
+    return idx - start_idx
+
+
+def pool_segments(
+    x: torch.Tensor, segment_ids: torch.Tensor, num_segments: int
+) -> torch.Tensor:
+    """Mean of the positions of each segment of packed sequences
+
+    Args:
+        x (torch.Tensor): [B, L, D] Packed sequences
+        segment_ids (torch.Tensor): [B, L] segment id of each position, from 1 to num_segments. 0 for padding
+        num_segments (int): Total number of segments in the batch
+
+    Returns:
+        torch.Tensor: [num_segments, D] Mean of each segment. Row i corresponds to segment id i + 1
+    """
+    ids = segment_ids.flatten()
+    lengths = torch.bincount(ids, minlength=num_segments + 1)[1:].clamp(min=1)
+    out = x.new_zeros(num_segments + 1, x.size(-1))
+    out = out.index_add(0, ids, x.flatten(0, 1))[1:]
+
+    return out / lengths.unsqueeze(-1).to(x.dtype)
+
+
 def subsequent_mask(max_length: int) -> torch.Tensor:
     """Generate subsequent (lower triangular) mask for transformer autoregressive tasks
 
@@ -127,6 +265,27 @@ def subsequent_mask(max_length: int) -> torch.Tensor:
     return mask.triu().t().unsqueeze(0).contiguous()  # type: ignore
 
 
+@functools.lru_cache(maxsize=16)
+def cached_subsequent_mask(
+    max_length: int, device: Optional[torch.device] = None
+) -> torch.Tensor:
+    """Boolean subsequent mask, cached by (max_length, device)
+
+    Avoids building a new [L, L] mask for every batch. The returned tensor is shared, so it must
+    not be modified in place
+
+    Args:
+        max_length (int): Maximum sequence length
+        device (Optional[torch.device]): Device of the mask. Defaults to None (cpu).
+
+    Returns:
+        torch.Tensor: [1, L, L] boolean subsequent mask
+    """
+    mask = torch.ones(max_length, max_length, dtype=torch.bool, device=device)
+
+    return mask.tril().unsqueeze(0)
+
+
 def sort_sequences(
     inputs: torch.Tensor, lengths: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor, Callable[[torch.Tensor], torch.Tensor]]:
@@ -330,34 +489,203 @@ def shift_tensor(l: torch.Tensor, n: int = 1) -> torch.Tensor:
     return out
 
 
-def moore_penrose_pinv(x, num_iter=6):
+def _add_to_diagonal_(x: torch.Tensor, value: float) -> torch.Tensor:
+    """In-place x + value * I for a batch of square matrices, without allocating an identity
+
+    While tracing or compiling the sum is computed out of place, because in-place updates of
+    the diagonal view are not exported correctly to ONNX. Always use the returned tensor
+    """
+
+    if is_compiling():
+        return x + value * torch.eye(x.size(-1), dtype=x.dtype, device=x.device)
+
+    x.diagonal(dim1=-2, dim2=-1).add_(value)
+
+    return x
+
+
+def _pinv_residual(xz: torch.Tensor, out: Optional[torch.Tensor] = None) -> float:
+    """Maximum residual ||I - x z||_F over a batch of matrices"""
+    residual = _add_to_diagonal_(torch.neg(xz, out=out), 1.0)
+
+    return residual.norm(dim=(-2, -1)).max().item()
+
+
+def moore_penrose_pinv(
+    x: torch.Tensor, num_iter: int = 6, tol: Optional[float] = None
+) -> torch.Tensor:
     """Calculate approximate Moore-Penrose pseudoinverse, via iterative method
 
     * Method is described in (Razavi et al 2014) https://www.hindawi.com/journals/aaa/2014/563787/
     * Implementation modified from lucidrains https://github.com/lucidrains/nystrom-attention/blob/main/nystrom_attention/nystrom_attention.py#L13
 
+    Each matrix is normalized separately. The constant identity terms are added in place to the diagonal.
+    When gradients are not needed, the iterations reuse four preallocated buffers, except while
+    tracing or compiling.
+
     Args:
         x (torch.Tensor): (*, M, M) The square tensors to inverse.
             Dimension * can be any number of additional dimensions, e.g. (batch_size, num_heads, M, M)
-        num_iter (int): Number of iterations to run for approximation (6 is good enough usually)
+        num_iter (int): Maximum number of iterations to run for approximation (6 is good enough usually)
+        tol (Optional[float]): Stop early when the residual ||I - x z||_F of all matrices is below tol.
+            Checking the residual synchronizes with the device once per iteration. Defaults to None.
     Returns:
         (torch.Tensor): (B, H, N, N) The approximate Moore-Penrose pseudoinverse of mat
     """
     abs_x = torch.abs(x)
     col = abs_x.sum(dim=-1)
     row = abs_x.sum(dim=-2)
-    z = x.transpose(-1, -2).contiguous()
-    z = z / (torch.max(col) * torch.max(row))
+    # Normalize each matrix separately. A global max over the batch slows convergence
+    # for all matrices but the one with the largest norm
+    z = x.transpose(-1, -2) / (
+        col.max(dim=-1, keepdim=True)[0] * row.max(dim=-1, keepdim=True)[0]
+    ).unsqueeze(-1)
 
-    I = torch.eye(x.shape[-1], device=x.device).unsqueeze(0)
+    if (torch.is_grad_enabled() and x.requires_grad) or is_compiling():
+        # Out-of-place iterations. Preallocated buffers cannot be traced or exported
+        for _ in range(num_iter):
+            xz = x @ z
+
+            if tol is not None and _pinv_residual(xz) < tol:
+                break
+            t = _add_to_diagonal_(-xz, 7.0)
+            t = _add_to_diagonal_(-(xz @ t), 15.0)
+            t = _add_to_diagonal_(-(xz @ t), 13.0)
+            z = 0.25 * z @ t
+
+        return z
+
+    z = z.contiguous()
+    xz, t1, t2, z_next = [torch.empty_like(z) for _ in range(4)]
 
     for _ in range(num_iter):
-        xz = x @ z
-        z = 0.25 * z @ (13 * I - (xz @ (15 * I - (xz @ (7 * I - xz)))))
+        torch.matmul(x, z, out=xz)
+
+        if tol is not None and _pinv_residual(xz, out=t1) < tol:
+            break
+        _add_to_diagonal_(torch.neg(xz, out=t1), 7.0)
+        _add_to_diagonal_(torch.matmul(xz, t1, out=t2).neg_(), 15.0)
+        _add_to_diagonal_(torch.matmul(xz, t2, out=t1).neg_(), 13.0)
+        torch.matmul(z, t1, out=z_next).mul_(0.25)
+        z, z_next = z_next, z
 
     return z
 
 
+_RECOMPUTE_DEPTH = 0
+
+
+def is_recomputing() -> bool:
+    """Is the current forward pass a recomputation of a checkpointed function?
+
+    Modules with side effects in forward (e.g. counters, buffer updates) should skip them
+    while recomputing, so they run once per step and the recomputed activations match
+
+    Returns:
+        bool: True inside the backward pass recomputation of checkpoint
+    """
+
+    return _RECOMPUTE_DEPTH > 0
+
+
+def is_compiling() -> bool:
+    """Is the current forward pass traced by torch.compile or torch.jit?
+
+    Modules skip python side effects that break the compiled graph (e.g. RNN.flatten_parameters)
+
+    Returns:
+        bool: True while tracing with torch.compile (pytorch >= 2.0), torch.jit.script or torch.jit.trace
+    """
+    dynamo = getattr(torch, "_dynamo", None)
+
+    if dynamo is not None and dynamo.is_compiling():
+        return True
+
+    return torch.jit.is_scripting() or torch.jit.is_tracing()
+
+
+def is_low_precision(dtype: torch.dtype) -> bool:
+    """Is dtype a 16 bit floating point type (float16 or bfloat16)?"""
+
+    return dtype in (torch.float16, torch.bfloat16)
+
+
+def autocast_disabled(device_type: str = "cuda"):
+    """Context manager that disables autocast, e.g. for computations that need float32 precision
+
+    Tensors created or computed inside keep their dtype. Inputs must be cast explicitly
+
+    Args:
+        device_type (str): Device type of the autocast region to disable, e.g. x.device.type. Defaults to "cuda".
+
+    Returns:
+        ContextManager: torch.autocast(device_type, enabled=False), or a no-op for pytorch < 1.10
+    """
+
+    if not hasattr(torch, "autocast"):
+        return contextlib.nullcontext()
+
+    return torch.autocast(device_type, enabled=False)
+
+
+def safe_softmax(x: torch.Tensor, dim: int = -1) -> torch.Tensor:
+    """Softmax computed in float32 for float16 / bfloat16 inputs
+
+    The exponentials and the normalization are accumulated in float32 and the result is cast back
+    to the input dtype, so that low precision and autocast runs match float32 runs closely
+
+    Args:
+        x (torch.Tensor): Input logits
+        dim (int): Softmax dimension. Defaults to -1.
+
+    Returns:
+        torch.Tensor: Probabilities, with the dtype of x
+    """
+
+    if not is_low_precision(x.dtype):
+        return torch.softmax(x, dim=dim)
+
+    return torch.softmax(x, dim=dim, dtype=torch.float32).to(x.dtype)
+
+
+def checkpoint(function: Callable, *args, preserve_rng_state: bool = True):
+    """Run function with activation checkpointing
+
+    Intermediate activations are not stored in the forward pass and are recomputed
+    during the backward pass. Wraps torch.utils.checkpoint.checkpoint and uses the
+    non-reentrant implementation when the installed pytorch version supports it.
+    is_recomputing() is True while function is recomputed.
+
+    Args:
+        function (Callable): Function to run
+        *args: Function arguments
+        preserve_rng_state (bool): Restore RNG state for recomputation, so that dropout masks are
+            identical in the forward and backward pass. Defaults to True.
+
+    Returns:
+        Any: function(*args)
+    """
+    calls = [0]
+
+    def run(*inputs):
+        global _RECOMPUTE_DEPTH
+        recomputing = calls[0] > 0
+        calls[0] += 1
+
+        if not recomputing:
+            return function(*inputs)
+
+        _RECOMPUTE_DEPTH += 1
+        try:
+            return function(*inputs)
+        finally:
+            _RECOMPUTE_DEPTH -= 1
+
+    return _torch_checkpoint(
+        run, *args, preserve_rng_state=preserve_rng_state, **_CHECKPOINT_KWARGS
+    )
+
+
 def pad_sequence(
     sequences: List[torch.Tensor],
     batch_first: bool = False,
@@ -0,0 +1,694 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from slp.modules.attention import (
+    Attention,
+    AttentionMask,
+    MultiheadAttention,
+    MultiheadSelfAttention,
+    SelfAttention,
+    attention,
+    causal_nystrom_attention,
+    chunked_attention,
+    gaussian_orthogonal_random_matrix,
+    nystrom_attention,
+    performer_attention,
+    sliding_window_attention,
+)
+from slp.modules.fuse import AttentionFuser
+from slp.modules.transformer import Encoder
+from slp.modules.twowayattention import TwowayAttention
+from slp.util.pytorch import moore_penrose_pinv, pad_mask, subsequent_mask
+
+requires_sdpa = pytest.mark.skipif(
+    not hasattr(F, "scaled_dot_product_attention"),
+    reason="F.scaled_dot_product_attention requires pytorch >= 2.0",
+)
+
+B, H, L, M, A = 3, 4, 11, 7, 32
+LENGTHS = torch.tensor([11, 6, 1])
+
+
+def _pad(max_length=L):
+    return pad_mask(LENGTHS, max_length=max_length)
+
+
+def _masks(num_queries):
+    """Masks in all the shapes accepted by attention, with their names"""
+    pad = _pad()
+    masks = {
+        "none": None,
+        "pad_[B,1,1,L]": pad[:, None, None, :],
+        "pad_[B,1,M,L]": pad[:, None, None, :].expand(B, 1, num_queries, L),
+        "pad_[B,H,1,L]": pad[:, None, None, :].expand(B, H, 1, L),
+        "fully_masked_row": torch.zeros(B, 1, 1, L),
+    }
+
+    if num_queries == L:
+        masks["pad+subsequent_[B,1,L,L]"] = (pad.unsqueeze(1) * subsequent_mask(L))[
+            :, None
+        ]
+
+    return masks
+
+
+def _inputs(num_queries):
+    torch.manual_seed(0)
+    k = torch.randn(B, H, L, A // H)
+    q = torch.randn(B, H, num_queries, A // H)
+    v = torch.randn(B, H, L, A // H)
+
+    return k, q, v
+
+
+@requires_sdpa
+@pytest.mark.parametrize("num_queries", [L, M])
+@pytest.mark.parametrize("dk", [A // H, A])
+def test_sdpa_parity_multihead(num_queries, dk):
+    k, q, v = _inputs(num_queries)
+
+    for name, mask in _masks(num_queries).items():
+        ref, scores = attention(
+            k, q, v, dk, attention_mask=mask, dropout=0.0, training=False
+        )
+        out, no_scores = attention(
+            k,
+            q,
+            v,
+            dk,
+            attention_mask=mask,
+            dropout=0.0,
+            training=False,
+            need_weights=False,
+        )
+        assert scores is not None
+        assert no_scores is None
+        assert torch.allclose(ref, out, atol=1e-5), name
+
+
+@requires_sdpa
+def test_sdpa_parity_single_head():
+    torch.manual_seed(0)
+    k, q, v = torch.randn(B, L, A), torch.randn(B, M, A), torch.randn(B, L, A)
+    pad = _pad()
+
+    for mask in [None, pad.unsqueeze(1), pad.unsqueeze(1).expand(B, M, L)]:
+        ref, _ = attention(k, q, v, A, attention_mask=mask, dropout=0.0, training=False)
+        out, _ = attention(
+            k,
+            q,
+            v,
+            A,
+            attention_mask=mask,
+            dropout=0.0,
+            training=False,
+            need_weights=False,
+        )
+        assert torch.allclose(ref, out, atol=1e-5)
+
+
+@requires_sdpa
+def test_sdpa_parity_gradients():
+    k, q, v = [t.requires_grad_() for t in _inputs(L)]
+    mask = _masks(L)["pad+subsequent_[B,1,L,L]"]
+    ref, _ = attention(k, q, v, A // H, attention_mask=mask, dropout=0.0)
+    ref_grads = torch.autograd.grad(ref.sum(), (k, q, v))
+    out, _ = attention(
+        k, q, v, A // H, attention_mask=mask, dropout=0.0, need_weights=False
+    )
+    grads = torch.autograd.grad(out.sum(), (k, q, v))
+
+    for g1, g2 in zip(ref_grads, grads):
+        assert torch.allclose(g1, g2, atol=1e-5)
+
+
+@pytest.mark.parametrize("module_cls", [MultiheadAttention, MultiheadSelfAttention])
+@pytest.mark.parametrize("mask_kind", ["none", "pad", "pad+subsequent"])
+def test_module_need_weights_parity(module_cls, mask_kind):
+    torch.manual_seed(0)
+    module = module_cls(attention_size=A, num_heads=H, dropout=0.0).eval()
+    x = torch.randn(B, L, A)
+    pad = _pad()
+    mask = {
+        "none": None,
+        "pad": pad,
+        "pad+subsequent": pad.unsqueeze(1) * subsequent_mask(L),
+    }[mask_kind]
+
+    ref, scores = module(x, attention_mask=mask)
+    out, no_scores = module(x, attention_mask=mask, need_weights=False)
+
+    assert scores.shape == (B, H, L, L)
+    assert no_scores is None
+    assert torch.allclose(ref, out, atol=1e-5)
+
+
+@pytest.mark.parametrize("module_cls", [Attention, SelfAttention])
+def test_single_head_need_weights_parity(module_cls):
+    torch.manual_seed(0)
+    module = module_cls(attention_size=A, dropout=0.0).eval()
+    x = torch.randn(B, L, A)
+    ref, scores = module(x, attention_mask=_pad())
+    out, no_scores = module(x, attention_mask=_pad(), need_weights=False)
+
+    assert scores.shape == (B, L, L)
+    assert no_scores is None
+    assert torch.allclose(ref, out, atol=1e-5)
+
+
+def test_encoder_need_weights():
+    torch.manual_seed(0)
+    encoder = Encoder(
+        num_layers=2, hidden_size=A, num_heads=H, inner_size=64, dropout=0.0
+    ).eval()
+    x = torch.randn(B, L, A)
+    out = encoder(x, attention_mask=_pad())
+    out_with_weights, weights = encoder(x, attention_mask=_pad(), need_weights=True)
+
+    assert torch.allclose(out, out_with_weights, atol=1e-5)
+    assert [w.shape for w in weights] == [(B, H, L, L)] * 2
+
+
+def _dense_causal(k, q, v, dk, pad=None):
+    mask = subsequent_mask(k.size(-2)).unsqueeze(1)
+
+    if pad is not None:
+        mask = pad[:, None, None, :] * mask
+
+    out, _ = attention(k, q, v, dk, attention_mask=mask, dropout=0.0, training=False)
+
+    return out
+
+
+@pytest.mark.parametrize("seq_length", [L, 16])
+def test_causal_nystrom_exact_with_one_token_segments(seq_length):
+    torch.manual_seed(0)
+    k, q, v = [torch.randn(B, H, seq_length, A // H) for _ in range(3)]
+    pad = pad_mask(torch.tensor([seq_length, 6, 1]), max_length=seq_length)
+    ref = _dense_causal(k, q, v, A // H, pad=pad)
+    out, _ = causal_nystrom_attention(
+        k,
+        q,
+        v,
+        A // H,
+        seq_length,
+        attention_mask=pad[:, None, None, :],
+        dropout=0.0,
+        training=False,
+    )
+
+    for b, length in enumerate([seq_length, 6, 1]):
+        assert torch.allclose(ref[b, :, :length], out[b, :, :length], atol=1e-5)
+
+
+@pytest.mark.parametrize("num_landmarks", [1, 3, 4, 8])
+@pytest.mark.parametrize("module_cls", [MultiheadAttention, MultiheadSelfAttention])
+def test_causal_nystrom_no_future_leak(num_landmarks, module_cls):
+    torch.manual_seed(0)
+    seq_length = 37
+    module = module_cls(
+        attention_size=A,
+        num_heads=H,
+        dropout=0.0,
+        nystrom=True,
+        num_landmarks=num_landmarks,
+        causal=True,
+    ).eval()
+    x = torch.randn(B, seq_length, A)
+    mask = pad_mask(torch.tensor([37, 20, 9]), max_length=seq_length).unsqueeze(
+        1
+    ) * subsequent_mask(seq_length)
+    out, _ = module(x, attention_mask=mask)
+
+    for t in [0, 5, 17, 30]:
+        perturbed = x.clone()
+        perturbed[:, t + 1 :] = torch.randn_like(perturbed[:, t + 1 :])
+        out_perturbed, _ = module(perturbed, attention_mask=mask)
+        assert torch.allclose(out[:, : t + 1], out_perturbed[:, : t + 1], atol=1e-5)
+        assert not torch.allclose(out[:, t + 1 :], out_perturbed[:, t + 1 :])
+
+
+def test_causal_nystrom_encoder_no_future_leak():
+    torch.manual_seed(0)
+    seq_length = 40
+    encoder = Encoder(
+        num_layers=2,
+        hidden_size=A,
+        num_heads=H,
+        inner_size=64,
+        dropout=0.0,
+        nystrom=True,
+        num_landmarks=8,
+        causal=True,
+    ).eval()
+    x = torch.randn(2, seq_length, A)
+    out = encoder(x, attention_mask=subsequent_mask(seq_length))
+    perturbed = x.clone()
+    perturbed[:, 25:] = 0
+    out_perturbed = encoder(perturbed, attention_mask=subsequent_mask(seq_length))
+    assert torch.allclose(out[:, :25], out_perturbed[:, :25], atol=1e-5)
+
+
+def test_nystrom_exact_for_ragged_lengths():
+    # With one landmark per valid token, nystrom attention is exact for every sequence
+    torch.manual_seed(0)
+    k, q, v = [0.5 * torch.randn(2, H, 20, A // H) for _ in range(3)]
+    mask = pad_mask(torch.tensor([20, 12]), max_length=20)
+    ref, _ = attention(
+        k, q, v, A // H, attention_mask=mask[:, None, None, :], dropout=0.0
+    )
+
+    for num_landmarks, length in [(20, 20), (12, 12)]:
+        b = 0 if length == 20 else 1
+        out, _ = nystrom_attention(
+            k,
+            q,
+            v,
+            A // H,
+            num_landmarks,
+            attention_mask=mask,
+            inverse_iterations=30,
+            dropout=0.0,
+        )
+        assert torch.allclose(out[b, :, :length], ref[b, :, :length], atol=1e-4)
+
+
+@pytest.mark.parametrize("module_cls", [MultiheadAttention, MultiheadSelfAttention])
+def test_nystrom_module_keeps_positions(module_cls):
+    # Outputs must stay aligned with the inputs for lengths that are not a multiple of num_landmarks
+    torch.manual_seed(0)
+    module = module_cls(
+        attention_size=A,
+        num_heads=H,
+        dropout=0.0,
+        nystrom=True,
+        num_landmarks=30,
+        inverse_iterations=30,
+    ).eval()
+    x = torch.randn(2, 30, A)
+    out, _ = module(x[:, :29], attention_mask=torch.ones(2, 29))
+
+    assert out.shape == (2, 29, A)
+    # 29 tokens and 30 landmarks: still one landmark per token, so exact attention over 29 tokens
+    module.nystrom = False
+    dense, _ = module(x[:, :29])
+    assert torch.allclose(out, dense, atol=1e-3)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 64])
+def test_performer_causal_matches_quadratic_form(chunk_size):
+    # Chunked prefix sums must equal the explicit masked kernel attention
+    torch.manual_seed(0)
+    k, q, v = [torch.randn(B, H, 23, A // H) for _ in range(3)]
+    projection = gaussian_orthogonal_random_matrix(64, A // H)
+    out, _ = performer_attention(
+        k, q, v, A // H, projection, causal=True, chunk_size=chunk_size
+    )
+    ref, _ = performer_attention(
+        k, q, v, A // H, projection, causal=True, chunk_size=23
+    )
+
+    assert torch.allclose(out, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize("module_cls", [MultiheadAttention, MultiheadSelfAttention])
+def test_performer_causal_no_future_leak(module_cls):
+    torch.manual_seed(0)
+    seq_length = 40
+    module = module_cls(
+        attention_size=A, num_heads=H, dropout=0.0, performer=True, causal=True
+    ).eval()
+    x = torch.randn(B, seq_length, A)
+    mask = subsequent_mask(seq_length)
+    out, scores = module(x, attention_mask=mask)
+    perturbed = x.clone()
+    perturbed[:, 25:] = 10 * torch.randn_like(perturbed[:, 25:])
+    out_perturbed, _ = module(perturbed, attention_mask=mask)
+
+    assert scores is None
+    assert torch.allclose(out[:, :25], out_perturbed[:, :25], atol=1e-5)
+
+
+def _window_mask(seq_length, window_size, num_global_tokens, causal):
+    i = torch.arange(seq_length)[:, None]
+    j = torch.arange(seq_length)[None, :]
+    mask = ((j - i).abs() <= window_size) | (j < num_global_tokens)
+    mask = mask | (i < num_global_tokens)
+
+    if causal:
+        mask = mask & (j <= i)
+
+    return mask.float()
+
+
+@pytest.mark.parametrize("seq_length", [1, 16, 23])
+@pytest.mark.parametrize("window_size", [1, 4, 8])
+@pytest.mark.parametrize("num_global_tokens", [0, 2])
+@pytest.mark.parametrize("causal", [False, True])
+def test_sliding_window_matches_dense_masked(
+    seq_length, window_size, num_global_tokens, causal
+):
+    torch.manual_seed(0)
+    k, q, v = [torch.randn(B, H, seq_length, A // H) for _ in range(3)]
+    lengths = [seq_length, max(1, seq_length // 2), 1]
+    pad = pad_mask(torch.tensor(lengths), max_length=seq_length)
+    mask = pad[:, None, None, :] * _window_mask(
+        seq_length, window_size, num_global_tokens, causal
+    )
+    ref, _ = attention(k, q, v, A // H, attention_mask=mask, dropout=0.0)
+    out, scores = sliding_window_attention(
+        k,
+        q,
+        v,
+        A // H,
+        window_size,
+        attention_mask=pad,
+        num_global_tokens=num_global_tokens,
+        causal=causal,
+        dropout=0.0,
+    )
+
+    assert scores is None
+
+    for b, length in enumerate(lengths):
+        assert torch.allclose(out[b, :, :length], ref[b, :, :length], atol=1e-5)
+
+
+def test_sliding_window_encoder_matches_dense_masked():
+    torch.manual_seed(0)
+    seq_length = 30
+    encoder = Encoder(
+        num_layers=2,
+        hidden_size=A,
+        num_heads=H,
+        inner_size=64,
+        dropout=0.0,
+        window_size=4,
+        num_global_tokens=1,
+    ).eval()
+    x = torch.randn(2, seq_length, A)
+    pad = pad_mask(torch.tensor([30, 17]), max_length=seq_length)
+    out = encoder(x, attention_mask=pad)
+
+    for layer in encoder.encoder:
+        layer.l1.sublayer.window_size = None
+    mask = pad.unsqueeze(1) * _window_mask(seq_length, 4, 1, False)
+    ref = encoder(x, attention_mask=mask)
+
+    assert torch.allclose(out[0], ref[0], atol=1e-5)
+    assert torch.allclose(out[1, :17], ref[1, :17], atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"causal": True},
+        {"chunk_size": 4},
+        {"nystrom": True, "num_landmarks": 4},
+        {"nystrom": True, "num_landmarks": 4, "causal": True},
+        {"performer": True, "num_random_features": 16},
+        {"window_size": 3},
+        {"kernel_size": 3},
+    ],
+)
+@pytest.mark.parametrize("module_cls", [MultiheadSelfAttention, MultiheadAttention])
+def test_attention_mask_matches_tensor_mask(module_cls, kwargs):
+    torch.manual_seed(0)
+    module = module_cls(attention_size=A, num_heads=H, dropout=0.0, **kwargs).eval()
+    x = torch.randn(B, L, A)
+    pad = _pad()
+    ref, _ = module(x, attention_mask=pad, need_weights=False)
+    out, _ = module(x, attention_mask=AttentionMask(pad), need_weights=False)
+
+    assert torch.allclose(out, ref, atol=1e-5)
+
+
+def test_attention_mask_causal_is_shared():
+    pad = _pad()
+    mask = AttentionMask(pad)
+    causal = mask.with_causal()
+
+    assert causal is mask.with_causal()
+    assert causal.as_additive(torch.float) is causal.as_additive(torch.float)
+    assert torch.equal(
+        causal.as_float(torch.float), pad.unsqueeze(1) * subsequent_mask(L)
+    )
+
+
+def test_attention_mask_single_head_and_twoway():
+    torch.manual_seed(0)
+    x, y = torch.randn(B, L, A), torch.randn(B, L, A)
+    pad = _pad()
+    single = SelfAttention(attention_size=A, dropout=0.0).eval()
+    twoway = TwowayAttention(attention_size=A, dropout=0.0).eval()
+
+    ref, _ = single(x, attention_mask=pad)
+    out, _ = single(x, attention_mask=AttentionMask(pad))
+    assert torch.allclose(out, ref, atol=1e-5)
+
+    for ref, out in zip(
+        twoway(x, y, attention_mask=pad),
+        twoway(x, y, attention_mask=AttentionMask(pad)),
+    ):
+        assert torch.allclose(out, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize("module_cls", [Attention, MultiheadAttention])
+def test_fused_projection_loads_separate_weights(module_cls):
+    torch.manual_seed(0)
+    module = module_cls(attention_size=A, dropout=0.0).eval()
+    state_dict = module.state_dict()
+    q, k, v = state_dict.pop("qkv.weight").chunk(3, dim=0)
+    state_dict.update({"k.weight": k, "q.weight": q, "v.weight": v})
+    loaded = module_cls(attention_size=A, dropout=0.0).eval()
+    loaded.load_state_dict(state_dict)
+    x, y = torch.randn(B, L, A), torch.randn(B, M, A)
+
+    for queries in [None, y]:
+        ref, _ = module(x, queries=queries, need_weights=False)
+        out, _ = loaded(x, queries=queries, need_weights=False)
+        assert torch.allclose(out, ref)
+
+
+def _twoway_reference(module, mod1, mod2, pad):
+    """TwowayAttention with separate projections and attention calls per direction"""
+    weight = torch.cat([module.kqvx.weight, module.kqvy.weight])
+    kx, qx, vx, ky, qy, vy = weight.view(6, A, A)
+    mask = pad.unsqueeze(1)
+    out1, _ = attention(mod1 @ kx.t(), mod2 @ qy.t(), mod1 @ vx.t(), A, mask, 0.0)
+    out2, _ = attention(mod2 @ ky.t(), mod1 @ qx.t(), mod2 @ vy.t(), A, mask, 0.0)
+
+    return out1 + mod2, out2 + mod1
+
+
+def test_twoway_attention_matches_unbatched():
+    torch.manual_seed(0)
+    twoway = TwowayAttention(attention_size=A, dropout=0.0).eval()
+    x, y = torch.randn(B, L, A), torch.randn(B, L, A)
+    pad = _pad()
+
+    for out, ref in zip(twoway(x, y, pad), _twoway_reference(twoway, x, y, pad)):
+        assert torch.allclose(out, ref, atol=1e-5)
+
+    # Old checkpoints with separate or stacked projections
+    names = ["kx", "qx", "vx", "ky", "qy", "vy"]
+    weight = torch.stack([twoway.kqvx.weight, twoway.kqvy.weight]).detach()
+    separate = {f"{name}.weight": w for name, w in zip(names, weight.view(6, A, A))}
+
+    for state_dict in [separate, {"kqv": weight}]:
+        loaded = TwowayAttention(attention_size=A, dropout=0.0).eval()
+        loaded.load_state_dict(state_dict)
+        assert torch.equal(loaded.kqvx.weight, twoway.kqvx.weight)
+        assert torch.equal(loaded.kqvy.weight, twoway.kqvy.weight)
+
+
+def test_attention_fuser_batch_pairs():
+    torch.manual_seed(0)
+    fuser = AttentionFuser(A, 3, use_all_trimodal=True, dropout=0.0).eval()
+    batched = AttentionFuser(
+        A, 3, use_all_trimodal=True, dropout=0.0, batch_pairs=True
+    ).eval()
+    batched.load_state_dict(fuser.state_dict())
+    mods = [torch.randn(B, L, A) for _ in range(3)]
+
+    assert torch.allclose(batched(*mods), fuser(*mods), atol=1e-5)
+
+
+def test_moore_penrose_pinv_inference_path_and_tolerance():
+    torch.manual_seed(0)
+    x = torch.softmax(torch.randn(2, 3, 16, 16), dim=-1)
+    ref = moore_penrose_pinv(x.clone().requires_grad_())
+
+    with torch.no_grad():
+        out = moore_penrose_pinv(x)
+        converged = moore_penrose_pinv(x, num_iter=50, tol=1e-3)
+    residual = (torch.eye(16) - x @ converged).norm(dim=(-2, -1))
+
+    assert torch.allclose(out, ref, atol=1e-5)
+    assert (residual < 1e-3).all()
+
+
+def test_performer_redraw_skipped_in_checkpoint_recomputation():
+    torch.manual_seed(0)
+    encoder = Encoder(
+        num_layers=2,
+        hidden_size=A,
+        num_heads=H,
+        inner_size=64,
+        dropout=0.0,
+        performer=True,
+        num_random_features=16,
+        feature_redraw_interval=1,
+        checkpoint_activations=1,
+    ).train()
+    x = torch.randn(B, L, A, requires_grad=True)
+    kernels = [layer.l1.sublayer.performer for layer in encoder.encoder]
+
+    for _ in range(2):
+        out = encoder(x, attention_mask=_pad())
+        projections = [kernel.projection.clone() for kernel in kernels]
+        out.sum().backward()
+
+        for kernel, projection in zip(kernels, projections):
+            assert torch.equal(kernel.projection, projection)
+            assert kernel.calls_since_redraw == 1
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"causal": True},
+        {"chunk_size": 4},
+        {"nystrom": True, "num_landmarks": 4},
+        {"nystrom": True, "num_landmarks": 4, "causal": True},
+        {"performer": True, "num_random_features": 16},
+        {"window_size": 3},
+    ],
+)
+def test_bfloat16_autocast_matches_float32(kwargs):
+    torch.manual_seed(0)
+    module = MultiheadSelfAttention(
+        attention_size=A, num_heads=H, dropout=0.0, **kwargs
+    ).eval()
+    x = torch.randn(B, L, A)
+    ref, _ = module(x, attention_mask=_pad(), need_weights=False)
+
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        out, _ = module(x, attention_mask=_pad(), need_weights=False)
+
+    assert out.dtype == torch.bfloat16
+    valid = _pad().bool()
+    assert torch.allclose(out.float()[valid], ref[valid], atol=5e-2)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+def test_low_precision_fully_masked_rows_are_finite(dtype):
+    k, q, v = [t.to(dtype) for t in _inputs(L)]
+    mask = torch.zeros(B, 1, 1, L)
+    out, scores = attention(k, q, v, A // H, attention_mask=mask, training=False)
+
+    assert out.dtype == dtype
+    assert torch.isfinite(out).all() and torch.isfinite(scores).all()
+    # Fully masked rows attend uniformly, as in float32
+    assert torch.allclose(scores.float(), torch.full((B, H, L, L), 1 / L), atol=1e-3)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 32])
+@pytest.mark.parametrize("causal", [False, True])
+def test_chunked_attention_matches_dense(chunk_size, causal):
+    k, q, v = [t.requires_grad_() for t in _inputs(L)]
+    masks = {k: m for k, m in _masks(L).items() if k != "fully_masked_row"}
+
+    for name, mask in masks.items():
+        dense_mask = mask
+
+        if causal:
+            future = subsequent_mask(L)[None]
+            dense_mask = future if mask is None else mask * future
+        ref, _ = attention(
+            k, q, v, A // H, attention_mask=dense_mask, dropout=0.0, training=False
+        )
+        ref_grads = torch.autograd.grad(ref.sum(), (k, q, v))
+        out, scores = chunked_attention(
+            k,
+            q,
+            v,
+            A // H,
+            attention_mask=mask,
+            chunk_size=chunk_size,
+            causal=causal,
+            dropout=0.0,
+            training=False,
+        )
+        grads = torch.autograd.grad(out.sum(), (k, q, v))
+
+        assert scores is None
+        assert torch.allclose(out, ref, atol=1e-5), name
+
+        for grad, ref_grad in zip(grads, ref_grads):
+            assert torch.allclose(grad, ref_grad, atol=1e-5), name
+
+
+def test_performer_rejects_structured_masks_without_causal():
+    k, q, v = _inputs(L)
+    projection = gaussian_orthogonal_random_matrix(16, A // H)
+    pad = _pad()
+    structured = (pad.unsqueeze(1) * subsequent_mask(L))[:, None]
+
+    with pytest.raises(ValueError):
+        performer_attention(k, q, v, A // H, projection, attention_mask=structured)
+
+    out, _ = performer_attention(
+        k, q, v, A // H, projection, attention_mask=structured, causal=True
+    )
+    ref, _ = performer_attention(
+        k, q, v, A // H, projection, attention_mask=pad, causal=True
+    )
+    assert torch.allclose(out, ref)
+
+
+def test_sliding_window_rejects_structured_masks_without_causal():
+    k, q, v = _inputs(L)
+    pad = _pad()
+    structured = (pad.unsqueeze(1) * subsequent_mask(L))[:, None]
+    kwargs = {"window_size": 3, "dropout": 0.0, "training": False}
+
+    with pytest.raises(ValueError):
+        sliding_window_attention(k, q, v, A // H, attention_mask=structured, **kwargs)
+
+    out, _ = sliding_window_attention(
+        k, q, v, A // H, attention_mask=structured, causal=True, **kwargs
+    )
+    ref, _ = sliding_window_attention(
+        k, q, v, A // H, attention_mask=pad, causal=True, **kwargs
+    )
+    assert torch.allclose(out, ref)
+
+
+def test_nystrom_rejects_structured_masks():
+    k, q, v = _inputs(L)
+    structured = (_pad().unsqueeze(1) * subsequent_mask(L))[:, None]
+
+    with pytest.raises(ValueError):
+        nystrom_attention(k, q, v, A // H, 4, attention_mask=structured)
+
+
+def test_causal_nystrom_accepts_pad_and_subsequent_masks():
+    k, q, v = _inputs(L)
+    pad = _pad()
+    kwargs = {"dropout": 0.0, "training": False}
+    ref, _ = causal_nystrom_attention(k, q, v, A // H, 4, attention_mask=pad, **kwargs)
+    out, _ = causal_nystrom_attention(
+        k,
+        q,
+        v,
+        A // H,
+        4,
+        attention_mask=(pad.unsqueeze(1) * subsequent_mask(L))[:, None],
+        **kwargs,
+    )
+
+    assert torch.allclose(out, ref)
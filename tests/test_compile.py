@@ -0,0 +1,184 @@
+import pytest
+import torch
+
+from slp.deploy import compile_model
+from slp.modules.attention import Attention, MultiheadAttention
+from slp.modules.embed import PositionalEncoding
+from slp.modules.fuse import ProjectFuseAggregate, make_fuser
+from slp.modules.mmdrop import MultimodalDropout
+from slp.modules.multimodal import MultimodalBaseline
+from slp.modules.rnn import RNN, AttentiveRNN
+from slp.modules.transformer import (
+    Encoder,
+    TransformerSequenceEncoder,
+    TransformerTokenSequenceEncoder,
+)
+from slp.modules.twowayattention import TwowayAttention
+from slp.util.pytorch import pad_mask
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(torch, "compile"), reason="torch.compile requires pytorch >= 2.0"
+)
+
+B, L, D = 4, 10, 32
+
+
+def _inputs():
+    x = torch.randn(B, L, D)
+    lengths = torch.tensor([10, 7, 3, 5])
+
+    return x, lengths, pad_mask(lengths, max_length=L)
+
+
+def _encoder(**kwargs):
+    return Encoder(num_layers=2, hidden_size=D, num_heads=4, inner_size=64, **kwargs)
+
+
+MODULES = {
+    "encoder": lambda x, lengths, mask: (_encoder(), (x,), {"attention_mask": mask}),
+    "encoder_nystrom": lambda x, lengths, mask: (
+        _encoder(nystrom=True, num_landmarks=5),
+        (x,),
+        {"attention_mask": mask},
+    ),
+    "encoder_performer": lambda x, lengths, mask: (
+        _encoder(performer=True),
+        (x,),
+        {"attention_mask": mask},
+    ),
+    "encoder_rotary": lambda x, lengths, mask: (
+        _encoder(rotary=True),
+        (x,),
+        {"attention_mask": mask},
+    ),
+    "sequence_encoder": lambda x, lengths, mask: (
+        TransformerSequenceEncoder(
+            D, num_layers=2, hidden_size=D, num_heads=4, inner_size=64
+        ),
+        (x,),
+        {"attention_mask": mask},
+    ),
+    "token_sequence_encoder": lambda x, lengths, mask: (
+        TransformerTokenSequenceEncoder(
+            vocab_size=50, num_layers=2, hidden_size=D, num_heads=4, inner_size=64
+        ),
+        ((x[..., 0].abs() * 10).long() % 50,),
+        {"attention_mask": mask},
+    ),
+    "packed_positional_encoding": lambda x, lengths, mask: (
+        PositionalEncoding(D, max_len=L),
+        (x,),
+        {"positions": torch.arange(L).expand(B, L) % 6},
+    ),
+    "multihead_attention": lambda x, lengths, mask: (
+        MultiheadAttention(D, 4),
+        (x,),
+        {"attention_mask": mask},
+    ),
+    "attention": lambda x, lengths, mask: (
+        Attention(D),
+        (x,),
+        {"attention_mask": mask},
+    ),
+    "cat_fuser": lambda x, lengths, mask: (
+        make_fuser("cat", D, 3),
+        (x, x.flip(0), x.flip(1)),
+        {"lengths": lengths},
+    ),
+    "bilinear_fuser": lambda x, lengths, mask: (
+        make_fuser("bilinear", D, 3),
+        (x, x.flip(0), x.flip(1)),
+        {"lengths": lengths},
+    ),
+    "attention_fuser": lambda x, lengths, mask: (
+        make_fuser("attention", D, 3),
+        (x, x.flip(0), x.flip(1)),
+        {"lengths": lengths},
+    ),
+}
+
+# torch.compile does not capture nn.LSTM / nn.GRU layers, so these modules have graph breaks
+RNN_MODULES = {
+    "rnn": lambda x, lengths, mask: (
+        RNN(D, D, bidirectional=True),
+        (x, lengths),
+        {},
+    ),
+    "attentive_rnn": lambda x, lengths, mask: (
+        AttentiveRNN(D, D, attention=True),
+        (x, lengths),
+        {},
+    ),
+    "project_fuse_aggregate": lambda x, lengths, mask: (
+        ProjectFuseAggregate(
+            [D, D, D],
+            D,
+            projection_type="linear",
+            fusion_method="attention",
+            timesteps_pooling_method="rnn",
+        ),
+        (x, x.flip(0), x.flip(1)),
+        {"lengths": lengths},
+    ),
+    "multimodal_baseline": lambda x, lengths, mask: (
+        MultimodalBaseline(D, D, D, hidden_size=D),
+        (x, x.flip(0), x.flip(1)),
+        {"lengths": lengths},
+    ),
+}
+
+
+def _check_compiled(name, builder, fullgraph):
+    torch.manual_seed(0)
+    torch._dynamo.reset()
+    module, args, kwargs = builder(*_inputs())
+    module.eval()
+    compiled = compile_model(module, fullgraph=fullgraph, backend="eager")
+
+    with torch.no_grad():
+        expected, out = module(*args, **kwargs), compiled(*args, **kwargs)
+
+    expected = expected if isinstance(expected, tuple) else (expected,)
+    out = out if isinstance(out, tuple) else (out,)
+
+    for e, o in zip(expected, out):
+        if isinstance(e, torch.Tensor):
+            assert torch.allclose(e, o, atol=1e-5), name
+
+
+@pytest.mark.parametrize("name", list(MODULES.keys()))
+def test_modules_compile_without_graph_breaks(name):
+    _check_compiled(name, MODULES[name], fullgraph=True)
+
+
+@pytest.mark.parametrize("name", list(RNN_MODULES.keys()))
+def test_rnn_modules_compile(name):
+    _check_compiled(name, RNN_MODULES[name], fullgraph=False)
+
+
+@pytest.mark.parametrize("mode", ["hard", "soft"])
+def test_mmdrop_compiles_in_training(mode):
+    torch._dynamo.reset()
+    x, _, _ = _inputs()
+    mmdrop = MultimodalDropout(p=0.5, n_modalities=3, mode=mode).train()
+    compiled = compile_model(mmdrop, fullgraph=True, backend="eager")
+
+    torch.manual_seed(0)
+    expected = mmdrop(x, x, x)
+    torch.manual_seed(0)
+    out = compiled(x, x, x)
+
+    for e, o in zip(expected, out):
+        assert torch.allclose(e, o)
+
+
+def test_twoway_attention_inductor_parity():
+    torch.manual_seed(0)
+    torch._dynamo.reset()
+    x, y = torch.randn(B, L, D), torch.randn(B, L, D)
+    twoway = TwowayAttention(D).eval()
+    compiled = compile_model(twoway, fullgraph=True)
+
+    with torch.no_grad():
+        for e, o in zip(twoway(x, y), compiled(x, y)):
+            assert torch.allclose(e, o, atol=1e-5)
@@ -0,0 +1,151 @@
+import pytest
+import torch
+
+from slp.deploy import (
+    OnnxModel,
+    export_onnx,
+    load_quantized,
+    quantize_and_report,
+    quantize_dynamic,
+)
+from slp.modules.classifier import (
+    RNNSequenceClassifier,
+    TransformerLateFusionClassifier,
+    TransformerTokenSequenceClassifier,
+)
+from slp.modules.rnn import TokenRNN
+from slp.modules.twowayattention import TwowayAttention
+from slp.util.pytorch import pad_mask
+
+
+def _batches(make_inputs, num_batches=2, batch_size=8, max_length=12):
+    batches = []
+
+    for _ in range(num_batches):
+        lengths = torch.randint(3, max_length + 1, (batch_size,))
+        lengths[0] = max_length
+        targets = torch.randint(0, 3, (batch_size,))
+        batches.append((make_inputs(batch_size, max_length), targets, lengths))
+
+    return batches
+
+
+def test_quantized_rnn_classifier_parity_and_artifact(tmp_path):
+    torch.manual_seed(0)
+    model = RNNSequenceClassifier(16, 3, hidden_size=32, layers=2, bidirectional=True)
+    batches = _batches(lambda b, l: torch.randn(b, l, 16))
+    path = str(tmp_path / "rnn.pt")
+
+    quantized, report = quantize_and_report(model, batches, path=path)
+
+    rnn = quantized.encoder.rnn.rnn
+    assert type(rnn).__name__ == "LSTM" and "quantized" in type(rnn).__module__
+    assert report["agreement"] > 0.8
+    assert report["size_reduction"] > 2
+    loaded = load_quantized(path)
+    inputs, _, lengths = batches[0]
+    assert torch.allclose(loaded(inputs, lengths), quantized(inputs, lengths))
+
+
+def test_quantized_transformer_traced_artifact(tmp_path):
+    torch.manual_seed(0)
+    model = TransformerTokenSequenceClassifier(
+        3, vocab_size=50, num_layers=2, hidden_size=32, num_heads=4, inner_size=64
+    )
+    batches = _batches(lambda b, l: torch.randint(1, 50, (b, l)))
+
+    def forward_fn(model, batch):
+        inputs, targets, lengths = batch
+        mask = pad_mask(lengths, max_length=inputs.size(1))
+
+        return model(inputs, attention_mask=mask), targets
+
+    inputs, _, lengths = batches[0]
+    mask = pad_mask(lengths, max_length=inputs.size(1))
+    path = str(tmp_path / "transformer.pt")
+    quantized, report = quantize_and_report(
+        model, batches, forward_fn=forward_fn, path=path, example_inputs=(inputs, mask)
+    )
+
+    assert report["agreement"] > 0.8
+    loaded = load_quantized(path)
+    assert isinstance(loaded, torch.jit.ScriptModule)
+    assert torch.allclose(loaded(inputs, mask), quantized(inputs, attention_mask=mask))
+
+
+def test_quantized_twoway_attention_projections():
+    torch.manual_seed(0)
+    model = TwowayAttention(attention_size=32, dropout=0.0).eval()
+    quantized = quantize_dynamic(model)
+
+    for projection in (quantized.kqvx, quantized.kqvy):
+        assert "quantized" in type(projection).__module__
+
+    mask = pad_mask(torch.tensor([10, 6, 3]), max_length=10)
+
+    # Batched projections for equal lengths, one projection per modality otherwise
+    for y_length in (10, 7):
+        x, y = torch.randn(3, 10, 32), torch.randn(3, y_length, 32)
+        attention_mask = mask if y_length == 10 else None
+
+        for out, ref in zip(
+            quantized(x, y, attention_mask), model(x, y, attention_mask)
+        ):
+            assert torch.allclose(out, ref, atol=0.1)
+
+
+def test_onnx_export_token_rnn_dynamic_axes(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    torch.manual_seed(0)
+    model = TokenRNN(hidden_size=16, vocab_size=50, embeddings_dim=16).eval()
+    (inputs, _, lengths), *others = _batches(lambda b, l: torch.randint(1, 50, (b, l)))
+    path = str(tmp_path / "token_rnn.onnx")
+    # Other batch size and sequence lengths than the sample batch
+    check = [(torch.randint(1, 50, (3, 20)), torch.tensor([20, 4, 11]))]
+
+    report = export_onnx(model, (inputs, lengths), path, check_batches=check)
+
+    assert report["max_abs_diff"] < 1e-4
+    onnx_model = OnnxModel(path)
+    assert torch.allclose(onnx_model(*check[0]), model(*check[0]), atol=1e-4)
+
+
+def test_onnx_export_multimodal_transformer_mask_dicts(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    torch.manual_seed(0)
+    model = TransformerLateFusionClassifier(
+        {"text": 16, "audio": 8},
+        3,
+        num_layers=1,
+        hidden_size=16,
+        num_heads=2,
+        inner_size=32,
+        num_landmarks=4,
+        multi_modal_drop="mmdrop_hard",
+    )
+
+    def make_batch(batch_size, text_length, audio_length):
+        inputs = {
+            "text": torch.randn(batch_size, text_length, 16),
+            "audio": torch.randn(batch_size, audio_length, 8),
+        }
+        masks = {
+            "text": pad_mask(
+                torch.randint(1, text_length + 1, (batch_size,)), text_length
+            ),
+            "audio": pad_mask(
+                torch.randint(1, audio_length + 1, (batch_size,)), audio_length
+            ),
+        }
+
+        return inputs, masks
+
+    path = str(tmp_path / "late_fusion.onnx")
+    report = export_onnx(
+        model, make_batch(4, 12, 15), path, check_batches=[make_batch(2, 20, 9)]
+    )
+
+    assert report["max_abs_diff"] < 1e-4
+    assert {"inputs.text", "attention_masks.audio"} <= OnnxModel(path).input_names
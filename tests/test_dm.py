@@ -0,0 +1,171 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+
+# slp.plbind imports ray for hyperparameter tuning
+pytest.importorskip("ray")
+
+from slp.plbind.dm import (  # noqa: E402
+    PLDataModuleFromCorpus,
+    PLDataModuleFromDatasets,
+    worker_init,
+)
+
+
+def _datamodule(**kwargs):
+    train = [torch.tensor([i, i + 1]) for i in range(40)]
+    val = [torch.tensor([i, i]) for i in range(8)]
+    test = [torch.tensor([i, -i]) for i in range(8)]
+
+    return PLDataModuleFromDatasets(
+        train, val=val, test=test, batch_size=4, pin_memory=False, **kwargs
+    )
+
+
+def test_worker_kwargs_are_forwarded_to_dataloader():
+    dm = _datamodule(
+        num_workers=2,
+        persistent_workers=True,
+        prefetch_factor=4,
+        multiprocessing_context="spawn",
+        seed=13,
+        seed_workers=True,
+        num_threads_per_worker=1,
+    )
+    dm.setup()
+
+    for loader in (dm.train_dataloader(), dm.val_dataloader(), dm.test_dataloader()):
+        assert loader.num_workers == 2
+        assert loader.persistent_workers
+        assert loader.prefetch_factor == 4
+        assert loader.multiprocessing_context._name == "spawn"
+        assert loader.worker_init_fn.func is worker_init
+        assert loader.worker_init_fn.keywords == {"num_threads": 1}
+        assert loader.generator.initial_seed() == 13
+
+    # Worker-only arguments are dropped without worker processes
+    dm = _datamodule(num_workers=0, persistent_workers=True, seed_workers=True)
+    dm.setup()
+    loader = dm.train_dataloader()
+    assert not loader.persistent_workers
+    assert loader.worker_init_fn is None
+
+
+class _RandomDataset(torch.utils.data.Dataset):
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, idx):
+        return torch.tensor([random.random(), np.random.rand(), torch.rand(1).item()])
+
+
+def _random_epochs(num_epochs):
+    dm = PLDataModuleFromDatasets(
+        _RandomDataset(),
+        val=_RandomDataset(),
+        test=_RandomDataset(),
+        batch_size=4,
+        num_workers=1,
+        seed=13,
+        seed_workers=True,
+        pin_memory=False,
+    )
+    dm.setup()
+    loader = dm.train_dataloader()
+
+    return [torch.cat(list(loader)) for _ in range(num_epochs)]
+
+
+def test_seeded_workers_are_reproducible_and_change_every_epoch():
+    first, second = _random_epochs(2)
+
+    # python, numpy and torch streams differ between epochs
+    assert (first != second).all()
+
+    for epoch, other in zip(_random_epochs(2), [first, second]):
+        assert torch.equal(epoch, other)
+
+
+def test_tune_loader_returns_and_applies_a_valid_configuration():
+    dm = _datamodule(num_workers=0)
+    dm.setup()
+    best = dm.tune_loader(num_batches=3, num_workers=[0, 1], num_threads_per_worker=[1])
+
+    assert set(best) == {
+        "num_workers",
+        "num_threads_per_worker",
+        "persistent_workers",
+        "batches_per_sec",
+    }
+    assert best["num_workers"] in (0, 1)
+    assert best["num_threads_per_worker"] == (None if best["num_workers"] == 0 else 1)
+    assert best["batches_per_sec"] > 0
+    assert dm.num_workers == best["num_workers"]
+    assert len(list(dm.train_dataloader())) == 10
+
+
+def _corpus_datamodule(**kwargs):
+    rng = random.Random(0)
+    words = ["a", "b", "c", "d", "e", "f", "g"]
+    corpus = [rng.choices(words, k=rng.randint(2, 9)) for _ in range(30)]
+    labels = [rng.randint(0, 1) for _ in range(30)]
+
+    return PLDataModuleFromCorpus(
+        corpus,
+        train_labels=labels,
+        tokenizer="tokenized",
+        num_workers=0,
+        pin_memory=False,
+        **kwargs,
+    )
+
+
+def _assert_same_samples(dataset, other):
+    assert len(dataset) == len(other)
+
+    for sample, other_sample in zip(dataset, other):
+        for x, y in zip(sample, other_sample):
+            assert torch.equal(torch.as_tensor(x), torch.as_tensor(y))
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot")
+    dm = _corpus_datamodule(seed=7, max_length=6)
+    dm.setup()
+    dm.save_snapshot(path)
+    # Existing snapshots are replaced
+    dm.save_snapshot(path)
+    restored = PLDataModuleFromCorpus.from_snapshot(
+        path, tokenizer="tokenized", seed=7, max_length=6, batch_size=8
+    )
+
+    assert restored.vocab_size == dm.vocab_size
+    assert sum(dm.token_counts) > 0
+    assert restored.token_counts == dm.token_counts
+    assert restored.batch_size == 8
+
+    for split in ("train", "val", "test"):
+        _assert_same_samples(getattr(dm, split), getattr(restored, split))
+
+
+@pytest.mark.parametrize("mismatch", [{"seed": 8}, {"max_length": 5}])
+def test_snapshot_config_mismatch_raises(tmp_path, mismatch):
+    path = str(tmp_path / "snapshot")
+    dm = _corpus_datamodule(seed=7, max_length=6)
+    dm.save_snapshot(path)
+    kwargs = {"tokenizer": "tokenized", "seed": 7, "max_length": 6}
+    kwargs.update(mismatch)
+
+    with pytest.raises(ValueError):
+        PLDataModuleFromCorpus.from_snapshot(path, **kwargs)
+
+
+def test_snapshot_does_not_replace_other_directories(tmp_path):
+    (tmp_path / "data.txt").write_text("keep me")
+    dm = _corpus_datamodule(seed=7, max_length=6)
+
+    with pytest.raises(ValueError):
+        dm.save_snapshot(str(tmp_path))
+    assert (tmp_path / "data.txt").read_text() == "keep me"
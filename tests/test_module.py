@@ -0,0 +1,84 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from slp.modules.classifier import TransformerEarlyExitClassifier
+from slp.modules.transformer import TransformerTokenSequenceEncoder
+
+# slp.plbind imports ray for hyperparameter tuning
+pytest.importorskip("ray")
+
+from slp.plbind.module import (  # noqa: E402
+    SimplePLModule,
+    _Classification,
+    _TransformerClassification,
+)
+
+
+class _SequenceTagger(nn.Module):
+    def forward(self, x, attention_mask=None):
+        return torch.zeros(x.size(0), x.size(1), 3)
+
+
+def test_only_early_exit_models_are_flattened():
+    inputs = torch.randint(1, 20, (4, 6))
+    batch = (inputs, torch.tensor([0, 1, 2, 0]), torch.tensor([6, 5, 4, 3]))
+    predictor = _TransformerClassification()
+    encoder = TransformerTokenSequenceEncoder(
+        vocab_size=20, num_layers=3, hidden_size=16, num_heads=2, inner_size=32
+    )
+    model = TransformerEarlyExitClassifier(encoder, 3, exit_layers=[0])
+
+    y_pred, targets = predictor.get_predictions_and_targets(model.train(), batch)
+    assert y_pred.shape == (8, 3)
+    assert torch.equal(targets, batch[1].repeat(2))
+
+    y_pred, targets = predictor.get_predictions_and_targets(model.eval(), batch)
+    assert y_pred.shape == (4, 3)
+    assert torch.equal(targets, batch[1])
+
+    # Other 3-D outputs are not early exit logits
+    y_pred, targets = predictor.get_predictions_and_targets(_SequenceTagger(), batch)
+    assert y_pred.shape == (4, 6, 3)
+    assert torch.equal(targets, batch[1])
+
+
+def test_bfloat16_autocast_training_step_is_float32_outside_the_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 3))
+    module = SimplePLModule(
+        model,
+        torch.optim.Adam(model.parameters()),
+        nn.CrossEntropyLoss(),
+        predictor_cls=_Classification,
+        autocast_dtype=torch.bfloat16,
+    )
+    dtypes = []
+    model[0].register_forward_hook(lambda m, i, out: dtypes.append(out.dtype))
+    batch = (torch.randn(4, 8), torch.tensor([0, 1, 2, 0]))
+
+    y_hat, targets, loss = module._predict(module.model, batch)
+    loss.backward()
+
+    # The model runs in bfloat16. Outputs, loss and gradients are float32
+    assert dtypes == [torch.bfloat16]
+    assert y_hat.dtype == torch.float32
+    assert loss.dtype == torch.float32
+    assert torch.equal(targets, batch[1])
+
+    for p in model.parameters():
+        assert p.grad.dtype == torch.float32
+        assert torch.isfinite(p.grad).all()
+
+
+def test_autocast_dtype_requires_torch_autocast(monkeypatch):
+    monkeypatch.delattr(torch, "autocast")
+    model = nn.Linear(8, 3)
+
+    with pytest.raises(ValueError):
+        SimplePLModule(
+            model,
+            torch.optim.Adam(model.parameters()),
+            nn.CrossEntropyLoss(),
+            autocast_dtype=torch.bfloat16,
+        )
@@ -0,0 +1,48 @@
+import threading
+
+import torch
+
+from slp.data.prefetch import PrefetchDataLoader
+
+
+def _loader(**kwargs):
+    return PrefetchDataLoader(
+        torch.arange(20).unsqueeze(-1), batch_size=2, prefetch_batches=2, **kwargs
+    )
+
+
+def test_prefetch_full_pass():
+    loader = _loader()
+    batches = list(loader)
+
+    assert torch.equal(torch.cat(batches), torch.arange(20).unsqueeze(-1))
+    assert loader.num_batches == 10
+
+
+def test_prefetch_thread_exits_after_break():
+    num_threads = threading.active_count()
+    loader = _loader()
+
+    for _ in range(3):
+        for i, _ in enumerate(loader):
+            if i == 1:
+                break
+
+    assert threading.active_count() == num_threads
+    # Partial passes are reported
+    assert loader.num_batches == 6
+
+
+def test_prefetch_new_iterator_closes_previous():
+    loader = _loader()
+    first = iter(loader)
+    next(first)
+    second = iter(loader)
+
+    assert not first.thread.is_alive()
+    assert len(list(second)) == 10
+
+    third = iter(loader)
+    loader.close()
+    assert not third.thread.is_alive()
+    assert list(third) == []
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from slp.modules.rnn import AttentiveRNN
+
+
+@pytest.mark.parametrize("rnn_type", ["lstm", "gru"])
+@pytest.mark.parametrize("packed_sequence", [True, False])
+def test_checkpoint_activations_matches_gradients_with_dropout(
+    rnn_type, packed_sequence
+):
+    x = torch.randn(3, 9, 8)
+    lengths = torch.tensor([9, 5, 7])
+    grads = []
+
+    for checkpoint_activations in [False, True]:
+        torch.manual_seed(0)
+        model = AttentiveRNN(
+            8,
+            hidden_size=16,
+            layers=2,
+            bidirectional=True,
+            dropout=0.3,
+            rnn_type=rnn_type,
+            packed_sequence=packed_sequence,
+            attention=True,
+            checkpoint_activations=checkpoint_activations,
+        ).train()
+        # Dropout between the stacked layers runs inside the fused op and is recomputed
+        model.rnn.rnn.dropout = 0.3
+        # Same dropout masks in both runs. Recomputation must reuse them
+        torch.manual_seed(1)
+        out = model(x, lengths)
+        out.sum().backward()
+        grads.append([p.grad for p in model.parameters()])
+
+    for ref, grad in zip(*grads):
+        assert torch.allclose(grad, ref, atol=1e-5)
+
+
+def test_attentive_rnn_rejects_nystrom_with_performer():
+    with pytest.raises(ValueError):
+        AttentiveRNN(8, attention=True, num_heads=2, nystrom=True, performer=True)
+
+    model = AttentiveRNN(8, attention=True, num_heads=2, nystrom=False, performer=True)
+    assert model.attention.performer is not None
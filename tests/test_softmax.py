@@ -0,0 +1,91 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from slp.modules.softmax import (
+    AdaptiveSoftmax,
+    SampledSoftmax,
+    frequency_cutoffs,
+    frequency_ranks,
+)
+from slp.modules.transformer import Transformer
+from slp.util.pytorch import subsequent_mask
+
+V, H = 50, 16
+
+
+def _counts():
+    torch.manual_seed(0)
+
+    return torch.randint(0, 1000, (V,)).tolist()
+
+
+def test_frequency_ranks_and_cutoffs():
+    counts = [0, 5, 10, 5, 1]
+
+    assert frequency_ranks(counts).tolist() == [4, 1, 0, 2, 3]
+    assert frequency_cutoffs(counts, coverage=(0.5, 0.9)) == [2, 3]
+
+
+def test_adaptive_softmax_loss_is_exact_nll_of_token_ids():
+    adaptive = AdaptiveSoftmax(H, V, token_counts=_counts())
+    hidden = torch.randn(3, 7, H)
+    targets = torch.randint(0, V, (3, 7))
+    targets[0, 0] = -100
+
+    log_probs = adaptive.log_prob(hidden)
+    keep = targets != -100
+    nll = -log_probs[keep].gather(-1, targets[keep].unsqueeze(-1)).mean()
+
+    assert torch.allclose(log_probs.logsumexp(-1), torch.zeros(3, 7), atol=1e-5)
+    assert torch.allclose(adaptive(hidden, targets), nll, atol=1e-5)
+
+
+def test_sampled_softmax_is_exact_in_eval():
+    torch.manual_seed(0)
+    sampled = SampledSoftmax(H, V, num_sampled=10, token_counts=_counts())
+    hidden = torch.randn(3, 7, H)
+    targets = torch.randint(0, V, (3, 7))
+    full = F.cross_entropy(sampled.logits(hidden).view(-1, V), targets.view(-1))
+
+    sampled.train()
+    loss = sampled(hidden, targets)
+    loss.backward()
+
+    assert torch.isfinite(loss)
+    # Only the targets and the sampled tokens get gradients
+    assert (sampled.weight.grad.abs().sum(-1) > 0).sum() <= 3 * 7 + 10
+
+    sampled.eval()
+    assert torch.allclose(sampled(hidden, targets), full)
+
+
+@pytest.mark.parametrize("output_layer", ["adaptive", "sampled"])
+def test_transformer_output_layers(output_layer):
+    torch.manual_seed(0)
+    model = Transformer(
+        vocab_size=V,
+        max_length=8,
+        num_layers=1,
+        hidden_size=H,
+        num_heads=2,
+        inner_size=32,
+        output_layer=output_layer,
+        token_counts=_counts(),
+    ).eval()
+    source = torch.randint(3, V, (2, 6))
+    target = torch.randint(3, V, (2, 5))
+
+    out = model(source, target, target_mask=subsequent_mask(5))
+    assert out.shape == (2, 5, H)
+    assert model.predict(out, target).ndim == 0
+
+    tokens, scores = model.generate(source, bos_idx=1, eos_idx=2, max_length=5)
+    log_probs = model.log_prob(
+        model(source, tokens[:, :-1], target_mask=subsequent_mask(4))
+    )
+    assert torch.allclose(
+        log_probs.gather(-1, tokens[:, 1:].unsqueeze(-1)).sum(dim=(1, 2)),
+        scores,
+        atol=1e-4,
+    )
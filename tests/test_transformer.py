@@ -2,15 +2,23 @@
 import itertools
 from warnings import simplefilter
 
+import pytest
 import pytorch_lightning as pl
 import torch
 from torch.utils.data import DataLoader, Dataset
 
 from slp.config.nlp import SPECIAL_TOKENS
-from slp.data.collators import Seq2SeqCollator
+from slp.data.collators import PackedSequenceClassificationCollator, Seq2SeqCollator
 from slp.data.corpus import create_vocab
 from slp.data.transforms import ToTensor, ToTokenIds
-from slp.modules.transformer import Transformer
+from slp.modules.attention import MultiheadAttention
+from slp.modules.classifier import TransformerEarlyExitClassifier
+from slp.modules.transformer import (
+    Sublayer3,
+    Transformer,
+    TransformerSequenceEncoder,
+    TransformerTokenSequenceEncoder,
+)
 from slp.util.pytorch import pad_mask, subsequent_mask
 
 simplefilter(action="ignore")
@@ -117,3 +125,312 @@ def test_inner_layers_output_size():
 
     o = model.transformer_block(x, y, source_mask=mask1, target_mask=mask2)
     assert o.size() == (1, len(sentence) - 1, hidden_size)
+
+
+def _seq2seq_model(prenorm, position_encoding="sinusoidal"):
+    torch.manual_seed(0)
+
+    return Transformer(
+        vocab_size=20,
+        max_length=16,
+        num_layers=2,
+        hidden_size=32,
+        num_heads=4,
+        inner_size=64,
+        prenorm=prenorm,
+        position_encoding=position_encoding,
+    ).eval()
+
+
+@pytest.mark.parametrize(
+    "prenorm,position_encoding",
+    [(True, "sinusoidal"), (False, "sinusoidal"), (True, "rotary")],
+)
+def test_incremental_decoding_matches_full_forward(prenorm, position_encoding):
+    model = _seq2seq_model(prenorm, position_encoding=position_encoding)
+    source = torch.randint(3, 20, (3, 9))
+    source_mask = pad_mask(torch.tensor([9, 5, 7]), max_length=9).unsqueeze(1)
+    target = model.embed_sequence(torch.randint(3, 20, (3, 6)))
+    encoded = model.transformer_block.encoder(
+        model.embed_sequence(source), attention_mask=source_mask
+    )
+    decoder = model.transformer_block.decoder
+    full = decoder(
+        target, encoded, source_mask=source_mask, target_mask=subsequent_mask(6)
+    )
+    cache = decoder.init_cache()
+    steps = [
+        decoder(target[:, t : t + 1], encoded, source_mask=source_mask, cache=cache)
+        for t in range(6)
+    ]
+
+    assert torch.allclose(full, torch.cat(steps, dim=1), atol=1e-5)
+
+
+@pytest.mark.parametrize("prenorm", [True, False])
+def test_greedy_generate_matches_full_forward(prenorm):
+    model = _seq2seq_model(prenorm)
+    source = torch.randint(3, 20, (3, 9))
+    source_mask = pad_mask(torch.tensor([9, 5, 7]), max_length=9)
+    tokens, scores = model.generate(
+        source, bos_idx=1, eos_idx=2, source_mask=source_mask, max_length=10
+    )
+    logits = model(
+        source,
+        tokens[:, :-1],
+        source_mask=source_mask.unsqueeze(1),
+        target_mask=subsequent_mask(tokens.size(1) - 1),
+    )
+    log_probs = torch.log_softmax(logits, dim=-1)
+
+    # No eos with this seed. Every token is the argmax of the full forward pass
+    assert not (tokens == 2).any()
+    assert torch.equal(log_probs.argmax(-1), tokens[:, 1:])
+    assert torch.allclose(
+        log_probs.gather(-1, tokens[:, 1:].unsqueeze(-1)).sum(dim=(1, 2)),
+        scores,
+        atol=1e-4,
+    )
+
+    beam_tokens, beam_scores = model.generate(
+        source,
+        bos_idx=1,
+        eos_idx=2,
+        source_mask=source_mask,
+        max_length=10,
+        beam_size=4,
+        length_penalty=0.0,
+    )
+    assert beam_tokens.shape == tokens.shape
+    assert (beam_scores >= scores - 1e-5).all()
+
+
+@pytest.mark.parametrize("checkpoint_activations", [1, 2])
+def test_checkpoint_activations_matches_gradients_with_dropout(checkpoint_activations):
+    source = torch.randint(3, 20, (3, 9))
+    target = torch.randint(3, 20, (3, 6))
+    source_mask = pad_mask(torch.tensor([9, 5, 7]), max_length=9).unsqueeze(1)
+    grads = []
+
+    for segment_size in [0, checkpoint_activations]:
+        torch.manual_seed(0)
+        model = Transformer(
+            vocab_size=20,
+            max_length=16,
+            num_layers=3,
+            hidden_size=32,
+            num_heads=4,
+            inner_size=64,
+            dropout=0.3,
+            checkpoint_activations=segment_size,
+        ).train()
+        # Same dropout masks in both runs. Recomputation must reuse them
+        torch.manual_seed(1)
+        logits = model(
+            source, target, source_mask=source_mask, target_mask=subsequent_mask(6)
+        )
+        logits.sum().backward()
+        grads.append([p.grad for p in model.parameters()])
+
+    for ref, grad in zip(*grads):
+        assert torch.allclose(grad, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"kernel_size": 3}, {"nystrom": True}, {"position_encoding": "rotary"}],
+)
+def test_varlen_sequence_encoder_matches_padded(kwargs):
+    torch.manual_seed(0)
+    model = TransformerSequenceEncoder(
+        10,
+        num_layers=2,
+        hidden_size=32,
+        num_heads=4,
+        inner_size=64,
+        num_landmarks=4,
+        dropout=0.0,
+        **kwargs,
+    ).eval()
+    x = torch.randn(4, 16, 10)
+    mask = pad_mask(torch.tensor([7, 16, 3, 12]), max_length=16)
+    x.requires_grad_()
+    padded = model(x, attention_mask=mask)
+    padded_grad = torch.autograd.grad(padded.sum(), x)[0]
+
+    model.varlen = True
+    unpadded = model(x, attention_mask=mask)
+    unpadded_grad = torch.autograd.grad(unpadded.sum(), x)[0]
+
+    assert torch.allclose(unpadded, padded, atol=1e-5)
+    assert torch.allclose(unpadded_grad, padded_grad, atol=1e-5)
+    # Masked mean pooling ignores padded positions
+    assert (unpadded_grad[mask == 0] == 0).all()
+
+
+def _packed_batch():
+    batch = [(torch.randint(1, 50, (n,)), i % 3) for i, n in enumerate([5, 3, 9, 2, 7])]
+
+    return batch, PackedSequenceClassificationCollator(max_length=12)(batch)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 4])
+@pytest.mark.parametrize("position_encoding", ["sinusoidal", "rotary"])
+def test_packed_token_sequence_encoder_matches_unpacked(position_encoding, chunk_size):
+    torch.manual_seed(0)
+    batch, packed_batch = _packed_batch()
+    (
+        inputs,
+        targets,
+        lengths,
+        segment_ids,
+        position_ids,
+    ) = packed_batch
+    model = TransformerTokenSequenceEncoder(
+        vocab_size=50,
+        num_layers=2,
+        hidden_size=32,
+        num_heads=4,
+        inner_size=64,
+        dropout=0.0,
+        position_encoding=position_encoding,
+    ).eval()
+
+    for module in model.modules():
+        if isinstance(module, MultiheadAttention):
+            # Dense or chunked attention
+            module.chunk_size = chunk_size
+
+    assert inputs.size(0) < len(batch)
+    assert lengths.sum() == sum(len(x) for x, _ in batch)
+    assert torch.equal(targets, torch.tensor([y for _, y in batch]))
+
+    packed = model(inputs, segment_ids=segment_ids, position_ids=position_ids)
+    unpacked = torch.cat([model(x.unsqueeze(0)) for x, _ in batch])
+
+    assert torch.allclose(packed, unpacked, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "kernel",
+    [{"performer": True}, {"nystrom": True}, {"window_size": 2}, {"kernel_size": 3}],
+)
+def test_packed_token_sequence_encoder_rejects_segment_unaware_kernels(kernel):
+    _, (inputs, _, _, segment_ids, position_ids) = _packed_batch()
+    model = TransformerTokenSequenceEncoder(
+        vocab_size=50,
+        num_layers=1,
+        hidden_size=32,
+        num_heads=4,
+        inner_size=64,
+        **kernel,
+    )
+
+    with pytest.raises(ValueError):
+        model(inputs, segment_ids=segment_ids, position_ids=position_ids)
+
+
+def test_positional_encoding_tables_are_shared_and_not_saved():
+    model = TransformerSequenceEncoder(10, num_layers=1, hidden_size=32, max_length=8)
+    other = TransformerSequenceEncoder(10, num_layers=1, hidden_size=32, max_length=8)
+    model.eval(), other.eval()
+
+    assert model.pe.pe.data_ptr() == other.pe.pe.data_ptr()
+    assert "pe.pe" not in model.state_dict()
+
+    # Modules moved to the same dtype / device share the table again
+    model.double(), other.double()
+    assert model.pe.pe.dtype == torch.double
+    assert model.pe.pe.data_ptr() == other.pe.pe.data_ptr()
+    model.float(), other.float()
+
+    # Checkpoints with persistent tables still load
+    state_dict = dict(model.state_dict(), **{"pe.pe": torch.zeros(1, 8, 32)})
+    other.load_state_dict(state_dict)
+
+    # Longer sequences grow the table
+    x = torch.randn(2, 20, 10)
+    out = model(x)
+    assert model.pe.max_len == 20
+    assert torch.allclose(out, other(x), atol=1e-6)
+
+
+def test_packed_rows_longer_than_max_length_grow_the_table():
+    torch.manual_seed(0)
+    batch = [(torch.randint(1, 50, (n,)), 0) for n in [5, 7]]
+    inputs, _, _, segment_ids, position_ids = PackedSequenceClassificationCollator(
+        max_length=12
+    )(batch)
+    model = TransformerTokenSequenceEncoder(
+        vocab_size=50,
+        max_length=8,
+        num_layers=1,
+        hidden_size=32,
+        num_heads=4,
+        inner_size=64,
+        dropout=0.0,
+    ).eval()
+
+    assert inputs.shape == (1, 12)
+
+    packed = model(inputs, segment_ids=segment_ids)
+    unpacked = torch.cat([model(x.unsqueeze(0)) for x, _ in batch])
+    assert torch.allclose(packed, unpacked, atol=1e-5)
+
+    # Unpadded tokens at positions beyond max_length
+    model.varlen = True
+    x = torch.randint(1, 50, (2, 12))
+    out = model(x, attention_mask=pad_mask(torch.tensor([12, 4]), max_length=12))
+    assert model.pe.max_len >= 12
+    assert torch.allclose(out[:1], model(x[:1]), atol=1e-5)
+
+
+def test_early_exit_matches_exit_heads_of_full_forward():
+    torch.manual_seed(0)
+    encoder = TransformerTokenSequenceEncoder(
+        vocab_size=50,
+        num_layers=4,
+        hidden_size=32,
+        num_heads=4,
+        inner_size=64,
+        dropout=0.0,
+    )
+    model = TransformerEarlyExitClassifier(encoder, 3, exit_layers=[0, 2], dropout=0.0)
+    x = torch.randint(1, 50, (16, 10))
+    mask = pad_mask(torch.randint(3, 11, (16,)), max_length=10)
+
+    exits = model.train()(x, attention_mask=mask)
+    assert exits.shape == (3, 16, 3)
+
+    model.eval()
+    confidence = torch.softmax(exits, dim=-1).max(dim=-1)[0]
+    model.threshold = confidence[0].median().item()
+    logits = model(x, attention_mask=mask)
+
+    # Each example exits at the first confident head, with the same logits as in the full forward pass
+    layers = torch.tensor([1, 3, 4])
+    confident = confidence >= model.threshold
+    confident[-1] = True
+    exit_idx = confident.int().argmax(dim=0)
+    assert torch.equal(model.layers_used, layers[exit_idx])
+    assert model.layers_used.unique().numel() > 1
+    assert torch.allclose(logits, exits[exit_idx, torch.arange(16)], atol=1e-5)
+
+
+@pytest.mark.parametrize("prenorm", [True, False])
+def test_cross_attention_residual_is_on_the_decoder_stream(prenorm):
+    torch.manual_seed(0)
+    sublayer = Sublayer3(hidden_size=16, num_heads=2, dropout=0.0, prenorm=prenorm)
+    sublayer.eval()
+    # Encoder outputs and decoder states have different lengths
+    x, y = torch.randn(2, 7, 16), torch.randn(2, 3, 16)
+    mask = pad_mask(torch.tensor([7, 4]), max_length=7)
+
+    assert sublayer(x, y, attention_mask=mask).shape == y.shape
+
+    # Without the attention output only the residual remains
+    torch.nn.init.zeros_(sublayer.sublayer.output.weight)
+    torch.nn.init.zeros_(sublayer.sublayer.output.bias)
+    out = sublayer(x, y, attention_mask=mask)
+    expected = y if prenorm else sublayer.lnorm(y)
+    assert torch.allclose(out, expected)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""Benchmark time and peak memory of the attention kernels in slp.modules.attention
+
+* dense: attention with explicit scores
+* sdpa: attention(need_weights=False), dispatched to F.scaled_dot_product_attention
+* chunked: chunked_attention
+* nystrom: nystrom_attention, or causal_nystrom_attention with --causal
+* performer: performer_attention, with causal prefix sums with --causal
+* window: sliding_window_attention with --window-size and --num-global-tokens
+
+With --causal, dense and sdpa use a pad + subsequent mask and chunked uses causal=True.
+
+Example:
+    python tools/benchmark_attention.py --lengths 512 1024 2048 4096 --chunk-size 256 --backward
+    python tools/benchmark_attention.py --causal --methods sdpa nystrom --lengths 512 1024 2048 4096 8192
+    python tools/benchmark_attention.py --methods sdpa performer --num-random-features 256 --lengths 1024 4096 16384
+    python tools/benchmark_attention.py --methods sdpa window --window-size 128 --lengths 1024 4096 16384
+
+Peak memory is measured with torch.cuda.max_memory_allocated on GPU. On CPU each configuration
+runs in a fresh process and the increase of the maximum resident set size is reported.
+"""
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+
+from slp.modules.attention import (
+    attention,
+    causal_nystrom_attention,
+    chunked_attention,
+    gaussian_orthogonal_random_matrix,
+    nystrom_attention,
+    performer_attention,
+    sliding_window_attention,
+)
+from slp.util.pytorch import subsequent_mask
+
+
+def make_inputs(args, length):
+    shape = (args.batch_size, args.num_heads, length, args.head_size)
+    k, q, v = [
+        torch.randn(*shape, device=args.device, requires_grad=args.backward)
+        for _ in range(3)
+    ]
+    mask = torch.ones(args.batch_size, 1, 1, length, device=args.device)
+    mask[: args.batch_size // 2, ..., length // 2 :] = 0
+
+    return k, q, v, mask
+
+
+def run_kernel(args, method, k, q, v, mask, projection=None):
+    kwargs = dict(attention_mask=mask, dropout=0.0, training=args.backward)
+    length = k.size(-2)
+
+    if args.causal and method in {"dense", "sdpa"}:
+        kwargs["attention_mask"] = mask * subsequent_mask(length).to(mask.device)
+
+    if method == "window":
+        out, _ = sliding_window_attention(
+            k,
+            q,
+            v,
+            args.head_size,
+            args.window_size,
+            num_global_tokens=args.num_global_tokens,
+            causal=args.causal,
+            **kwargs,
+        )
+    elif method == "performer":
+        out, _ = performer_attention(
+            k,
+            q,
+            v,
+            args.head_size,
+            projection,
+            attention_mask=mask,
+            causal=args.causal,
+            chunk_size=args.chunk_size,
+        )
+    elif method == "nystrom" and args.causal:
+        out, _ = causal_nystrom_attention(
+            k, q, v, args.head_size, args.num_landmarks, **kwargs
+        )
+    elif method == "nystrom":
+        kwargs["attention_mask"] = mask.reshape(mask.size(0), length)
+        out, _ = nystrom_attention(
+            k, q, v, args.head_size, args.num_landmarks, **kwargs
+        )
+    elif method == "dense":
+        out, _ = attention(k, q, v, args.head_size, **kwargs)
+    elif method == "sdpa":
+        out, _ = attention(k, q, v, args.head_size, need_weights=False, **kwargs)
+    else:
+        out, _ = chunked_attention(
+            k,
+            q,
+            v,
+            args.head_size,
+            chunk_size=args.chunk_size,
+            causal=args.causal,
+            **kwargs,
+        )
+
+    if args.backward:
+        out.sum().backward()
+
+    return out
+
+
+def measure(args, method, length):
+    k, q, v, mask = make_inputs(args, length)
+    projection = gaussian_orthogonal_random_matrix(
+        args.num_random_features, args.head_size, device=args.device
+    )
+    cuda = args.device.startswith("cuda")
+
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with torch.set_grad_enabled(args.backward):
+        # Warmup
+        run_kernel(args, method, k, q, v, mask, projection=projection)
+
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+
+        for _ in range(args.repeats):
+            run_kernel(args, method, k, q, v, mask, projection=projection)
+
+        if cuda:
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / args.repeats
+
+    if cuda:
+        peak_mb = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        # ru_maxrss is in KB on linux
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 2 ** 10
+
+    return elapsed, peak_mb
+
+
+def _measure_in_child(args, method, length, queue):
+    queue.put(measure(args, method, length))
+
+
+def measure_isolated(args, method, length):
+    if args.device.startswith("cuda"):
+        return measure(args, method, length)
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure_in_child, args=(args, method, length, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark attention kernels")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--head-size", type=int, default=64)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--methods",
+        type=str,
+        nargs="+",
+        choices=["dense", "sdpa", "chunked", "nystrom", "performer", "window"],
+        default=["dense", "sdpa", "chunked"],
+    )
+    parser.add_argument("--num-landmarks", type=int, default=64)
+    parser.add_argument("--num-random-features", type=int, default=256)
+    parser.add_argument("--window-size", type=int, default=128)
+    parser.add_argument("--num-global-tokens", type=int, default=0)
+    parser.add_argument("--backward", action="store_true", help="Include backward pass")
+    parser.add_argument("--causal", action="store_true", help="Autoregressive masks")
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(
+        f"{'length':>8} {'method':>8} {'time (ms)':>10} {'tokens/s':>10} {'peak mem (MB)':>14}",
+        flush=True,
+    )
+
+    for length in args.lengths:
+        for method in args.methods:
+            if method == "nystrom" and not args.causal and length % args.num_landmarks:
+                # nystrom_attention expects inputs padded to a multiple of num_landmarks
+                continue
+            elapsed, peak_mb = measure_isolated(args, method, length)
+            throughput = args.batch_size * length / elapsed
+            print(
+                f"{length:>8} {method:>8} {1000 * elapsed:>10.2f} {throughput:>10.0f} {peak_mb:>14.1f}",
+                flush=True,
+            )
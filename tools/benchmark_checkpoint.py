@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""Benchmark the memory / compute trade-off of activation checkpointing
+
+Runs forward + backward passes of a transformer Encoder, with checkpoint_activations set to
+each of the --segments values (0 disables checkpointing, N checkpoints segments of N layers),
+and of a multi-layer UnimodalEncoder RNN with and without checkpointing.
+
+Example:
+    python tools/benchmark_checkpoint.py --lengths 512 1024 2048 --num-layers 6 --segments 0 1 2 3
+    python tools/benchmark_checkpoint.py --models rnn --lengths 500 1000 --rnn-layers 4
+
+Peak memory is measured with torch.cuda.max_memory_allocated on GPU. On CPU each configuration
+runs in a fresh process and the increase of the maximum resident set size is reported.
+"""
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+
+from slp.modules.multimodal import UnimodalEncoder
+from slp.modules.transformer import Encoder
+
+
+def make_model(args, model, segments):
+    if model == "transformer":
+        return Encoder(
+            num_layers=args.num_layers,
+            hidden_size=args.hidden_size,
+            num_heads=args.num_heads,
+            inner_size=4 * args.hidden_size,
+            dropout=0.1,
+            checkpoint_activations=segments,
+        )
+
+    return UnimodalEncoder(
+        args.hidden_size,
+        args.hidden_size,
+        layers=args.rnn_layers,
+        attention=False,
+        checkpoint_activations=segments > 0,
+    )
+
+
+def run_step(model_name, model, x, lengths):
+    if model_name == "transformer":
+        out = model(x)
+    else:
+        out = model(x, lengths=lengths)
+    out.sum().backward()
+
+
+def measure(args, model_name, segments, length):
+    cuda = args.device.startswith("cuda")
+
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    torch.manual_seed(0)
+    model = make_model(args, model_name, segments).to(args.device).train()
+    x = torch.randn(
+        args.batch_size,
+        length,
+        args.hidden_size,
+        device=args.device,
+        requires_grad=True,
+    )
+    lengths = torch.full((args.batch_size,), length, dtype=torch.long)
+
+    # Warmup
+    run_step(model_name, model, x, lengths)
+
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+
+    for _ in range(args.repeats):
+        model.zero_grad(set_to_none=True)
+        x.grad = None
+        run_step(model_name, model, x, lengths)
+
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / args.repeats
+
+    if cuda:
+        peak_mb = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        # ru_maxrss is in KB on linux
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 2 ** 10
+
+    return elapsed, peak_mb
+
+
+def _measure_in_child(args, model_name, segments, length, queue):
+    queue.put(measure(args, model_name, segments, length))
+
+
+def measure_isolated(args, model_name, segments, length):
+    if args.device.startswith("cuda"):
+        return measure(args, model_name, segments, length)
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(
+        target=_measure_in_child, args=(args, model_name, segments, length, queue)
+    )
+    proc.start()
+    result = queue.get()
+    proc.join()
+
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark activation checkpointing")
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        choices=["transformer", "rnn"],
+        default=["transformer", "rnn"],
+    )
+    parser.add_argument("--lengths", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-layers", type=int, default=6)
+    parser.add_argument("--rnn-layers", type=int, default=2)
+    parser.add_argument(
+        "--segments",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2],
+        help="checkpoint_activations values. For the RNN any value > 0 enables checkpointing",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(
+        f"{'model':>12} {'length':>8} {'segments':>9} {'fwd+bwd (ms)':>13} {'peak mem (MB)':>14}",
+        flush=True,
+    )
+
+    for model_name in args.models:
+        segments_list = (
+            args.segments
+            if model_name == "transformer"
+            else sorted({min(s, 1) for s in args.segments})
+        )
+
+        for length in args.lengths:
+            for segments in segments_list:
+                elapsed, peak_mb = measure_isolated(args, model_name, segments, length)
+                print(
+                    f"{model_name:>12} {length:>8} {segments:>9} {1000 * elapsed:>13.2f} {peak_mb:>14.1f}",
+                    flush=True,
+                )
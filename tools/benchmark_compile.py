@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Benchmark eager vs torch.compile latency of the core slp modules in eval mode
+
+Compiles randomly initialized TransformerSequenceEncoder, AttentiveRNN, ProjectFuseAggregate and
+MultimodalBaseline modules with slp.deploy.compile_model and reports the compilation time, the max
+absolute difference of the outputs and the latency per batch of the eager and compiled modules.
+The transformer is compiled into a single graph. torch.compile does not capture the recurrent layers,
+so they run eagerly between the compiled graphs of the RNN based modules.
+
+Example:
+    python tools/benchmark_compile.py --batch-size 32 --max-length 64 --backend inductor
+"""
+import argparse
+import time
+
+import torch
+
+from slp.deploy import compile_model, measure_latency
+from slp.modules.fuse import ProjectFuseAggregate
+from slp.modules.multimodal import MultimodalBaseline
+from slp.modules.rnn import AttentiveRNN
+from slp.modules.transformer import TransformerSequenceEncoder
+from slp.util.pytorch import pad_mask
+
+
+def make_batches(args, num_modalities):
+    batches = []
+
+    for _ in range(args.num_batches):
+        lengths = torch.randint(
+            args.max_length // 4, args.max_length + 1, (args.batch_size,)
+        )
+        lengths[0] = args.max_length
+        mods = [
+            torch.randn(args.batch_size, args.max_length, args.hidden_size)
+            for _ in range(num_modalities)
+        ]
+        batches.append((mods, lengths))
+
+    return batches
+
+
+def transformer_forward(model, batch):
+    (x,), lengths = batch
+    mask = pad_mask(lengths, max_length=x.size(1))
+
+    return model(x, attention_mask=mask), None
+
+
+def rnn_forward(model, batch):
+    (x,), lengths = batch
+
+    return model(x, lengths), None
+
+
+def fusion_forward(model, batch):
+    mods, lengths = batch
+
+    return model(*mods, lengths=lengths), None
+
+
+def benchmarks(args):
+    h = args.hidden_size
+
+    return {
+        "transformer": lambda: (
+            TransformerSequenceEncoder(
+                h,
+                num_layers=4,
+                hidden_size=h,
+                num_heads=8,
+                max_length=args.max_length,
+                inner_size=4 * h,
+            ),
+            1,
+            transformer_forward,
+        ),
+        "rnn": lambda: (
+            AttentiveRNN(h, h, layers=2, attention=True),
+            1,
+            rnn_forward,
+        ),
+        "fusion": lambda: (
+            ProjectFuseAggregate(
+                [h, h, h],
+                h,
+                projection_type="linear",
+                fusion_method="attention",
+                timesteps_pooling_method="rnn",
+            ),
+            3,
+            fusion_forward,
+        ),
+        "multimodal": lambda: (
+            MultimodalBaseline(h, h, h, hidden_size=h),
+            3,
+            fusion_forward,
+        ),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark eager vs compiled modules")
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        choices=["transformer", "rnn", "fusion", "multimodal"],
+        default=["transformer", "rnn", "fusion", "multimodal"],
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--num-batches", type=int, default=10)
+    parser.add_argument("--backend", type=str, default="inductor")
+    parser.add_argument("--mode", type=str, default=None)
+    parser.add_argument("--threads", type=int, default=None)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    print(
+        f"{'model':>12} {'compile (s)':>12} {'max diff':>10} {'eager (ms)':>11} "
+        f"{'compiled (ms)':>14} {'speedup':>8}",
+        flush=True,
+    )
+    builders = benchmarks(args)
+
+    for name in args.models:
+        model, num_modalities, forward_fn = builders[name]()
+        model.eval()
+        batches = make_batches(args, num_modalities)
+        compiled = compile_model(
+            model, fullgraph=name == "transformer", backend=args.backend, mode=args.mode
+        )
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            out, _ = forward_fn(compiled, batches[0])
+            compile_time = time.perf_counter() - start
+            expected, _ = forward_fn(model, batches[0])
+        max_diff = (expected - out).abs().max().item()
+
+        eager = measure_latency(model, batches, forward_fn=forward_fn)
+        latency = measure_latency(compiled, batches, forward_fn=forward_fn)
+        print(
+            f"{name:>12} {compile_time:>12.1f} {max_diff:>10.2e} {1000 * eager:>11.2f} "
+            f"{1000 * latency:>14.2f} {eager / latency:>8.2f}",
+            flush=True,
+        )
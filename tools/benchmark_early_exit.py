@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Benchmark early exit inference of TransformerEarlyExitClassifier
+
+Trains all exit heads jointly on a synthetic classification task, where the label is the keyword token
+that follows a marker token. Distractor keywords appear at random positions, so examples without
+distractors are easy and examples with many distractors are hard.
+Then evaluates held out data for a range of confidence thresholds and reports accuracy, average number
+of layers used and speedup over running all layers. The fastest threshold with an accuracy drop of at
+most --max-accuracy-drop is reported last.
+
+Example:
+    python tools/benchmark_early_exit.py --num-layers 6 --thresholds 0.8 0.9 0.95 0.99
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from slp.modules.classifier import TransformerEarlyExitClassifier
+from slp.modules.transformer import TransformerTokenSequenceEncoder
+from slp.util.pytorch import pad_mask
+
+
+def make_data(args, num_examples):
+    lengths = torch.randint(args.max_length // 4, args.max_length + 1, (num_examples,))
+    marker = args.num_classes + 1
+    x = torch.randint(marker + 1, args.vocab_size, (num_examples, args.max_length))
+    y = torch.randint(0, args.num_classes, (num_examples,))
+
+    for i in range(num_examples):
+        # Distractor keywords, then the marker followed by the label keyword
+        num_distractors = int(torch.randint(0, 8, (1,)))
+        positions = torch.randperm(int(lengths[i]) - 1)[: num_distractors + 1]
+        x[i, positions[1:]] = torch.randint(1, marker, (positions.size(0) - 1,))
+        x[i, positions[0]] = marker
+        x[i, positions[0] + 1] = y[i] + 1
+
+    mask = pad_mask(lengths, max_length=args.max_length)
+    x = x * mask.long()
+
+    return x.to(args.device), y.to(args.device), mask.to(args.device)
+
+
+def train(args, model):
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    model.train()
+
+    for step in range(args.steps):
+        x, y, mask = make_data(args, args.batch_size)
+        exits = model(x, attention_mask=mask)
+        # Same objective as TransformerClassificationPLModule: loss averaged over all exits
+        loss = F.cross_entropy(exits.flatten(0, 1), y.repeat(exits.size(0)))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if step % 100 == 0:
+            print(f"step {step}: loss {loss.item():.4f}", flush=True)
+
+
+@torch.no_grad()
+def evaluate(args, model, data, threshold):
+    model.eval()
+    model.threshold = threshold
+    correct, layers, elapsed = 0, 0.0, 0.0
+
+    for x, y, mask in data:
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        logits = model(x, attention_mask=mask)
+
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+        correct += (logits.argmax(-1) == y).sum().item()
+        layers += model.exit_layers.float().sum().item()
+
+    num_examples = sum(x.size(0) for x, _, _ in data)
+
+    return correct / num_examples, layers / num_examples, elapsed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark early exit inference")
+    parser.add_argument("--num-layers", type=int, default=6)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--num-heads", type=int, default=4)
+    parser.add_argument("--vocab-size", type=int, default=1000)
+    parser.add_argument("--num-classes", type=int, default=3)
+    parser.add_argument("--max-length", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--eval-batches", type=int, default=20)
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.6, 0.8, 0.9, 0.95, 0.99]
+    )
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+    encoder = TransformerTokenSequenceEncoder(
+        vocab_size=args.vocab_size,
+        max_length=args.max_length,
+        num_layers=args.num_layers,
+        hidden_size=args.hidden_size,
+        num_heads=args.num_heads,
+        inner_size=4 * args.hidden_size,
+        dropout=0.1,
+    )
+    model = TransformerEarlyExitClassifier(encoder, args.num_classes, dropout=0.1)
+    model = model.to(args.device)
+    train(args, model)
+
+    data = [make_data(args, args.batch_size) for _ in range(args.eval_batches)]
+    full_accuracy, _, full_time = evaluate(args, model, data, None)
+    print(
+        f"{'threshold':>10} {'accuracy':>9} {'avg layers':>11} {'time (ms)':>10} {'speedup':>8}",
+        flush=True,
+    )
+    print(
+        f"{'none':>10} {full_accuracy:>9.4f} {args.num_layers:>11.2f} {1000 * full_time:>10.1f} {1.0:>8.2f}",
+        flush=True,
+    )
+    best = None
+
+    for threshold in args.thresholds:
+        accuracy, layers, elapsed = evaluate(args, model, data, threshold)
+        speedup = full_time / elapsed
+        print(
+            f"{threshold:>10} {accuracy:>9.4f} {layers:>11.2f} {1000 * elapsed:>10.1f} {speedup:>8.2f}",
+            flush=True,
+        )
+
+        if full_accuracy - accuracy <= args.max_accuracy_drop and (
+            best is None or speedup > best[1]
+        ):
+            best = (threshold, speedup, layers)
+
+    if best is not None:
+        print(
+            f"Best threshold within {args.max_accuracy_drop} accuracy drop: {best[0]} "
+            f"({best[2]:.2f} layers, {best[1]:.2f}x speedup)"
+        )
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Benchmark Transformer.generate against decoding without a key / value cache
+
+* cached: Transformer.generate. The decoder runs one position per step, with cached self-attention
+    keys / values and cross-attention keys / values computed once per source
+* recompute: Full forward pass over the whole target prefix at every step
+
+Both methods run greedy decoding for a fixed number of steps (eos is never produced) and report
+generated tokens per second.
+
+Example:
+    python tools/benchmark_generate.py --lengths 32 64 128 256 --batch-size 8
+"""
+import argparse
+import time
+
+import torch
+
+from slp.modules.transformer import Transformer
+from slp.util.pytorch import subsequent_mask
+
+
+def recompute_generate(model, source, bos_idx, max_length):
+    tokens = source.new_full((source.size(0), 1), bos_idx)
+
+    for _ in range(max_length - 1):
+        logits = model(source, tokens, target_mask=subsequent_mask(tokens.size(1)))
+        tokens = torch.cat([tokens, logits[:, -1].argmax(-1, keepdim=True)], dim=-1)
+
+    return tokens
+
+
+def timeit(fn, repeats, device):
+    fn()
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        out = fn()
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+    return out, (time.perf_counter() - start) / repeats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark incremental decoding")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--source-length", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--beam-size", type=int, default=1)
+    parser.add_argument("--vocab-size", type=int, default=8000)
+    parser.add_argument("--num-layers", type=int, default=6)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--inner-size", type=int, default=2048)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+    model = Transformer(
+        vocab_size=args.vocab_size,
+        max_length=max(max(args.lengths), args.source_length),
+        num_layers=args.num_layers,
+        hidden_size=args.hidden_size,
+        num_heads=args.num_heads,
+        inner_size=args.inner_size,
+    )
+    model = model.to(args.device).eval()
+    source = torch.randint(
+        3, args.vocab_size, (args.batch_size, args.source_length), device=args.device
+    )
+    # Never produce eos, so that all methods decode the same number of steps
+    eos_idx = -1
+    print(
+        f"{'length':>8} {'method':>10} {'time (ms)':>10} {'tokens/s':>10}", flush=True
+    )
+
+    with torch.no_grad():
+        for length in args.lengths:
+            methods = {
+                "cached": lambda: model.generate(
+                    source,
+                    bos_idx=1,
+                    eos_idx=eos_idx,
+                    max_length=length,
+                    beam_size=args.beam_size,
+                )[0]
+            }
+
+            if args.beam_size == 1:
+                methods["recompute"] = lambda: recompute_generate(
+                    model, source, 1, length
+                )
+            outputs = {}
+
+            for name, fn in methods.items():
+                outputs[name], elapsed = timeit(fn, args.repeats, args.device)
+                throughput = args.batch_size * (length - 1) / elapsed
+                print(
+                    f"{length:>8} {name:>10} {1000 * elapsed:>10.2f} {throughput:>10.0f}",
+                    flush=True,
+                )
+
+            if "recompute" in outputs:
+                # Near ties of an untrained model can flip with float rounding, after which sequences diverge
+                agreement = (
+                    (outputs["cached"] == outputs["recompute"]).float().mean().item()
+                )
+                print(f"{'':>8} {'agreement':>10} {agreement:>10.3f}", flush=True)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""Compare nystrom_attention against the previous implementation
+
+Reports time per call and relative approximation error with respect to exact softmax attention,
+for ragged batches (sequence lengths uniformly sampled in [L / 2, L]).
+
+Example:
+    python tools/benchmark_nystrom.py --lengths 500 1000 2000 4000 --num-landmarks 64
+
+The legacy_* functions are a frozen copy of the implementation that padded inputs to a multiple of
+num_landmarks, built the three kernels with separate attention_scores calls and normalized
+the pseudo-inverse with a global max over the batch.
+"""
+import argparse
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+from slp.modules.attention import attention, nystrom_attention
+
+
+def legacy_moore_penrose_pinv(x, num_iter=6):
+    abs_x = torch.abs(x)
+    col = abs_x.sum(dim=-1)
+    row = abs_x.sum(dim=-2)
+    z = x.transpose(-1, -2).contiguous()
+    z = z / (torch.max(col) * torch.max(row))
+
+    I = torch.eye(x.shape[-1], device=x.device).unsqueeze(0)
+
+    for _ in range(num_iter):
+        xz = x @ z
+        z = 0.25 * z @ (13 * I - (xz @ (15 * I - (xz @ (7 * I - xz)))))
+
+    return z
+
+
+def legacy_attention_scores(k, q, dk, attention_mask=None, dropout=0.2, training=True):
+    scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(dk)
+
+    if attention_mask is not None:
+        scores = scores + ((1 - attention_mask) * -1e5)
+    scores = F.softmax(scores, dim=-1)
+    scores = F.dropout(scores, p=dropout, training=training)
+
+    return scores
+
+
+def legacy_nystrom_attention(
+    k,
+    q,
+    v,
+    dk,
+    num_landmarks,
+    attention_mask=None,
+    inverse_iterations=6,
+    dropout=0.2,
+    training=True,
+):
+    _, num_heads, seq_length, head_size = k.size()
+
+    masked_mean_denom = seq_length // num_landmarks
+
+    if attention_mask is not None:
+        attention_mask = attention_mask.unsqueeze(1)
+        masked_mean_denom = (
+            attention_mask.reshape(
+                -1, 1, num_landmarks, seq_length // num_landmarks
+            ).sum(-1)
+            + 1e-8
+        )
+        mask_landmarks = (masked_mean_denom > 0).type(torch.float)
+        masked_mean_denom = masked_mean_denom[..., None]
+        attention_mask = attention_mask.unsqueeze(-1)
+        q = q * attention_mask
+        k = k * attention_mask
+        v = v * attention_mask
+
+        scores_1_mask = attention_mask * mask_landmarks[..., None, :]
+        scores_2_mask = mask_landmarks[..., None] * mask_landmarks[..., None, :]
+        scores_3_mask = scores_1_mask.transpose(-1, -2)
+
+    q = q / math.sqrt(dk)
+
+    q_landmarks = q.reshape(
+        q.size(0), q.size(1), num_landmarks, seq_length // num_landmarks, q.size(-1)
+    ).sum(dim=-2)
+
+    k_landmarks = k.reshape(
+        k.size(0), k.size(1), num_landmarks, seq_length // num_landmarks, k.size(-1)
+    ).sum(dim=-2)
+
+    k_landmarks = k_landmarks / masked_mean_denom
+    q_landmarks = q_landmarks / masked_mean_denom
+
+    scores_1 = legacy_attention_scores(
+        k_landmarks, q, 1, scores_1_mask, dropout=dropout, training=training
+    )
+    scores_2 = legacy_attention_scores(
+        k_landmarks, q_landmarks, 1, scores_2_mask, dropout=dropout, training=training
+    )
+    scores_3 = legacy_attention_scores(
+        k, q_landmarks, 1, scores_3_mask, dropout=dropout, training=training
+    )
+
+    z_star = legacy_moore_penrose_pinv(scores_2, num_iter=inverse_iterations)
+    out = (scores_1 @ z_star) @ (scores_3 @ v)
+
+    return out, (scores_1, scores_2, scores_3)
+
+
+def legacy_forward(k, q, v, dk, num_landmarks, mask, inverse_iterations):
+    """Left pad to a multiple of num_landmarks, as the previous implementation did"""
+    seq_length = k.size(-2)
+    remainder = seq_length % num_landmarks
+
+    if remainder > 0:
+        padding = num_landmarks - remainder
+        k, q, v = [F.pad(t, (0, 0, padding, 0)) for t in (k, q, v)]
+        mask = F.pad(mask, (padding, 0))
+    out, _ = legacy_nystrom_attention(
+        k,
+        q,
+        v,
+        dk,
+        num_landmarks,
+        attention_mask=mask,
+        inverse_iterations=inverse_iterations,
+        dropout=0.0,
+        training=False,
+    )
+
+    return out[..., -seq_length:, :]
+
+
+def make_inputs(args, length):
+    lengths = torch.randint(length // 2, length + 1, (args.batch_size,))
+    lengths[0] = length
+    mask = (torch.arange(length)[None, :] < lengths[:, None]).float()
+    shape = (args.batch_size, args.num_heads, length, args.head_size)
+    # Low rank structure + noise, so that attention is not uniform
+    basis = torch.randn(args.batch_size, args.num_heads, args.rank, args.head_size)
+    coefs = torch.randn(args.batch_size, args.num_heads, length, args.rank)
+    x = args.scale * coefs @ basis / math.sqrt(args.rank)
+    q = x + args.noise * torch.randn(*shape)
+    k = x + args.noise * torch.randn(*shape)
+    v = torch.randn(*shape)
+
+    return [t.to(args.device) for t in (k, q, v, mask)]
+
+
+def timeit(fn, repeats, device):
+    fn()
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        out = fn()
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+    return out, (time.perf_counter() - start) / repeats
+
+
+def relative_error(out, ref, mask):
+    valid = mask[:, None, :, None]
+
+    return ((out - ref) * valid).norm().item() / (ref * valid).norm().item()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark nystrom attention")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[500, 1000, 2000])
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--head-size", type=int, default=64)
+    parser.add_argument("--num-landmarks", type=int, default=64)
+    parser.add_argument("--inverse-iterations", type=int, default=6)
+    parser.add_argument("--rank", type=int, default=8, help="Rank of q, k structure")
+    parser.add_argument(
+        "--scale", type=float, default=0.5, help="Scale of low rank q, k component"
+    )
+    parser.add_argument(
+        "--noise", type=float, default=0.1, help="Scale of full rank q, k noise"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+    print(
+        f"{'length':>8} {'method':>8} {'time (ms)':>10} {'rel. error':>11}", flush=True
+    )
+
+    with torch.no_grad():
+        for length in args.lengths:
+            k, q, v, mask = make_inputs(args, length)
+            ref, _ = attention(
+                k,
+                q,
+                v,
+                args.head_size,
+                attention_mask=mask[:, None, None, :],
+                dropout=0.0,
+                training=False,
+            )
+            legacy, legacy_time = timeit(
+                lambda: legacy_forward(
+                    k,
+                    q,
+                    v,
+                    args.head_size,
+                    args.num_landmarks,
+                    mask,
+                    args.inverse_iterations,
+                ),
+                args.repeats,
+                args.device,
+            )
+            (new, _), new_time = timeit(
+                lambda: nystrom_attention(
+                    k,
+                    q,
+                    v,
+                    args.head_size,
+                    args.num_landmarks,
+                    attention_mask=mask,
+                    inverse_iterations=args.inverse_iterations,
+                    dropout=0.0,
+                    training=False,
+                ),
+                args.repeats,
+                args.device,
+            )
+
+            for name, out, elapsed in [
+                ("legacy", legacy, legacy_time),
+                ("new", new, new_time),
+            ]:
+                err = relative_error(out, ref, mask)
+                print(
+                    f"{length:>8} {name:>8} {1000 * elapsed:>10.2f} {err:>11.4f}",
+                    flush=True,
+                )
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Benchmark pytorch vs onnxruntime CPU inference of exported slp models
+
+Exports randomly initialized TokenRNN, RNNSequenceClassifier, TransformerTokenSequenceClassifier and
+MultimodalBaselineClassifier models with slp.deploy.export_onnx, checks parity on batches with other
+batch sizes and sequence lengths than the export sample, and reports the CPU latency per batch of
+pytorch and onnxruntime. Requires onnx and onnxruntime.
+
+Example:
+    python tools/benchmark_onnx.py --batch-size 32 --max-length 64 --threads 1
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+
+from slp.deploy import OnnxModel, export_onnx, measure_latency
+from slp.modules.classifier import (
+    RNNSequenceClassifier,
+    TransformerTokenSequenceClassifier,
+)
+from slp.modules.multimodal import MultimodalBaselineClassifier
+from slp.modules.rnn import TokenRNN
+from slp.util.pytorch import pad_mask
+
+
+def make_lengths(batch_size, max_length):
+    lengths = torch.randint(max_length // 4 + 1, max_length + 1, (batch_size,))
+    lengths[0] = max_length
+
+    return lengths
+
+
+def benchmarks(args):
+    def token_rnn():
+        model = TokenRNN(
+            hidden_size=args.hidden_size,
+            vocab_size=args.vocab_size,
+            embeddings_dim=300,
+            layers=2,
+            bidirectional=True,
+        )
+
+        def make_inputs(b, l):
+            return torch.randint(1, args.vocab_size, (b, l)), make_lengths(b, l)
+
+        return model, make_inputs
+
+    def rnn():
+        model = RNNSequenceClassifier(
+            args.input_size,
+            args.num_classes,
+            hidden_size=args.hidden_size,
+            layers=2,
+            bidirectional=True,
+        )
+
+        def make_inputs(b, l):
+            return torch.randn(b, l, args.input_size), make_lengths(b, l)
+
+        return model, make_inputs
+
+    def transformer():
+        model = TransformerTokenSequenceClassifier(
+            args.num_classes,
+            vocab_size=args.vocab_size,
+            num_layers=4,
+            hidden_size=args.hidden_size,
+            num_heads=8,
+            max_length=args.max_length,
+            inner_size=4 * args.hidden_size,
+        )
+
+        def make_inputs(b, l):
+            mask = pad_mask(make_lengths(b, l), max_length=l)
+
+            return torch.randint(1, args.vocab_size, (b, l)), mask
+
+        return model, make_inputs
+
+    def multimodal():
+        model = MultimodalBaselineClassifier(
+            num_classes=1, hidden_size=args.hidden_size
+        )
+
+        def make_inputs(b, l):
+            mods = {
+                "text": torch.randn(b, l, 300),
+                "audio": torch.randn(b, l, 74),
+                "visual": torch.randn(b, l, 35),
+            }
+
+            return mods, {"text": make_lengths(b, l)}
+
+        return model, make_inputs
+
+    return {
+        "token_rnn": token_rnn,
+        "rnn": rnn,
+        "transformer": transformer,
+        "multimodal": multimodal,
+    }
+
+
+def forward(model, batch):
+    return model(*batch), None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark ONNX export")
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        choices=["token_rnn", "rnn", "transformer", "multimodal"],
+        default=["token_rnn", "rnn", "transformer", "multimodal"],
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=64)
+    parser.add_argument("--num-batches", type=int, default=10)
+    parser.add_argument("--input-size", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--num-classes", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    print(
+        f"{'model':>12} {'max diff':>10} {'torch (ms)':>11} {'onnx (ms)':>10} {'speedup':>8}",
+        flush=True,
+    )
+    builders = benchmarks(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.models:
+            model, make_inputs = builders[name]()
+            model.eval()
+            path = os.path.join(tmp, f"{name}.onnx")
+            # Export with a small batch, run with the benchmark batch size and lengths
+            sample = make_inputs(2, args.max_length // 2)
+            batches = [
+                make_inputs(args.batch_size, args.max_length)
+                for _ in range(args.num_batches)
+            ]
+            report = export_onnx(model, sample, path, check_batches=batches)
+            onnx_model = OnnxModel(path, num_threads=args.threads)
+
+            latency = measure_latency(model, batches, forward_fn=forward)
+            onnx_latency = measure_latency(onnx_model, batches, forward_fn=forward)
+            print(
+                f"{name:>12} {report['max_abs_diff']:>10.2e} {1000 * latency:>11.2f} "
+                f"{1000 * onnx_latency:>10.2f} {latency / onnx_latency:>8.2f}",
+                flush=True,
+            )
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Benchmark moore_penrose_pinv inside nystrom_attention
+
+Compares the current moore_penrose_pinv against the previous implementation across batch sizes
+and landmark counts. Reports time per nystrom_attention call, with and without gradients, and
+the pseudo-inverse residual max ||I - x z||_F over the landmark kernels.
+
+* legacy: frozen copy of the previous implementation, which allocated 13 * I, 15 * I and 7 * I
+    in every iteration
+* new: moore_penrose_pinv with a fixed number of iterations
+* new+tol: moore_penrose_pinv with early stopping on --tol, up to --max-iterations iterations
+
+Example:
+    python tools/benchmark_pinv.py --batch-sizes 1 8 32 --num-landmarks 32 64 128
+"""
+import argparse
+import time
+
+import torch
+
+import slp.modules.attention as attention_module
+from slp.util.pytorch import moore_penrose_pinv
+
+
+def legacy_moore_penrose_pinv(x, num_iter=6, tol=None):
+    abs_x = torch.abs(x)
+    col = abs_x.sum(dim=-1)
+    row = abs_x.sum(dim=-2)
+    z = x.transpose(-1, -2).contiguous()
+    z = z / (
+        col.max(dim=-1, keepdim=True)[0] * row.max(dim=-1, keepdim=True)[0]
+    ).unsqueeze(-1)
+
+    I = torch.eye(x.shape[-1], device=x.device).unsqueeze(0)
+
+    for _ in range(num_iter):
+        xz = x @ z
+        z = 0.25 * z @ (13 * I - (xz @ (15 * I - (xz @ (7 * I - xz)))))
+
+    return z
+
+
+class Recorder(object):
+    def __init__(self, pinv):
+        """Wrap a pinv implementation and keep the residual of its last call"""
+        self.pinv = pinv
+        self.residual = None
+
+    def __call__(self, x, num_iter=6, tol=None):
+        z = self.pinv(x, num_iter=num_iter, tol=tol)
+        eye = torch.eye(x.size(-1), device=x.device, dtype=x.dtype)
+        self.residual = (eye - x @ z).norm(dim=(-2, -1)).max().item()
+
+        return z
+
+
+def run(args, pinv, batch_size, num_landmarks, backward, tol=None):
+    shape = (batch_size, args.num_heads, args.length, args.head_size)
+    k, q, v = [
+        torch.randn(*shape, device=args.device, requires_grad=backward)
+        for _ in range(3)
+    ]
+    recorder = Recorder(pinv)
+    attention_module.moore_penrose_pinv = recorder
+    iterations = args.max_iterations if tol is not None else args.inverse_iterations
+
+    def step():
+        with torch.set_grad_enabled(backward):
+            out, _ = attention_module.nystrom_attention(
+                k,
+                q,
+                v,
+                args.head_size,
+                num_landmarks,
+                inverse_iterations=iterations,
+                inverse_tolerance=tol,
+                dropout=0.0,
+                training=False,
+            )
+
+        if backward:
+            out.sum().backward()
+
+    try:
+        step()
+
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+
+        for _ in range(args.repeats):
+            step()
+
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+    finally:
+        attention_module.moore_penrose_pinv = moore_penrose_pinv
+
+    return (time.perf_counter() - start) / args.repeats, recorder.residual
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark pseudo-inverse in nystrom attention")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--num-landmarks", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--length", type=int, default=512)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--head-size", type=int, default=64)
+    parser.add_argument("--inverse-iterations", type=int, default=6)
+    parser.add_argument("--max-iterations", type=int, default=20)
+    parser.add_argument("--tol", type=float, default=1e-2)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+    print(
+        f"{'batch':>6} {'landmarks':>10} {'method':>8} {'fwd (ms)':>9} {'fwd+bwd (ms)':>13} {'residual':>9}",
+        flush=True,
+    )
+
+    for batch_size in args.batch_sizes:
+        for num_landmarks in args.num_landmarks:
+            for name, pinv, tol in [
+                ("legacy", legacy_moore_penrose_pinv, None),
+                ("new", moore_penrose_pinv, None),
+                ("new+tol", moore_penrose_pinv, args.tol),
+            ]:
+                fwd, residual = run(args, pinv, batch_size, num_landmarks, False, tol)
+                bwd, _ = run(args, pinv, batch_size, num_landmarks, True, tol)
+                print(
+                    f"{batch_size:>6} {num_landmarks:>10} {name:>8} {1000 * fwd:>9.2f} "
+                    f"{1000 * bwd:>13.2f} {residual:>9.4f}",
+                    flush=True,
+                )
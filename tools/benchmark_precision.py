@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Benchmark float32 vs bfloat16 autocast training on CPU
+
+Times a training step (forward, loss, backward and Adam update) of randomly initialized
+TransformerTokenSequenceClassifier and RNNSequenceClassifier models, in float32 and under
+torch.autocast("cpu", dtype=torch.bfloat16), as SimplePLModule does with autocast_dtype=torch.bfloat16.
+Weights and optimizer states stay in float32. The loss column is the relative difference of the
+bfloat16 loss from the float32 loss on the same batch.
+
+bfloat16 is fast on CPUs with native support (AVX512-BF16 or AMX, e.g. Intel Sapphire Rapids or AMD Zen 4).
+On older CPUs it is emulated and slower than float32.
+
+Example:
+    python tools/benchmark_precision.py --batch-size 32 --max-length 128 --threads 8
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from slp.modules.classifier import (
+    RNNSequenceClassifier,
+    TransformerTokenSequenceClassifier,
+)
+from slp.util.pytorch import pad_mask
+
+
+def make_lengths(batch_size, max_length):
+    lengths = torch.randint(max_length // 4 + 1, max_length + 1, (batch_size,))
+    lengths[0] = max_length
+
+    return lengths
+
+
+def benchmarks(args):
+    def transformer():
+        model = TransformerTokenSequenceClassifier(
+            args.num_classes,
+            vocab_size=args.vocab_size,
+            num_layers=4,
+            hidden_size=args.hidden_size,
+            num_heads=8,
+            max_length=args.max_length,
+            inner_size=4 * args.hidden_size,
+            dropout=0.1,
+        )
+        lengths = make_lengths(args.batch_size, args.max_length)
+        inputs = (
+            torch.randint(1, args.vocab_size, (args.batch_size, args.max_length)),
+            pad_mask(lengths, max_length=args.max_length),
+        )
+
+        return model, inputs
+
+    def rnn():
+        model = RNNSequenceClassifier(
+            args.input_size,
+            args.num_classes,
+            hidden_size=args.hidden_size,
+            layers=2,
+            bidirectional=True,
+        )
+        inputs = (
+            torch.randn(args.batch_size, args.max_length, args.input_size),
+            make_lengths(args.batch_size, args.max_length),
+        )
+
+        return model, inputs
+
+    return {"transformer": transformer, "rnn": rnn}
+
+
+def train_step(model, optimizer, criterion, inputs, targets, dtype):
+    optimizer.zero_grad()
+
+    with torch.autocast("cpu", dtype=dtype, enabled=dtype != torch.float32):
+        loss = criterion(model(*inputs).float(), targets)
+    loss.backward()
+    optimizer.step()
+
+    return loss.item()
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        fn()
+
+    return (time.perf_counter() - start) / repeats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark bfloat16 autocast training")
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        choices=["transformer", "rnn"],
+        default=["transformer", "rnn"],
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--input-size", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--num-classes", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    print(
+        f"{'model':>12} {'fp32 (ms)':>10} {'bf16 (ms)':>10} {'speedup':>8} {'loss diff':>10}",
+        flush=True,
+    )
+    builders = benchmarks(args)
+    criterion = nn.CrossEntropyLoss()
+    targets = torch.randint(0, args.num_classes, (args.batch_size,))
+
+    for name in args.models:
+        model, inputs = builders[name]()
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        times, losses = {}, {}
+
+        for dtype in (torch.float32, torch.bfloat16):
+            # Same weights and dropout masks for both runs
+            state = {k: v.clone() for k, v in model.state_dict().items()}
+            torch.manual_seed(0)
+            losses[dtype] = train_step(
+                model, optimizer, criterion, inputs, targets, dtype
+            )
+            model.load_state_dict(state)
+            times[dtype] = timeit(
+                lambda: train_step(model, optimizer, criterion, inputs, targets, dtype),
+                args.repeats,
+            )
+            model.load_state_dict(state)
+
+        fp32, bf16 = times[torch.float32], times[torch.bfloat16]
+        diff = abs(losses[torch.bfloat16] - losses[torch.float32]) / abs(
+            losses[torch.float32]
+        )
+        print(
+            f"{name:>12} {1000 * fp32:>10.2f} {1000 * bf16:>10.2f} {fp32 / bf16:>8.2f} "
+            f"{diff:>10.2e}",
+            flush=True,
+        )
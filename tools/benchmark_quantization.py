@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Benchmark dynamic int8 quantization of the deployed classifiers on CPU
+
+Quantizes randomly initialized TransformerSequenceClassifier, RNNSequenceClassifier, TokenRNN and
+MultimodalBaselineClassifier models with slp.deploy.quantize_and_report, on random batches, and reports
+prediction agreement, CPU latency per batch and model size before and after quantization.
+
+Example:
+    python tools/benchmark_quantization.py --batch-size 32 --max-length 64 --threads 1
+"""
+import argparse
+
+import torch
+
+from slp.deploy import quantize_and_report
+from slp.modules.classifier import RNNSequenceClassifier, TransformerSequenceClassifier
+from slp.modules.multimodal import MultimodalBaselineClassifier
+from slp.modules.rnn import TokenRNN
+from slp.util.pytorch import pad_mask
+
+
+def make_lengths(args):
+    lengths = torch.randint(
+        args.max_length // 4, args.max_length + 1, (args.batch_size,)
+    )
+    lengths[0] = args.max_length
+
+    return lengths
+
+
+def make_batches(args, make_inputs):
+    batches = []
+
+    for _ in range(args.num_batches):
+        lengths = make_lengths(args)
+        targets = torch.randint(0, args.num_classes, (args.batch_size,))
+        batches.append((make_inputs(), targets, lengths))
+
+    return batches
+
+
+def transformer_forward(model, batch):
+    inputs, targets, lengths = batch
+    mask = pad_mask(lengths, max_length=inputs.size(1))
+
+    return model(inputs, attention_mask=mask), targets
+
+
+def token_rnn_forward(model, batch):
+    inputs, targets, lengths = batch
+
+    return model(inputs, lengths), targets
+
+
+def multimodal_forward(model, batch):
+    inputs, targets, lengths = batch
+
+    return model(inputs, {"text": lengths}), targets
+
+
+def benchmarks(args):
+    b, l = args.batch_size, args.max_length
+
+    def transformer():
+        model = TransformerSequenceClassifier(
+            args.input_size,
+            args.num_classes,
+            num_layers=4,
+            hidden_size=args.hidden_size,
+            num_heads=8,
+            max_length=l,
+            inner_size=4 * args.hidden_size,
+        )
+        batches = make_batches(args, lambda: torch.randn(b, l, args.input_size))
+
+        return model, batches, transformer_forward
+
+    def rnn():
+        model = RNNSequenceClassifier(
+            args.input_size,
+            args.num_classes,
+            hidden_size=args.hidden_size,
+            layers=2,
+            bidirectional=True,
+        )
+        batches = make_batches(args, lambda: torch.randn(b, l, args.input_size))
+
+        return model, batches, token_rnn_forward
+
+    def token_rnn():
+        model = TokenRNN(
+            hidden_size=args.hidden_size,
+            vocab_size=args.vocab_size,
+            embeddings_dim=300,
+            layers=2,
+            bidirectional=True,
+        )
+        batches = make_batches(args, lambda: torch.randint(1, args.vocab_size, (b, l)))
+
+        return model, batches, token_rnn_forward
+
+    def multimodal():
+        model = MultimodalBaselineClassifier(
+            num_classes=1, hidden_size=args.hidden_size
+        )
+        batches = make_batches(
+            args,
+            lambda: {
+                "text": torch.randn(b, l, 300),
+                "audio": torch.randn(b, l, 74),
+                "visual": torch.randn(b, l, 35),
+            },
+        )
+
+        return model, batches, multimodal_forward
+
+    return {
+        "transformer": transformer,
+        "rnn": rnn,
+        "token_rnn": token_rnn,
+        "multimodal": multimodal,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark dynamic quantization")
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        choices=["transformer", "rnn", "token_rnn", "multimodal"],
+        default=["transformer", "rnn", "token_rnn", "multimodal"],
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=64)
+    parser.add_argument("--num-batches", type=int, default=5)
+    parser.add_argument("--input-size", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--num-classes", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    print(
+        f"{'model':>12} {'agreement':>10} {'fp32 (ms)':>10} {'int8 (ms)':>10} {'speedup':>8} "
+        f"{'fp32 (MB)':>10} {'int8 (MB)':>10} {'reduction':>10}",
+        flush=True,
+    )
+    builders = benchmarks(args)
+
+    for name in args.models:
+        model, batches, forward_fn = builders[name]()
+        _, report = quantize_and_report(model, batches, forward_fn=forward_fn)
+        print(
+            f"{name:>12} {report['agreement']:>10.4f} {report['latency_ms']:>10.2f} "
+            f"{report['quantized_latency_ms']:>10.2f} {report['speedup']:>8.2f} {report['size_mb']:>10.2f} "
+            f"{report['quantized_size_mb']:>10.2f} {report['size_reduction']:>10.2f}",
+            flush=True,
+        )
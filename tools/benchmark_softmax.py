@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Benchmark full, adaptive and sampled softmax output layers for large vocabulary language models
+
+Times a training step (loss, backward and SGD update) of the output layer alone, on random hidden states
+and targets drawn from a Zipfian distribution with the token counts that create_vocab would produce.
+The eval column is the time of the exact validation loss used for perplexity.
+
+Example:
+    python tools/benchmark_softmax.py --vocab-size 33278 --hidden-size 512 --tokens 4096
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from slp.modules.softmax import make_output_layer
+
+
+def zipf_counts(vocab_size, num_tokens):
+    probs = 1.0 / torch.arange(1, vocab_size + 1, dtype=torch.double)
+    counts = (probs / probs.sum() * num_tokens).round().long()
+    # Token ids are not ordered by frequency
+    return counts[torch.randperm(vocab_size)]
+
+
+def loss_fn(layer):
+    if isinstance(layer, nn.Linear):
+        criterion = nn.CrossEntropyLoss()
+
+        return lambda h, t: criterion(layer(h), t)
+
+    return layer
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        fn()
+
+    return (time.perf_counter() - start) / repeats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark softmax output layers")
+    parser.add_argument(
+        "--layers",
+        type=str,
+        nargs="+",
+        choices=["softmax", "adaptive", "sampled"],
+        default=["softmax", "adaptive", "sampled"],
+    )
+    parser.add_argument("--vocab-size", type=int, default=33278)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--num-sampled", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    counts = zipf_counts(args.vocab_size, 2_000_000)
+    targets = torch.multinomial(counts.double() + 1, args.tokens, replacement=True)
+    hidden = torch.randn(args.tokens, args.hidden_size)
+    print(
+        f"{'layer':>10} {'params (M)':>11} {'train (ms)':>11} {'eval (ms)':>10} {'speedup':>8}",
+        flush=True,
+    )
+    baseline = None
+
+    for name in args.layers:
+        kwargs = {"num_sampled": args.num_sampled} if name == "sampled" else {}
+        layer = make_output_layer(
+            name,
+            args.hidden_size,
+            args.vocab_size,
+            token_counts=counts.tolist(),
+            **kwargs,
+        )
+        compute_loss = loss_fn(layer)
+        optimizer = torch.optim.SGD(layer.parameters(), lr=0.1)
+
+        def train_step():
+            optimizer.zero_grad()
+            compute_loss(hidden, targets).backward()
+            optimizer.step()
+
+        def eval_step():
+            with torch.no_grad():
+                compute_loss(hidden, targets)
+
+        layer.train()
+        train = timeit(train_step, args.repeats)
+        layer.eval()
+        evaluation = timeit(eval_step, args.repeats)
+        baseline = baseline if baseline is not None else train
+        params = sum(p.numel() for p in layer.parameters()) / 1e6
+        print(
+            f"{name:>10} {params:>11.2f} {1000 * train:>11.2f} {1000 * evaluation:>10.2f} "
+            f"{baseline / train:>8.2f}",
+            flush=True,
+        )
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Benchmark padded vs unpadded (varlen) execution of TransformerSequenceEncoder
+
+Sequence lengths are drawn uniformly from [--min-length, --max-length] and the batch is padded
+to the longest sequence. With varlen=True the embedding, projections, feed-forward layers and
+norms run only on the valid tokens, while the attention kernels run on the re-padded batch.
+
+Example:
+    python tools/benchmark_varlen.py --batch-sizes 16 64 --min-length 16 --max-length 512
+"""
+import argparse
+import time
+
+import torch
+
+from slp.modules.transformer import TransformerSequenceEncoder
+from slp.util.pytorch import pad_mask
+
+
+def make_batch(args, batch_size):
+    lengths = torch.randint(args.min_length, args.max_length + 1, (batch_size,))
+    max_length = int(lengths.max())
+    x = torch.randn(batch_size, max_length, args.input_size, device=args.device)
+    mask = pad_mask(lengths, max_length=max_length).to(args.device)
+
+    return x, mask
+
+
+def run(args, model, x, mask, backward):
+    def step():
+        with torch.set_grad_enabled(backward):
+            out = model(x, attention_mask=mask)
+
+        if backward:
+            out.sum().backward()
+
+    step()
+
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+
+    for _ in range(args.repeats):
+        step()
+
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / args.repeats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark varlen transformer encoders")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--min-length", type=int, default=16)
+    parser.add_argument("--max-length", type=int, default=256)
+    parser.add_argument("--input-size", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+    model = TransformerSequenceEncoder(
+        args.input_size,
+        num_layers=args.num_layers,
+        hidden_size=args.hidden_size,
+        num_heads=args.num_heads,
+        max_length=args.max_length,
+        inner_size=4 * args.hidden_size,
+        dropout=0.1,
+    ).to(args.device)
+    print(
+        f"{'batch':>6} {'padding':>8} {'mode':>7} {'fwd (ms)':>9} {'fwd+bwd (ms)':>13}",
+        flush=True,
+    )
+
+    for batch_size in args.batch_sizes:
+        x, mask = make_batch(args, batch_size)
+        padding = 1 - mask.mean().item()
+
+        for varlen in [False, True]:
+            model.varlen = varlen
+            fwd = run(args, model.eval(), x, mask, False)
+            bwd = run(args, model.train(), x, mask, True)
+            print(
+                f"{batch_size:>6} {padding:>8.2f} {'varlen' if varlen else 'padded':>7} "
+                f"{1000 * fwd:>9.2f} {1000 * bwd:>13.2f}",
+                flush=True,
+            )